@@ -0,0 +1,209 @@
+"""Latency of the owner analytics, get_owner_analytics and get_car_analytics, at ten million deals.
+
+Creates a scratch database next to PG_DB, applies the migrations and seeds
+it with a rental history of --deals deals spread over --owners owners with
+100 cars each, then rebuilds the stats with refresh_rental_stats. Times the
+report of random owners against the same totals summed from the history,
+books more cars through make_rent and checks the triggers kept the stats of
+those cars in line with their history. Exits with status 1 if the report's
+p95 exceeds --max-ms or the stats drifted. The scratch database is dropped
+afterwards.
+
+Run from the repository root:
+    python -m benchmarks.bench_analytics --deals 10000000
+"""
+import os
+import time
+import random
+import argparse
+import statistics
+from server.migrations import MigrationRunner
+from benchmarks.check_query_plans import connect, recreate_database, drop_database
+
+
+CARS_PER_OWNER = 100
+
+SEED_SQL = """
+    INSERT INTO users (given_name, surname, passport_no, identification_no, license_no, telephone_no, email, date_of_birth, password)
+    SELECT 'U'||g, 'S', lpad(g::text, 9, '0'), lpad(g::text, 14, '0'), lpad(g::text, 10, '0'),
+           '+375'||lpad(g::text, 9, '0'), 'u'||g||'@mail.com', '1990-01-01', 'pw'||g
+    FROM generate_series(1, 2 * %(owners)s) g;
+
+    INSERT INTO car_types (type_name) SELECT unnest(enum_range(NULL::CAR_TYPE));
+    INSERT INTO fuel_types (type_name) SELECT unnest(enum_range(NULL::FUEL_TYPE));
+    INSERT INTO brands (name, model) SELECT b, 'M'||m FROM unnest(enum_range(NULL::CAR_BRAND)) b, generate_series(1, 20) m;
+
+    -- Owners are users 1..owners, renters the users after them
+    INSERT INTO cars (owner_id, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description)
+    SELECT 1 + g %% %(owners)s, 1 + g %% 9, 1 + (g * 7) %% 600, 1 + g %% 4,
+           lpad((g %% 10000)::text, 4, '0')||' '||chr(65 + (g / 10000) %% 26)||chr(65 + (g / 260000) %% 26)||'-'||(g %% 7),
+           10 + g %% 300, 'car '||g
+    FROM generate_series(1, %(cars)s) g;
+    UPDATE users SET is_owner = TRUE WHERE id <= %(owners)s;
+"""
+
+# Deal k of a car starts 4k days into the history and lasts one to three
+# nights, so a car's deals never overlap. One in twenty is cancelled
+DEALS_SQL = """
+    INSERT INTO rental_deals (user_id, car_id, start_date, end_date, total_price, status)
+    SELECT %(owners)s + 1 + g %% %(owners)s, car_id, start_date, start_date + nights, nights * 50,
+           CASE WHEN g %% 20 = 0 THEN 'inactive' ELSE 'active' END::ACTIVITY_STATUS_TYPE
+    FROM (
+        SELECT g, 1 + g %% %(cars)s AS car_id, DATE '2000-01-01' + (g / %(cars)s) * 4 AS start_date, 1 + g %% 3 AS nights
+        FROM generate_series(%(first)s, %(last)s) g
+    ) AS deals;
+"""
+
+TAXES_SQL = """
+    INSERT INTO taxes (rental_deal_id, price)
+    SELECT id, total_price * 0.13 FROM rental_deals WHERE id BETWEEN %(first)s AND %(last)s;
+"""
+
+REPORT_SQL = [
+    "SELECT * FROM get_owner_analytics(%s);",
+    "SELECT * FROM get_car_analytics(%s);",
+]
+
+# What a report without the stats tables would run
+HISTORY_SQL = """
+    SELECT COUNT(*), SUM(upper(rental_deals.period) - lower(rental_deals.period)),
+           SUM(rental_deals.total_price), SUM(taxes.price)
+    FROM rental_deals
+    JOIN cars ON rental_deals.car_id = cars.id
+    LEFT JOIN taxes ON taxes.rental_deal_id = rental_deals.id
+    WHERE cars.owner_id = %s AND rental_deals.status = 'active';
+"""
+
+CAR_HISTORY_SQL = """
+    SELECT COUNT(*), COALESCE(SUM(upper(rental_deals.period) - lower(rental_deals.period)), 0),
+           COALESCE(SUM(rental_deals.total_price), 0), COALESCE(SUM(taxes.price), 0)
+    FROM rental_deals
+    LEFT JOIN taxes ON taxes.rental_deal_id = rental_deals.id
+    WHERE rental_deals.car_id = %s AND rental_deals.status = 'active';
+"""
+
+
+def seed(connection, deals, owners, chunk_size=1_000_000):
+    cars = owners * CARS_PER_OWNER
+    with connection.cursor() as cursor:
+        # Skips the per-row change notifications and stats updates, refresh_rental_stats does the latter once
+        cursor.execute("SET app.bulk_import = 'on';")
+        cursor.execute(SEED_SQL, {"owners": owners, "cars": cars})
+        connection.commit()
+
+        for first in range(1, deals + 1, chunk_size):
+            last = min(first + chunk_size - 1, deals)
+            cursor.execute(DEALS_SQL, {"owners": owners, "cars": cars, "first": first, "last": last})
+            cursor.execute(TAXES_SQL, {"first": first, "last": last})
+            connection.commit()
+            print(f"    {last:,} deals")
+
+        cursor.execute("RESET app.bulk_import;")
+    connection.commit()
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    connection.autocommit = False
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (
+        statistics.median(samples) * 1000,
+        samples[max(int(len(samples) * 0.95) - 1, 0)] * 1000,
+        samples[-1] * 1000,
+    )
+
+
+def time_statements(cursor, statements, owner_ids):
+    samples = []
+    for owner_id in owner_ids:
+        started = time.perf_counter()
+        for statement in statements:
+            cursor.execute(statement, (owner_id,))
+            cursor.fetchall()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--deals", type=int, default=10_000_000)
+    parser.add_argument("--owners", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=200, help="reports of random owners")
+    parser.add_argument("--history-repeat", type=int, default=5, help="history sums of random owners")
+    parser.add_argument("--bookings", type=int, default=200, help="make_rent calls checked against the history")
+    parser.add_argument("--max-ms", type=float, default=5.0, help="allowed p95 of a report")
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    database = args.database or f"{os.getenv('PG_DB')}_analytics_bench"
+    recreate_database(database)
+    failures = []
+    try:
+        MigrationRunner(lambda: connect(database)).run()
+        connection = connect(database)
+        try:
+            started = time.perf_counter()
+            seed(connection, args.deals, args.owners)
+            print(f"Seeded {args.deals:,} deals in {time.perf_counter() - started:.1f} s")
+
+            with connection.cursor() as cursor:
+                started = time.perf_counter()
+                cursor.execute("CALL refresh_rental_stats();")
+                connection.commit()
+                print(f"refresh_rental_stats in {time.perf_counter() - started:.1f} s")
+
+                random.seed(42)
+                owner_ids = [random.randint(1, args.owners) for _ in range(args.repeat)]
+                p50, p95, worst = percentiles(time_statements(cursor, REPORT_SQL, owner_ids))
+                print(f"Report from the stats    p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  max {worst:8.2f} ms")
+                if p95 > args.max_ms:
+                    failures.append(f"report p95 {p95:.2f} ms above {args.max_ms} ms")
+
+                p50, p95, worst = percentiles(time_statements(cursor, [HISTORY_SQL], owner_ids[:args.history_repeat]))
+                print(f"Sum over the history     p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  max {worst:8.2f} ms")
+                connection.rollback()
+
+                # Bookings after the seeded history, through make_rent and its triggers
+                cars = args.owners * CARS_PER_OWNER
+                booked = random.sample(range(1, cars + 1), min(args.bookings, cars))
+                samples = []
+                for car_id in booked:
+                    started = time.perf_counter()
+                    cursor.execute(
+                        "SELECT make_rent(%s, %s, 'A', 'B', CURRENT_DATE + 1, CURRENT_DATE + 4);",
+                        (args.owners + 1 + car_id % args.owners, car_id),
+                    )
+                    connection.commit()
+                    samples.append(time.perf_counter() - started)
+                p50, p95, worst = percentiles(samples)
+                print(f"make_rent                p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  max {worst:8.2f} ms")
+
+                drifted = 0
+                for car_id in booked:
+                    cursor.execute(
+                        "SELECT deal_count, days_rented, revenue, tax FROM car_rental_stats WHERE car_id = %s;", (car_id,)
+                    )
+                    stats = cursor.fetchone()
+                    cursor.execute(CAR_HISTORY_SQL, (car_id,))
+                    if stats != cursor.fetchone():
+                        drifted += 1
+                connection.rollback()
+                print(f"Stats of {len(booked)} booked cars checked against their history, {drifted} drifted")
+                if drifted:
+                    failures.append(f"stats of {drifted} cars drifted from their history")
+        finally:
+            connection.close()
+    finally:
+        if not args.keep:
+            drop_database(database)
+
+    if failures:
+        raise SystemExit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Latency of the date-range availability search, get_free_cars.
+
+Creates a scratch database next to PG_DB, applies the migrations and seeds
+it with cars and a year of non-overlapping bookings per car, then times
+random search windows on the first page and at random cursors and prints
+the plan of one search. The scratch database is dropped afterwards.
+
+Run from the repository root:
+    python -m benchmarks.bench_availability --cars 100000 --bookings-per-car 12
+"""
+import os
+import time
+import random
+import argparse
+import statistics
+from datetime import date, timedelta
+from server.migrations import MigrationRunner
+from benchmarks.check_query_plans import connect, recreate_database, drop_database
+
+
+YEAR_START = date(2025, 1, 1)
+
+SEED_SQL = """
+    INSERT INTO users (given_name, surname, passport_no, identification_no, license_no, telephone_no, email, date_of_birth, password)
+    SELECT 'U'||g, 'S', lpad(g::text, 9, '0'), lpad(g::text, 14, '0'), lpad(g::text, 10, '0'),
+           '+375'||lpad(g::text, 9, '0'), 'u'||g||'@mail.com', '1990-01-01', 'pw'||g
+    FROM generate_series(1, 1000) g;
+
+    INSERT INTO car_types (type_name) SELECT unnest(enum_range(NULL::CAR_TYPE));
+    INSERT INTO fuel_types (type_name) SELECT unnest(enum_range(NULL::FUEL_TYPE));
+    INSERT INTO brands (name, model) SELECT b, 'M'||m FROM unnest(enum_range(NULL::CAR_BRAND)) b, generate_series(1, 20) m;
+
+    INSERT INTO cars (owner_id, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description)
+    SELECT 1 + g %% 1000, 1 + g %% 9, 1 + (g * 7) %% 600, 1 + g %% 4,
+           lpad((g %% 10000)::text, 4, '0')||' '||chr(65 + (g / 10000) %% 26)||chr(65 + (g / 260000) %% 26)||'-'||(g %% 7),
+           10 + g %% 300, 'car '||g
+    FROM generate_series(1, %(cars)s) g;
+
+    INSERT INTO car_images (car_id, url) SELECT id, 'http://img/'||id||'/main.jpg' FROM cars;
+
+    -- Booking k of a car starts in slot k of the year, shifted by a per-car
+    -- phase, and lasts 1-10 nights, so bookings of one car never overlap
+    INSERT INTO rental_deals (user_id, car_id, start_date, end_date, total_price)
+    SELECT 1 + (car_id + k) %% 1000, car_id,
+           %(year_start)s::date + k * %(slot)s + car_id %% %(slot)s,
+           %(year_start)s::date + k * %(slot)s + car_id %% %(slot)s + 1 + (car_id + k) %% 10,
+           100
+    FROM generate_series(1, %(cars)s) car_id, generate_series(0, %(bookings)s - 1) k;
+"""
+
+SEARCH_SQL = "SELECT * FROM get_free_cars(%s, %s, %s, %s);"
+
+
+def seed(connection, cars, bookings_per_car):
+    slot = 365 // bookings_per_car
+    if slot < 12:
+        raise SystemExit("At most 30 bookings per car fit into a year without overlaps")
+
+    with connection.cursor() as cursor:
+        # Skips the per-row change notifications, nobody is listening
+        cursor.execute("SET app.bulk_import = 'on';")
+        cursor.execute(SEED_SQL, {
+            "cars": cars, "bookings": bookings_per_car, "slot": slot, "year_start": YEAR_START,
+        })
+    connection.commit()
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    connection.autocommit = False
+
+
+def random_window(generator):
+    start = YEAR_START + timedelta(days=generator.randrange(350))
+    return start, start + timedelta(days=generator.randint(1, 14))
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (
+        statistics.median(samples) * 1000,
+        samples[int(len(samples) * 0.95) - 1] * 1000,
+        samples[-1] * 1000,
+    )
+
+
+def time_searches(connection, cars, searches, page_size, deep):
+    generator = random.Random(42)
+    samples = []
+    returned = 0
+    with connection.cursor() as cursor:
+        for _ in range(searches):
+            start, end = random_window(generator)
+            after = generator.randrange(cars) if deep else None
+            started = time.perf_counter()
+            cursor.execute(SEARCH_SQL, (start, end, after, page_size))
+            returned += len(cursor.fetchall())
+            samples.append(time.perf_counter() - started)
+        connection.rollback()
+    return samples, returned / searches
+
+
+def print_plan(connection, page_size):
+    start, end = random_window(random.Random(7))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT prosrc FROM pg_proc WHERE proname = 'get_free_cars';")
+        source = cursor.fetchone()[0]
+        start_at = source.index("SELECT", source.index("RETURN QUERY"))
+        query = source[start_at:source.index(";", start_at)]
+        for name, value in (("after_car_id", "NULL::INT"), ("page_size", str(page_size)),
+                            ("requested_period", f"daterange('{start}', '{end}', '[)')")):
+            query = query.replace(name, value)
+
+        cursor.execute(f"EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF, SUMMARY OFF) {query}")
+        print(f"Plan for {start} - {end}:")
+        for (line,) in cursor.fetchall():
+            print(f"    {line}")
+    connection.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cars", type=int, default=100_000)
+    parser.add_argument("--bookings-per-car", type=int, default=12)
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    database = args.database or f"{os.getenv('PG_DB')}_availability_bench"
+    recreate_database(database)
+    try:
+        MigrationRunner(lambda: connect(database)).run()
+        connection = connect(database)
+        try:
+            started = time.perf_counter()
+            seed(connection, args.cars, args.bookings_per_car)
+            print(f"Seeded {args.cars:,} cars and {args.cars * args.bookings_per_car:,} bookings "
+                  f"in {time.perf_counter() - started:.1f} s")
+
+            for label, deep in (("first page", False), ("random cursor", True)):
+                samples, rows = time_searches(connection, args.cars, args.searches, args.page_size, deep)
+                p50, p95, worst = percentiles(samples)
+                print(f"{label:<14} p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  max {worst:7.2f} ms  {rows:5.1f} cars/page")
+
+            print_plan(connection, args.page_size)
+        finally:
+            connection.close()
+    finally:
+        if not args.keep:
+            drop_database(database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Cars/sec of POST /user/{id}/add_car one by one vs. POST /user/{id}/cars/bulk.
+
+Runs the app in-process against a scratch database next to PG_DB, which is
+created, migrated and dropped afterwards.
+
+Run from the repository root:
+    python -m benchmarks.bench_bulk_import --single 200 --bulk 20000 --format jsonl
+"""
+import os
+import io
+import csv
+import json
+import time
+import argparse
+from benchmarks.check_query_plans import recreate_database, drop_database
+
+
+TYPES = ["sedan", "SUV", "coupe", "hatchback", "minivan"]
+BRANDS = ["BMW", "Audi", "Toyota", "Volkswagen"]
+FUELS = ["diesel", "gasoline", "electric"]
+
+
+def registration_plate(index):
+    letters = index // 10000
+    return f"{index % 10000:04d} {chr(65 + letters % 26)}{chr(65 + letters // 26 % 26)}-{letters // 676 % 10}"
+
+
+def make_car(index):
+    return {
+        "type_name": TYPES[index % len(TYPES)],
+        "brand": BRANDS[index % len(BRANDS)],
+        "model": f"M{index % 50}",
+        "fuel_type": FUELS[index % len(FUELS)],
+        "registration_plate": registration_plate(index),
+        "price_per_day": 20 + index % 200,
+        "description": f"Fleet car {index}",
+        "images": [f"http://images.example.com/cars/{index}/{k}.jpg" for k in range(2)],
+    }
+
+
+def encode_jsonl(cars):
+    return "\n".join(json.dumps(car) for car in cars).encode(), "application/x-ndjson"
+
+
+def encode_csv(cars):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(cars[0]))
+    writer.writeheader()
+    for car in cars:
+        writer.writerow({**car, "images": "|".join(car["images"])})
+    return output.getvalue().encode(), "text/csv"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--single", type=int, default=200, help="cars added one request at a time")
+    parser.add_argument("--bulk", type=int, default=20_000, help="cars added in one bulk request")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--database", default=f"{os.getenv('PG_DB')}_bulk_bench")
+    args = parser.parse_args()
+
+    recreate_database(args.database)
+    maintenance_db, os.environ["PG_DB"] = os.environ.get("PG_DB"), args.database
+    os.environ.setdefault("APP_ENV", "development")
+    try:
+        # Imported late so the app connects to the scratch database
+        from fastapi.testclient import TestClient
+        from server.main import app
+
+        with TestClient(app) as client:
+            owner = client.post("/register", json={
+                "given_name": "Fleet", "surname": "Operator", "passport_no": "AB1234567",
+                "identification_no": "12345678901234", "license_no": "LIC0000001",
+                "telephone_no": "+375290000001", "email": "fleet@example.com",
+                "date_of_birth": "1980-01-01", "password": "fleet", "avatar_url": "string",
+            }).json()["id"]
+            token = client.put("/login", json={"email": "fleet@example.com", "password": "fleet"}).json()["token"]
+            auth = {"Authorization": f"Bearer {token}"}
+
+            started = time.perf_counter()
+            for index in range(args.single):
+                response = client.post(f"/user/{owner}/add_car", json=make_car(index), headers=auth)
+                assert response.status_code == 200, response.text
+            single_rate = args.single / (time.perf_counter() - started)
+
+            cars = [make_car(index) for index in range(args.single, args.single + args.bulk)]
+            body, content_type = (encode_jsonl if args.format == "jsonl" else encode_csv)(cars)
+            started = time.perf_counter()
+            response = client.post(f"/user/{owner}/cars/bulk", content=body, headers={**auth, "Content-Type": content_type})
+            bulk_elapsed = time.perf_counter() - started
+            result = response.json()
+            assert response.status_code == 200 and not result["errors"], response.text[:500]
+            bulk_rate = result["inserted"] / bulk_elapsed
+    finally:
+        os.environ["PG_DB"] = maintenance_db
+        drop_database(args.database)
+
+    print(f"add_car    {args.single:>8,} cars {single_rate:>10,.0f} cars/s")
+    print(f"bulk {args.format:<5} {result['inserted']:>8,} cars {bulk_rate:>10,.0f} cars/s ({bulk_elapsed:.2f} s)")
+    print(f"{bulk_rate / single_rate:.1f}x more cars per second")
+
+
+if __name__ == "__main__":
+    main()
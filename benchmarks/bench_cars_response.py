@@ -0,0 +1,97 @@
+"""Per-request CPU time and allocations of GET /cars, before and after the
+json.dumps/json.loads round trip was removed.
+
+Both apps serve the same pre-fetched rows, so only the Python side of the
+request (decoding, serialization, validation) is measured.
+
+Run from the repository root:
+    python -m benchmarks.bench_cars_response --cars 10000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from decimal import Decimal
+from typing import List
+from fastapi import FastAPI, Response
+from fastapi.testclient import TestClient
+from server.decoding import decode_rows, encode_json
+from server.models import Cars
+
+
+DESCRIPTION = [
+    ("car_id",), ("type_name",), ("brand",), ("model",),
+    ("fuel_type",), ("price_per_day",), ("main_image_url",),
+]
+
+
+def make_rows(count):
+    return [
+        (i, "sedan", "BMW", "X5", "diesel", Decimal(50 + i % 100), f"http://images.example.com/cars/{i}/main.jpg")
+        for i in range(count)
+    ]
+
+
+def build_legacy_app(rows):
+    app = FastAPI()
+
+    def get_available_cars():
+        cars = decode_rows(DESCRIPTION, rows, Cars)
+        return json.dumps([car.model_dump(mode="json") for car in cars], indent=2)
+
+    @app.get("/cars", response_model=List[Cars])
+    def get_cars():
+        data_dict = json.loads(get_available_cars())
+        return [Cars(**car_data) for car_data in data_dict]
+
+    return app
+
+
+def build_fast_app(rows):
+    app = FastAPI()
+
+    def get_available_cars():
+        return decode_rows(DESCRIPTION, rows, Cars)
+
+    @app.get("/cars", response_model=List[Cars])
+    def get_cars():
+        return Response(content=encode_json(get_available_cars(), List[Cars]), media_type="application/json")
+
+    return app
+
+
+def measure(name, app, requests):
+    client = TestClient(app)
+    body = client.get("/cars").content
+
+    started = time.process_time()
+    for _ in range(requests):
+        client.get("/cars")
+    cpu = (time.process_time() - started) / requests
+
+    tracemalloc.start()
+    client.get("/cars")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<10} {cpu * 1000:8.1f} ms CPU/request {peak / 2**20:8.1f} MiB peak {len(body) / 2**10:8.0f} KiB body")
+    return cpu, peak, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cars", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.cars)
+    print(f"GET /cars with {args.cars:,} cars, {args.requests} requests")
+    legacy_cpu, legacy_peak, legacy_body = measure("legacy", build_legacy_app(rows), args.requests)
+    fast_cpu, fast_peak, fast_body = measure("fast", build_fast_app(rows), args.requests)
+
+    assert json.loads(legacy_body) == json.loads(fast_body)
+    print(f"CPU {legacy_cpu / fast_cpu:.2f}x less, peak allocations {legacy_peak / fast_peak:.2f}x less")
+
+
+if __name__ == "__main__":
+    main()
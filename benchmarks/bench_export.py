@@ -0,0 +1,156 @@
+"""Server memory while streaming the whole catalogue from GET /cars/export.
+
+Creates a scratch database next to PG_DB, applies the migrations and seeds
+it with cars, then starts the sync app with uvicorn in a subprocess and
+reads the export while sampling the server's RSS. The app has to run in its
+own process: the test client collects the whole body before returning it.
+Exits with status 1 if the RSS keeps growing once the export is under way.
+The scratch database is dropped afterwards. Linux only, RSS is read from
+/proc.
+
+Run from the repository root:
+    python -m benchmarks.bench_export --cars 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import urllib.request
+from urllib.error import URLError
+from server.migrations import MigrationRunner
+from benchmarks.check_query_plans import connect, recreate_database, drop_database
+
+
+SEED_SQL = """
+    INSERT INTO users (given_name, surname, passport_no, identification_no, license_no, telephone_no, email, date_of_birth, password)
+    SELECT 'U'||g, 'S', lpad(g::text, 9, '0'), lpad(g::text, 14, '0'), lpad(g::text, 10, '0'),
+           '+375'||lpad(g::text, 9, '0'), 'u'||g||'@mail.com', '1990-01-01', 'pw'||g
+    FROM generate_series(1, 1000) g;
+
+    INSERT INTO car_types (type_name) SELECT unnest(enum_range(NULL::CAR_TYPE));
+    INSERT INTO fuel_types (type_name) SELECT unnest(enum_range(NULL::FUEL_TYPE));
+    INSERT INTO brands (name, model) SELECT b, 'M'||m FROM unnest(enum_range(NULL::CAR_BRAND)) b, generate_series(1, 20) m;
+
+    INSERT INTO cars (owner_id, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description)
+    SELECT 1 + g %% 1000, 1 + g %% 9, 1 + (g * 7) %% 600, 1 + g %% 4,
+           lpad((g %% 10000)::text, 4, '0')||' '||chr(65 + (g / 10000) %% 26)||chr(65 + (g / 260000) %% 26)||'-'||(g %% 7),
+           10 + g %% 300, 'car '||g
+    FROM generate_series(1, %(cars)s) g;
+
+    INSERT INTO car_images (car_id, url) SELECT id, 'http://img/'||id||'/main.jpg' FROM cars;
+"""
+
+READ_SIZE = 64 * 1024
+
+
+def seed(connection, cars):
+    with connection.cursor() as cursor:
+        # Skips the per-row change notifications, nobody is listening
+        cursor.execute("SET app.bulk_import = 'on';")
+        cursor.execute(SEED_SQL, {"cars": cars})
+    connection.commit()
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    connection.autocommit = False
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError(f"No VmRSS for process {pid}")
+
+
+def wait_until_ready(server, url, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited with status {server.returncode}")
+        try:
+            with urllib.request.urlopen(url) as response:
+                response.read()
+                return
+        except (URLError, ConnectionError):
+            time.sleep(0.2)
+    raise SystemExit(f"Server did not answer {url} within {timeout} seconds")
+
+
+def export(server, base_url, max_chunks=None):
+    # (rows read, RSS) once every READ_SIZE bytes
+    samples = []
+    rows = 0
+    with urllib.request.urlopen(f"{base_url}/cars/export") as response:
+        while max_chunks is None or len(samples) < max_chunks:
+            chunk = response.read(READ_SIZE)
+            if not chunk:
+                break
+            rows += chunk.count(b"\n")
+            samples.append((rows, rss_mb(server.pid)))
+    return rows, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cars", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=1000, help="EXPORT_BATCH_SIZE of the server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-growth-mb", type=float, default=20.0,
+                        help="allowed RSS growth after the first tenth of the export")
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    database = args.database or f"{os.getenv('PG_DB')}_export_bench"
+    recreate_database(database)
+    server = None
+    try:
+        MigrationRunner(lambda: connect(database)).run()
+        connection = connect(database)
+        try:
+            started = time.perf_counter()
+            seed(connection, args.cars)
+            print(f"Seeded {args.cars:,} cars in {time.perf_counter() - started:.1f} s")
+        finally:
+            connection.close()
+
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server.main:app", "--port", str(args.port), "--log-level", "warning"],
+            env={**os.environ, "PG_DB": database, "EXPORT_BATCH_SIZE": str(args.batch_size), "APP_ENV": "development"},
+        )
+        base_url = f"http://127.0.0.1:{args.port}"
+        wait_until_ready(server, f"{base_url}/metrics")
+        # Warms up the pool and the type adapters, and leaves the export halfway like a client that gives up
+        export(server, base_url, max_chunks=16)
+        baseline = rss_mb(server.pid)
+
+        started = time.perf_counter()
+        rows, samples = export(server, base_url)
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if not args.keep:
+            drop_database(database)
+
+    print(f"Exported {rows:,} cars in {elapsed:.1f} s ({rows / elapsed:,.0f} cars/s), server RSS before {baseline:.1f} MB")
+    for tenth in range(1, 11):
+        row_target = rows * tenth // 10
+        _, rss = next(sample for sample in samples if sample[0] >= row_target)
+        print(f"    {tenth * 10:>3}% {row_target:>10,} cars  RSS {rss:7.1f} MB")
+
+    settled = next(rss for sampled_rows, rss in samples if sampled_rows >= rows // 10)
+    peak = max(rss for _, rss in samples)
+    print(f"Peak RSS {peak:.1f} MB, growth after the first tenth {peak - settled:+.1f} MB")
+    if rows != args.cars:
+        raise SystemExit(f"Expected {args.cars:,} cars, got {rows:,}")
+    if peak - settled > args.max_growth_mb:
+        raise SystemExit(f"Server RSS grew by more than {args.max_growth_mb} MB during the export")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Parse and plan savings of prepared statements for the ten busiest endpoints.
+
+Creates a scratch database next to PG_DB, applies the migrations and seeds
+it like check_query_plans. Then calls the statement behind each endpoint
+through DatabaseHandler, alternating raw_sql, which sends the text to be
+parsed and planned every time, with prepared_sql, which executes the
+statement prepared on the connection. Exits with status 1 if a prepared read
+returns other rows than the same text sent through raw_sql. The scratch
+database is dropped afterwards.
+
+Run from the repository root:
+    python -m benchmarks.bench_prepared --cars 100000
+"""
+import os
+import time
+import argparse
+import datetime
+import statistics
+from server.db import DatabaseHandler
+from benchmarks.check_query_plans import connect, recreate_database, drop_database, seed
+
+
+# (endpoint, statement name, query, parameters of the i-th call, whether it writes)
+# Writes get parameters that never collide, every call of make_rent books another car or week
+def statements(cars, users):
+    far_future = datetime.date.today() + datetime.timedelta(days=3650)
+    available = cars - cars // 10
+
+    def available_car(i):
+        # The i-th of the cars, every tenth one is seeded unavailable
+        k = i % available
+        return k + k // 9 + 1
+
+    def booking(i):
+        car_id = available_car(i)
+        start = far_future + datetime.timedelta(days=7 * (i // available))
+        # Car g is owned by user 1 + g % users, who cannot rent it
+        return (1 + (car_id + 1) % users, car_id, "A", "B", start, start + datetime.timedelta(days=3))
+
+    return [
+        ("GET /cars", "get_available_cars",
+         "SELECT * FROM get_available_cars(%s, %s, %s, %s, %s, %s, %s);",
+         lambda i: (None if i % 2 else i % cars, 51, None, None, None, None, None), False),
+        ("GET /cars/{car_id}", "get_available_car",
+         "SELECT * FROM get_available_car(%s);",
+         lambda i: (available_car(i),), False),
+        ("GET /cars/available", "get_free_cars",
+         "SELECT * FROM get_free_cars(%s, %s, %s, %s);",
+         lambda i: (datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 365),
+                    datetime.date(2024, 1, 4) + datetime.timedelta(days=i % 365), None, 51), False),
+        ("GET /cars/search", "search_cars",
+         "SELECT * FROM search_cars(%s, %s);",
+         lambda i: (("car", "bmw m1", "toyta", "audi")[i % 4], 21), False),
+        ("GET /cars/{car_id}/get_reviews", "get_reviews",
+         "SELECT * FROM get_reviews(%s, %s, %s);",
+         lambda i: (1 + i % cars, None, 51), False),
+        ("GET /user/{user_id}/profile", "user_profile",
+         "SELECT * FROM user_profile(%s);",
+         lambda i: (1 + i % users,), False),
+        ("GET /user/{user_id}/get_favourites", "get_favourites",
+         "SELECT * FROM get_favourites(%s);",
+         lambda i: (1 + i % users,), False),
+        ("session check", "user_session",
+         "SELECT status, role_id, session_generation FROM users WHERE id = %s;",
+         lambda i: (1 + i % users,), False),
+        ("POST /user/{user_id}/cars/{car_id}/make_review", "make_review",
+         "SELECT make_review(%s, %s, %s) AS id;",
+         lambda i: (1 + i % users, 1 + i % cars, "bench review"), True),
+        ("POST /user/{user_id}/cars/{car_id}/make_rent", "make_rent",
+         "SELECT make_rent(%s, %s, %s, %s, %s, %s);",
+         booking, True),
+    ]
+
+
+def timed_call(call, *args):
+    started = time.perf_counter()
+    cursor = call(*args)
+    rows = cursor.fetchall()
+    return time.perf_counter() - started, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cars", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=1000, help="calls of every statement, each way")
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    database = args.database or f"{os.getenv('PG_DB')}_prepared_bench"
+    recreate_database(database)
+    mismatched = []
+    try:
+        connection = connect(database)
+        db_handler = DatabaseHandler(
+            db_name=database,
+            db_user=os.getenv("PG_USER"),
+            db_password=os.getenv("PG_PASSWORD"),
+            db_host=os.getenv("PG_HOST"),
+            db_port=os.getenv("PG_PORT"),
+            pool_min_size=1,
+            pool_max_size=1,
+        )
+        try:
+            started = time.perf_counter()
+            seed(connection, args.cars)
+            print(f"Seeded {args.cars:,} cars in {time.perf_counter() - started:.1f} s")
+
+            users = max(args.cars // 10, 1)
+            print(f"{'endpoint':<48} {'raw_sql p50':>12} {'prepared p50':>13} {'saved':>9}")
+            with db_handler.transaction():
+                for endpoint, name, query, params, writes in statements(args.cars, users):
+                    plain, prepared = [], []
+                    for i in range(args.repeat):
+                        # Writes never repeat their parameters, reads run the same ones both ways
+                        elapsed, plain_rows = timed_call(db_handler.raw_sql, query, params(2 * i))
+                        plain.append(elapsed)
+                        elapsed, prepared_rows = timed_call(
+                            db_handler.prepared_sql, name, query, params(2 * i + 1 if writes else 2 * i)
+                        )
+                        prepared.append(elapsed)
+                        if not writes and plain_rows != prepared_rows and endpoint not in mismatched:
+                            mismatched.append(endpoint)
+
+                    plain_p50 = statistics.median(plain) * 1000
+                    prepared_p50 = statistics.median(prepared) * 1000
+                    print(f"{endpoint:<48} {plain_p50:9.3f} ms {prepared_p50:10.3f} ms "
+                          f"{(plain_p50 - prepared_p50) * 1000:6.0f} us")
+        finally:
+            db_handler.close()
+            connection.close()
+    finally:
+        if not args.keep:
+            drop_database(database)
+
+    if mismatched:
+        raise SystemExit(f"prepared statements returned other rows for: {', '.join(mismatched)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Rows/sec of the composite-text parsers vs. typed column decoding.
+
+Run from the repository root:
+    python -m benchmarks.bench_row_decoding --rows 100000
+"""
+import argparse
+import time
+from decimal import Decimal
+from server.decoding import decode_rows
+from server.models import Cars, CurrentCar
+
+
+CARS_DESCRIPTION = [
+    ("car_id",), ("type_name",), ("brand",), ("model",),
+    ("fuel_type",), ("price_per_day",), ("main_image_url",),
+]
+
+CAR_DESCRIPTION = [
+    ("type_name",), ("brand",), ("model",), ("fuel_type",),
+    ("registration_plate",), ("price_per_day",), ("description",),
+    ("images",), ("given_name",), ("telephone_no",),
+]
+
+
+def legacy_parse_cars(data):
+    parsed_data = []
+    for item in data:
+        item_data = item[0].strip('()').split(',')
+        parsed_data.append({
+            'car_id': int(item_data[0]),
+            'type_name': item_data[1],
+            'brand': item_data[2],
+            'model': item_data[3],
+            'fuel_type': item_data[4],
+            'price_per_day': float(item_data[5]),
+            'main_image_url': item_data[6]
+        })
+    return [Cars(**car_data) for car_data in parsed_data]
+
+
+def legacy_parse_car(data_string):
+    data_string = data_string[1:-1]
+
+    split_data = []
+    current = ''
+    quoted = False
+
+    for char in data_string:
+        if char == ',' and not quoted:
+            split_data.append(current)
+            current = ''
+        elif char == '"':
+            quoted = not quoted
+            current += char
+        else:
+            current += char
+
+    split_data.append(current)
+    split_data = [item.replace('"', '') for item in split_data]
+
+    return CurrentCar(**{
+        "type_name": split_data[0],
+        "brand": split_data[1],
+        "model": split_data[2],
+        "fuel_type": split_data[3],
+        "registration_plate": split_data[4],
+        "price_per_day": float(split_data[5]),
+        "description": split_data[6],
+        "images": split_data[7][1:-1].split(','),
+        "given_name": split_data[8],
+        "telephone_no": split_data[9]
+    })
+
+
+def make_cars_rows(count):
+    text_rows = [
+        (f"({i},sedan,BMW,X5,diesel,{50 + i % 100},http://images.example.com/cars/{i}/main.jpg)",)
+        for i in range(count)
+    ]
+    typed_rows = [
+        (i, "sedan", "BMW", "X5", "diesel", Decimal(50 + i % 100), f"http://images.example.com/cars/{i}/main.jpg")
+        for i in range(count)
+    ]
+    return text_rows, typed_rows
+
+
+def make_car_rows(count):
+    text_rows = [
+        f'(sedan,BMW,X5,diesel,"1234 AB-1",{50 + i % 100},"A quiet car with a big trunk",'
+        f'"{{http://images.example.com/{i}/1.jpg,http://images.example.com/{i}/2.jpg}}",Ann,+375290000000)'
+        for i in range(count)
+    ]
+    typed_rows = [
+        (
+            "sedan", "BMW", "X5", "diesel", "1234 AB-1", Decimal(50 + i % 100),
+            "A quiet car with a big trunk",
+            [f"http://images.example.com/{i}/1.jpg", f"http://images.example.com/{i}/2.jpg"],
+            "Ann", "+375290000000",
+        )
+        for i in range(count)
+    ]
+    return text_rows, typed_rows
+
+
+def measure(name, count, func):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {elapsed:8.3f} s {count / elapsed:>12,.0f} rows/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    cars_text, cars_typed = make_cars_rows(args.rows)
+    car_text, car_typed = make_car_rows(args.rows)
+
+    print(f"{args.rows:,} rows per result set")
+    legacy = measure("get_available_cars: split(',')", args.rows, lambda: legacy_parse_cars(cars_text))
+    typed = measure("get_available_cars: decode_rows", args.rows, lambda: decode_rows(CARS_DESCRIPTION, cars_typed, Cars))
+    print(f"{'speedup':<40} {legacy / typed:8.2f}x")
+
+    legacy = measure("get_available_car: char loop", args.rows, lambda: [legacy_parse_car(row) for row in car_text])
+    typed = measure("get_available_car: decode_rows", args.rows, lambda: decode_rows(CAR_DESCRIPTION, car_typed, CurrentCar))
+    print(f"{'speedup':<40} {legacy / typed:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
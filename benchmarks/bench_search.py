@@ -0,0 +1,148 @@
+"""Latency of the car search, search_cars, at a million cars.
+
+Creates a scratch database next to PG_DB, applies the migrations and seeds
+it with cars whose descriptions are drawn from a skewed vocabulary, so some
+words match a large share of the fleet and some only a handful of cars.
+Then times a mix of exact, prefix, misspelled and multi-word queries and
+exits with status 1 if any p95 exceeds --max-ms. The scratch database is
+dropped afterwards.
+
+Run from the repository root:
+    python -m benchmarks.bench_search --cars 1000000
+"""
+import os
+import time
+import argparse
+import statistics
+from server.migrations import MigrationRunner
+from benchmarks.check_query_plans import connect, recreate_database, drop_database
+
+
+MODELS = [
+    "Camry", "Corolla", "RAV4", "Golf", "Passat", "Tiguan", "Focus", "Fiesta", "Mustang", "Camaro",
+    "Malibu", "Altima", "Qashqai", "Civic", "Accord", "X5", "M3", "GLE", "A4", "Q7",
+]
+
+# Earlier words are picked far more often
+VOCABULARY = [
+    "clean", "reliable", "comfortable", "automatic", "manual", "spacious", "economical", "family",
+    "leather", "seats", "heated", "sunroof", "navigation", "camera", "bluetooth", "cruise", "control",
+    "panoramic", "roof", "alloy", "wheels", "tinted", "windows", "parking", "sensors", "keyless",
+    "entry", "premium", "sound", "system", "towbar", "roofrack", "winter", "tyres", "child", "seat",
+    "isofix", "ventilated", "massage", "headup", "display", "adaptive", "headlights", "matrix", "xenon",
+    "convertible", "hardtop", "sport", "package", "chrome", "trim", "ceramic", "brakes", "carbon",
+    "spoiler", "pristine", "vintage", "collector", "rare", "limited", "edition", "signed", "dashboard",
+]
+
+SEED_SQL = """
+    SELECT setseed(0.42);
+
+    INSERT INTO users (given_name, surname, passport_no, identification_no, license_no, telephone_no, email, date_of_birth, password)
+    SELECT 'U'||g, 'S', lpad(g::text, 9, '0'), lpad(g::text, 14, '0'), lpad(g::text, 10, '0'),
+           '+375'||lpad(g::text, 9, '0'), 'u'||g||'@mail.com', '1990-01-01', 'pw'||g
+    FROM generate_series(1, 1000) g;
+
+    INSERT INTO car_types (type_name) SELECT unnest(enum_range(NULL::CAR_TYPE));
+    INSERT INTO fuel_types (type_name) SELECT unnest(enum_range(NULL::FUEL_TYPE));
+    INSERT INTO brands (name, model) SELECT b, m FROM unnest(enum_range(NULL::CAR_BRAND)) b, unnest(%(models)s::text[]) m;
+
+    -- The search vector is filled by cars_search_vector_trigger, as for add_car
+    INSERT INTO cars (owner_id, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description)
+    SELECT 1 + g %% 1000, 1 + g %% 9, 1 + (g * 7) %% 600, 1 + g %% 4,
+           lpad((g %% 10000)::text, 4, '0')||' '||chr(65 + (g / 10000) %% 26)||chr(65 + (g / 260000) %% 26)||'-'||(g %% 7),
+           10 + g %% 300,
+           (SELECT string_agg((%(vocabulary)s::text[])[1 + floor(%(vocabulary_size)s * power(random(), 3))::int], ' ')
+            FROM generate_series(1, 6 + g %% 7) word WHERE g > 0)
+    FROM generate_series(1, %(cars)s) g;
+
+    INSERT INTO car_images (car_id, url) SELECT id, 'http://img/'||id||'/main.jpg' FROM cars;
+"""
+
+QUERIES = [
+    "camry", "camyr", "cam", "toyota", "toyta", "toyota corolla", "bmw x5", "mercedes-benz gle",
+    "leather", "heated seats", "panoramic sunroof", "vintage collector", "dashboard",
+    "audi leather sunroof", "signed limited edition", "zzzz",
+]
+
+SEARCH_SQL = "SELECT * FROM search_cars(%s, %s);"
+
+
+def seed(connection, cars):
+    with connection.cursor() as cursor:
+        # Skips the per-row change notifications, nobody is listening
+        cursor.execute("SET app.bulk_import = 'on';")
+        cursor.execute(SEED_SQL, {
+            "cars": cars, "models": MODELS, "vocabulary": VOCABULARY, "vocabulary_size": len(VOCABULARY),
+        })
+    connection.commit()
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    connection.autocommit = False
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (
+        statistics.median(samples) * 1000,
+        samples[max(int(len(samples) * 0.95) - 1, 0)] * 1000,
+        samples[-1] * 1000,
+    )
+
+
+def matching_cars(cursor, query):
+    cursor.execute(
+        "SELECT count(*) FROM cars WHERE is_available AND search_vector @@ plainto_tsquery('simple', %s);", (query,)
+    )
+    return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cars", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=30, help="runs of every query")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, default=20.0, help="allowed p95 of every query")
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    database = args.database or f"{os.getenv('PG_DB')}_search_bench"
+    recreate_database(database)
+    slow = []
+    try:
+        MigrationRunner(lambda: connect(database)).run()
+        connection = connect(database)
+        try:
+            started = time.perf_counter()
+            seed(connection, args.cars)
+            print(f"Seeded {args.cars:,} cars in {time.perf_counter() - started:.1f} s")
+
+            with connection.cursor() as cursor:
+                for query in QUERIES:
+                    samples = []
+                    for _ in range(args.repeat):
+                        started = time.perf_counter()
+                        cursor.execute(SEARCH_SQL, (query, args.page_size))
+                        rows = len(cursor.fetchall())
+                        samples.append(time.perf_counter() - started)
+
+                    p50, p95, worst = percentiles(samples)
+                    print(f"{query!r:<28} {matching_cars(cursor, query):>9,} exact matches  {rows:>3} rows  "
+                          f"p50 {p50:6.2f} ms  p95 {p95:6.2f} ms  max {worst:6.2f} ms")
+                    if p95 > args.max_ms:
+                        slow.append(query)
+            connection.rollback()
+        finally:
+            connection.close()
+    finally:
+        if not args.keep:
+            drop_database(database)
+
+    if slow:
+        raise SystemExit(f"p95 above {args.max_ms} ms for: {', '.join(slow)}")
+
+
+if __name__ == "__main__":
+    main()
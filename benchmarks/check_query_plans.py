@@ -0,0 +1,314 @@
+"""Query-plan regression check for the stored functions.
+
+Creates a scratch database next to PG_DB, applies the migrations, seeds it
+with a large dataset and EXPLAINs the statements the stored functions run,
+plus the lookup every foreign key cascade does on the referencing table.
+Statements inside plpgsql functions are cached as generic plans, so they are
+explained the same way. Exits with status 1 if any of them sequentially
+scans a large table.
+
+Run from the repository root:
+    python -m benchmarks.check_query_plans --cars 200000
+"""
+import os
+import sys
+import argparse
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from server.migrations import MigrationRunner
+
+
+LARGE_TABLES = {
+    "users", "cars", "car_images", "reviews", "car_review_stats", "favorite_cars", "car_rental_stats",
+    "rental_deals", "pick_up_location", "payments", "taxes", "user_logs",
+}
+
+# Roles are never deleted and the column changes on every login and logout
+UNINDEXED_FOREIGN_KEYS = {("users", "role_id"), ("admin", "role_id")}
+
+
+SEED_SQL = """
+    INSERT INTO users (given_name, surname, passport_no, identification_no, license_no, telephone_no, email, date_of_birth, password)
+    SELECT 'U'||g, 'S', lpad(g::text, 9, '0'), lpad(g::text, 14, '0'), lpad(g::text, 10, '0'),
+           '+375'||lpad(g::text, 9, '0'), 'u'||g||'@mail.com', '1990-01-01', 'pw'||g
+    FROM generate_series(1, %(users)s) g;
+
+    INSERT INTO car_types (type_name) SELECT unnest(enum_range(NULL::CAR_TYPE));
+    INSERT INTO fuel_types (type_name) SELECT unnest(enum_range(NULL::FUEL_TYPE));
+    INSERT INTO brands (name, model) SELECT b, 'M'||m FROM unnest(enum_range(NULL::CAR_BRAND)) b, generate_series(1, 20) m;
+
+    INSERT INTO cars (owner_id, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description, is_available)
+    SELECT 1 + g %% %(users)s, 1 + g %% 9, 1 + (g * 7) %% 600, 1 + g %% 4,
+           lpad((g %% 10000)::text, 4, '0')||' '||chr(65 + (g / 10000) %% 26)||chr(65 + (g / 260000) %% 26)||'-'||(g %% 7),
+           10 + g %% 300, 'car '||g, g %% 10 <> 0
+    FROM generate_series(1, %(cars)s) g;
+
+    INSERT INTO car_images (car_id, url) SELECT id, 'http://img/'||id||'/'||k||'.jpg' FROM cars, generate_series(1, 2) k;
+    INSERT INTO reviews (car_id, user_id, message, created_at)
+    SELECT 1 + g %% %(cars)s, 1 + g %% %(users)s, 'review '||g, NOW() FROM generate_series(1, %(cars)s) g;
+    INSERT INTO car_review_stats (car_id, review_count, last_review_at)
+    SELECT car_id, COUNT(*), MAX(created_at) FROM reviews GROUP BY car_id;
+    INSERT INTO favorite_cars (user_id, car_id) SELECT 1 + g %% %(users)s, 1 + (g * 13) %% %(cars)s FROM generate_series(1, %(cars)s) g;
+
+    INSERT INTO pick_up_location (start_location, end_location) SELECT 'A'||g, 'B'||g FROM generate_series(1, %(deals)s) g;
+    INSERT INTO rental_deals (user_id, car_id, pick_up_id, start_date, end_date, total_price)
+    SELECT 1 + g %% %(users)s, 1 + (g * 31) %% %(cars)s, g, DATE '2024-01-01' + g %% 365, DATE '2024-01-03' + g %% 365, 100
+    FROM generate_series(1, %(deals)s) g;
+    INSERT INTO payments (user_id, payed_price, time) SELECT user_id, total_price, NOW() FROM rental_deals;
+    INSERT INTO taxes (rental_deal_id, price) SELECT id, total_price * 0.13 FROM rental_deals;
+    INSERT INTO user_logs (user_id, message, time) SELECT user_id, 'rent', NOW() FROM rental_deals;
+"""
+
+
+LISTING_QUERY = """
+    SELECT cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name, cars.price_per_day,
+           (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+           COALESCE(car_review_stats.review_count, 0)
+    FROM cars
+    JOIN car_types ON cars.car_type_id = car_types.id
+    JOIN brands ON cars.brand_id = brands.id
+    JOIN fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE cars.is_available = TRUE {filters}
+    ORDER BY cars.id LIMIT 50
+"""
+
+# (function, statement, parameter types) mirroring the function bodies.
+# get_available_cars builds its query dynamically, so it is planned with
+# the actual values and is explained with literals instead of parameters.
+FUNCTION_STATEMENTS = [
+    ("check_user_status", "SELECT status FROM users WHERE id = $1", ["INT"]),
+    ("check_car", "SELECT EXISTS(SELECT 1 FROM cars WHERE id = $1)", ["INT"]),
+    ("user_profile", """
+        SELECT users.given_name, roles.name FROM users LEFT JOIN roles ON users.role_id = roles.id WHERE users.id = $1
+    """, ["INT"]),
+    ("user_login", "SELECT status FROM users WHERE email = $1", ["VARCHAR"]),
+    ("create_brand", "SELECT id FROM brands WHERE name = $1 AND model = $2 LIMIT 1", ["CAR_BRAND", "VARCHAR"]),
+    ("delete_car_type", "SELECT COUNT(*) FROM cars WHERE car_type_id = $1", ["INT"]),
+    ("delete_brand", "SELECT COUNT(*) FROM cars WHERE brand_id = $1", ["INT"]),
+    ("delete_fuel_type", "SELECT COUNT(*) FROM cars WHERE fuel_type_id = $1", ["INT"]),
+    ("delete_car", "DELETE FROM car_images WHERE car_id = $1", ["INT"]),
+    ("update_user_status_false", "SELECT COUNT(*) FROM cars WHERE owner_id = $1", ["INT"]),
+    ("get_available_cars", LISTING_QUERY.format(filters=""), []),
+    ("get_available_cars", LISTING_QUERY.format(filters="AND cars.id > 150000"), []),
+    ("get_available_cars", LISTING_QUERY.format(filters="AND brands.name = 'BMW'"), []),
+    ("get_available_cars", LISTING_QUERY.format(filters="AND cars.price_per_day >= 100 AND cars.price_per_day <= 120"), []),
+    ("get_free_cars", """
+        SELECT cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name, cars.price_per_day,
+               (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+               COALESCE(car_review_stats.review_count, 0)
+        FROM cars
+        JOIN car_types ON cars.car_type_id = car_types.id
+        JOIN brands ON cars.brand_id = brands.id
+        JOIN fuel_types ON cars.fuel_type_id = fuel_types.id
+        LEFT JOIN car_review_stats ON car_review_stats.car_id = cars.id
+        WHERE cars.is_available = TRUE
+          AND cars.id > COALESCE($1, 0)
+          AND NOT EXISTS (
+              SELECT 1 FROM rental_deals
+              WHERE int4range(rental_deals.car_id, rental_deals.car_id, '[]') && int4range(cars.id, cars.id, '[]')
+                AND rental_deals.period && $2
+                AND rental_deals.status = 'active'
+                AND rental_deals.car_id IS NOT NULL
+          )
+        ORDER BY cars.id
+        LIMIT $3
+    """, ["INT", "DATERANGE", "INT"]),
+    ("get_available_car", """
+        SELECT car_types.type_name, brands.name, brands.model, fuel_types.type_name,
+               cars.registration_plate, cars.price_per_day, cars.description,
+               ARRAY(SELECT url FROM car_images WHERE car_images.car_id = cars.id),
+               users.given_name, users.telephone_no
+        FROM cars
+        JOIN car_types ON cars.car_type_id = car_types.id
+        JOIN brands ON cars.brand_id = brands.id
+        JOIN fuel_types ON cars.fuel_type_id = fuel_types.id
+        JOIN users ON cars.owner_id = users.id
+        WHERE cars.id = $1 AND cars.is_available = TRUE
+    """, ["INT"]),
+    ("get_cars_by_ids", """
+        SELECT cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name,
+               cars.registration_plate, cars.price_per_day, cars.description, car_image_urls.urls,
+               users.given_name, users.telephone_no
+        FROM (SELECT requested.id, min(requested.position) AS position
+              FROM unnest($1) WITH ORDINALITY AS requested(id, position)
+              GROUP BY requested.id) AS requested_cars
+        JOIN cars ON cars.id = requested_cars.id
+        JOIN car_types ON cars.car_type_id = car_types.id
+        JOIN brands ON cars.brand_id = brands.id
+        JOIN fuel_types ON cars.fuel_type_id = fuel_types.id
+        JOIN users ON cars.owner_id = users.id
+        LEFT JOIN (SELECT car_images.car_id, array_agg(car_images.url ORDER BY car_images.id) AS urls
+                   FROM car_images WHERE car_images.car_id = ANY($1)
+                   GROUP BY car_images.car_id) AS car_image_urls ON car_image_urls.car_id = cars.id
+        WHERE cars.is_available = TRUE
+        ORDER BY requested_cars.position
+    """, ["INT[]"]),
+    ("get_reviews", """
+        SELECT reviews.id, reviews.user_id, users.given_name, reviews.message, reviews.created_at
+        FROM reviews LEFT JOIN users ON reviews.user_id = users.id
+        WHERE reviews.car_id = $1 AND ($2 IS NULL OR reviews.id < $2)
+        ORDER BY reviews.id DESC
+        LIMIT $3
+    """, ["INT", "INT", "INT"]),
+    ("add_rental_stats", "SELECT owner_id FROM cars WHERE id = $1", ["INT"]),
+    ("update_rental_stats", "SELECT SUM(taxes.price) FROM taxes WHERE taxes.rental_deal_id = $1", ["INT"]),
+    ("update_tax_stats", "SELECT car_id FROM rental_deals WHERE id = $1 AND status = 'active'", ["INT"]),
+    ("get_owner_analytics", "SELECT COUNT(*) FROM cars WHERE owner_id = $1", ["INT"]),
+    ("get_car_analytics", """
+        SELECT cars.id, brands.name, brands.model, stats.deal_count, stats.revenue
+        FROM cars
+        JOIN brands ON cars.brand_id = brands.id
+        LEFT JOIN car_rental_stats stats ON stats.car_id = cars.id
+        WHERE cars.owner_id = $1
+        ORDER BY cars.id
+    """, ["INT"]),
+    ("get_favourites_version", """
+        SELECT md5(string_agg(favorite_cars.car_id || ':' || cars.version || ':' || COALESCE(stats.version, 0), ','))
+        FROM favorite_cars
+        JOIN cars ON cars.id = favorite_cars.car_id
+        LEFT JOIN car_review_stats stats ON stats.car_id = cars.id
+        WHERE favorite_cars.user_id = $1
+    """, ["INT"]),
+    ("get_favourites", """
+        SELECT cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name, cars.price_per_day,
+               (SELECT url FROM car_images WHERE car_images.car_id = cars.id LIMIT 1),
+               COALESCE(car_review_stats.review_count, 0)
+        FROM cars
+        JOIN car_types ON cars.car_type_id = car_types.id
+        JOIN brands ON cars.brand_id = brands.id
+        JOIN fuel_types ON cars.fuel_type_id = fuel_types.id
+        LEFT JOIN car_review_stats ON car_review_stats.car_id = cars.id
+        WHERE cars.id IN (SELECT favorite_cars.car_id FROM favorite_cars WHERE favorite_cars.user_id = $1)
+          AND cars.is_available = TRUE
+    """, ["INT"]),
+]
+
+
+def connect(db_name):
+    return psycopg2.connect(
+        database=db_name,
+        user=os.getenv("PG_USER"),
+        password=os.getenv("PG_PASSWORD"),
+        host=os.getenv("PG_HOST"),
+        port=os.getenv("PG_PORT"),
+    )
+
+
+def recreate_database(db_name):
+    connection = connect(os.getenv("PG_DB"))
+    connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {db_name};")
+        cursor.execute(f"CREATE DATABASE {db_name} ENCODING 'UTF8' TEMPLATE template0;")
+    connection.close()
+
+
+def drop_database(db_name):
+    connection = connect(os.getenv("PG_DB"))
+    connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {db_name};")
+    connection.close()
+
+
+def seed(connection, cars):
+    with connection.cursor() as cursor:
+        cursor.execute(SEED_SQL, {"cars": cars, "users": max(cars // 10, 1), "deals": max(cars // 2, 1)})
+    connection.commit()
+
+    connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+
+
+def foreign_key_statements(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+        """
+            SELECT conrelid::regclass::text, attribute.attname, format_type(attribute.atttypid, attribute.atttypmod)
+            FROM pg_constraint
+            JOIN pg_attribute attribute ON attribute.attrelid = conrelid AND attribute.attnum = conkey[1]
+            WHERE contype = 'f' AND array_length(conkey, 1) = 1
+            ORDER BY 1, 2;
+        """
+        )
+        foreign_keys = cursor.fetchall()
+
+    return [
+        (f"fk {table}.{column}", f"SELECT 1 FROM ONLY {table} WHERE {column} = $1 FOR KEY SHARE", [column_type])
+        for table, column, column_type in foreign_keys
+        if (table, column) not in UNINDEXED_FOREIGN_KEYS
+    ]
+
+
+def sequential_scans(plan):
+    scans = []
+    if plan["Node Type"] == "Seq Scan" and plan["Relation Name"] in LARGE_TABLES:
+        scans.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans.extend(sequential_scans(child))
+    return scans
+
+
+def explain(cursor, statement, parameter_types):
+    if not parameter_types:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}")
+        return cursor.fetchone()[0][0]["Plan"]
+
+    # The generic plan does not depend on the values
+    arguments = ", ".join("NULL" for _ in parameter_types)
+    cursor.execute(f"PREPARE checked_statement ({', '.join(parameter_types)}) AS {statement}")
+    try:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) EXECUTE checked_statement ({arguments})")
+        return cursor.fetchone()[0][0]["Plan"]
+    finally:
+        cursor.execute("DEALLOCATE checked_statement")
+
+
+def check(connection):
+    failures = []
+    statements = FUNCTION_STATEMENTS + foreign_key_statements(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("SET plan_cache_mode = force_generic_plan;")
+        for name, statement, parameter_types in statements:
+            plan = explain(cursor, statement, parameter_types)
+            scans = sequential_scans(plan)
+            print(f"{'FAIL' if scans else 'ok':<5} {name:<40} {plan['Node Type']:<20} {plan['Total Cost']:>12.1f}"
+                  + (f"  seq scan on {', '.join(scans)}" if scans else ""))
+            if scans:
+                failures.append(name)
+    connection.rollback()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cars", type=int, default=200_000)
+    parser.add_argument("--database", default=f"{os.getenv('PG_DB')}_plan_check")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    recreate_database(args.database)
+    try:
+        MigrationRunner(lambda: connect(args.database)).run()
+        connection = connect(args.database)
+        try:
+            print(f"Seeding {args.cars:,} cars")
+            seed(connection, args.cars)
+            failures = check(connection)
+        finally:
+            connection.close()
+    finally:
+        if not args.keep:
+            drop_database(args.database)
+
+    if failures:
+        print(f"{len(failures)} statements scan large tables sequentially: {', '.join(failures)}")
+        sys.exit(1)
+    print("All statements use index access")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Synthetic dataset for load tests and benchmarks, ten thousand to tens of millions of rows.
+
+Creates a database next to PG_DB (dropped and recreated if it exists),
+applies the migrations and fills users, cars, car_images, reviews,
+favorite_cars and rental_deals, with their payments and taxes, in chunks
+generated by the server. Every row passes validate_user_register and the
+rules of validate_add_car. The data only depends on the sizes and --seed,
+so two runs with the same arguments load the same rows. The database is
+kept for benchmarks.loadgen and the other benchmarks' --database.
+
+Car g is owned by user 1 + g % users and every tenth car is unavailable.
+User g logs in as u<g>@mail.com with password pw<g>. Deals are in 2024 and
+2025, so bookings from today on never overlap them.
+
+Run from the repository root:
+    python -m benchmarks.datagen --cars 1000000
+"""
+import os
+import time
+import argparse
+from server.migrations import MigrationRunner
+from benchmarks.check_query_plans import connect, recreate_database
+
+
+REFERENCE_SQL = """
+    INSERT INTO car_types (type_name) SELECT unnest(enum_range(NULL::CAR_TYPE));
+    INSERT INTO fuel_types (type_name) SELECT unnest(enum_range(NULL::FUEL_TYPE));
+    INSERT INTO brands (name, model) SELECT b, 'M'||m FROM unnest(enum_range(NULL::CAR_BRAND)) b, generate_series(1, 20) m;
+"""
+
+# Passport, identification, license and telephone numbers are the user id
+# padded with zeros, so they are unique up to a billion users
+USERS_SQL = """
+    INSERT INTO users (given_name, surname, passport_no, identification_no, license_no, telephone_no, email,
+                       date_of_birth, password, avatar_url)
+    SELECT (ARRAY['Anna', 'Ivan', 'Olga', 'Pavel', 'Maria', 'Dmitry', 'Elena', 'Sergei'])[1 + g %% 8],
+           (ARRAY['Ivanova', 'Petrov', 'Smirnova', 'Kuznetsov', 'Popova', 'Sokolov'])[1 + g / 8 %% 6],
+           lpad(g::text, 9, '0'), lpad(g::text, 14, '0'), lpad(g::text, 10, '0'), '+375'||lpad(g::text, 9, '0'),
+           'u'||g||'@mail.com', DATE '1960-01-01' + g %% 15000, 'pw'||g, 'https://img.example.com/avatars/'||g||'.jpg'
+    FROM generate_series(%(first)s, %(last)s) g;
+"""
+
+# Plates count up through the digits, both letters and the region, which
+# keeps them unique for 67.6 million cars
+CARS_SQL = """
+    INSERT INTO cars (owner_id, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description,
+                      is_available)
+    SELECT 1 + g %% %(users)s, 1 + g %% %(car_types)s, 1 + (g * 7) %% %(brands)s, 1 + g %% %(fuel_types)s,
+           lpad(((g - 1) %% 10000)::text, 4, '0')||' '||chr(65 + ((g - 1) / 10000) %% 26)
+               ||chr(65 + ((g - 1) / 260000) %% 26)||'-'||((g - 1) / 6760000) %% 10,
+           20 + (g * 37) %% 280,
+           (ARRAY['Clean', 'Reliable', 'Comfortable', 'Economical', 'Spacious', 'Sporty'])[1 + g %% 6]||' '||
+           (ARRAY['family', 'city', 'weekend', 'business', 'road trip'])[1 + g / 6 %% 5]||' car with '||
+           (ARRAY['air conditioning', 'heated seats', 'navigation', 'roof rack', 'parking sensors'])[1 + g / 30 %% 5],
+           g %% 10 <> 0
+    FROM generate_series(%(first)s, %(last)s) g;
+"""
+
+IMAGES_SQL = """
+    INSERT INTO car_images (car_id, url)
+    SELECT g, 'https://img.example.com/cars/'||g||'/'||k||'.jpg'
+    FROM generate_series(%(first)s, %(last)s) g, generate_series(1, %(images_per_car)s) k;
+"""
+
+# Reviews and favourites go to popular cars far more often, the cube of a
+# uniform number puts half of the reviews on the first eighth of the cars
+REVIEWS_SQL = """
+    INSERT INTO reviews (car_id, user_id, message, created_at)
+    SELECT 1 + floor(%(cars)s * power(random(), 3))::INT, 1 + floor(%(users)s * random())::INT,
+           (ARRAY['Great car, would rent again', 'Clean and on time', 'Owner was very helpful',
+                  'Some scratches on the door', 'Smooth ride, low fuel consumption'])[1 + g %% 5],
+           TIMESTAMPTZ '2024-01-01' + g * INTERVAL '10 seconds'
+    FROM generate_series(%(first)s, %(last)s) g;
+"""
+
+FAVOURITES_SQL = """
+    INSERT INTO favorite_cars (user_id, car_id)
+    SELECT 1 + g %% %(users)s, 1 + floor(%(cars)s * power(random(), 2))::INT
+    FROM generate_series(%(first)s, %(last)s) g;
+"""
+
+# Deal k of a car starts 4k days after the first of January 2024 and lasts
+# one to three nights, so a car's deals never overlap. The renter is never
+# the owner, one deal in twenty is cancelled
+DEALS_SQL = """
+    INSERT INTO rental_deals (user_id, car_id, start_date, end_date, total_price, status)
+    SELECT 1 + (car_id + 1) %% %(users)s, car_id, start_date, start_date + nights, nights * (20 + (car_id * 37) %% 280),
+           CASE WHEN g %% 20 = 0 THEN 'inactive' ELSE 'active' END::ACTIVITY_STATUS_TYPE
+    FROM (
+        SELECT g, 1 + g %% %(cars)s AS car_id, DATE '2024-01-01' + (g / %(cars)s) * 4 AS start_date, 1 + g %% 3 AS nights
+        FROM generate_series(%(first)s, %(last)s) g
+    ) AS deals;
+
+    INSERT INTO payments (user_id, payed_price, time)
+    SELECT user_id, total_price * 1.13, start_date FROM rental_deals WHERE id BETWEEN %(first)s AND %(last)s;
+
+    INSERT INTO taxes (rental_deal_id, price)
+    SELECT id, total_price * 0.13 FROM rental_deals WHERE id BETWEEN %(first)s AND %(last)s;
+"""
+
+# What make_review, add_car and the rental triggers keep up to date row by row
+DERIVED_SQL = """
+    INSERT INTO car_review_stats (car_id, review_count, last_review_at)
+    SELECT car_id, COUNT(*), MAX(created_at) FROM reviews GROUP BY car_id;
+    UPDATE users SET is_owner = TRUE WHERE id IN (SELECT DISTINCT owner_id FROM cars);
+    CALL refresh_rental_stats();
+"""
+
+TABLES = ["users", "cars", "car_images", "reviews", "favorite_cars", "rental_deals"]
+
+# Deals at most one every four days per car, for two years from 2024
+MAX_DEALS_PER_CAR = 180
+
+
+def add_arguments(parser):
+    parser.add_argument("--cars", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=None, help="default one per ten cars")
+    parser.add_argument("--images-per-car", type=int, default=2)
+    parser.add_argument("--reviews", type=int, default=None, help="default one per car")
+    parser.add_argument("--favourites", type=int, default=None, help="default one per car")
+    parser.add_argument("--deals", type=int, default=None, help="default one per two cars")
+    parser.add_argument("--seed", type=float, default=0.5, help="setseed() value, between -1 and 1")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="rows per transaction")
+
+
+def dataset_sizes(args):
+    sizes = {
+        "cars": args.cars,
+        "users": args.users if args.users is not None else max(args.cars // 10, 2),
+        "images_per_car": args.images_per_car,
+        "reviews": args.reviews if args.reviews is not None else args.cars,
+        "favourites": args.favourites if args.favourites is not None else args.cars,
+        "deals": args.deals if args.deals is not None else args.cars // 2,
+    }
+    if sizes["cars"] < 2 or sizes["users"] < 2:
+        raise SystemExit("Need at least two cars and two users, owners cannot rent their own cars")
+    if sizes["deals"] > sizes["cars"] * MAX_DEALS_PER_CAR:
+        raise SystemExit(f"At most {MAX_DEALS_PER_CAR} deals per car")
+    return sizes
+
+
+def available_car(k, cars):
+    # The k-th available car, counting from 0 and wrapping around, every tenth car is seeded unavailable
+    k %= cars - cars // 10
+    return k + k // 9 + 1
+
+
+def renter(car_id, users):
+    # Anyone but the owner, 1 + car_id % users
+    return 1 + (car_id + 1) % users
+
+
+def insert_chunks(connection, statement, rows, chunk_size, params, label):
+    with connection.cursor() as cursor:
+        for first in range(1, rows + 1, chunk_size):
+            last = min(first + chunk_size - 1, rows)
+            cursor.execute(statement, {**params, "first": first, "last": last})
+            connection.commit()
+            if rows > chunk_size:
+                print(f"    {last:,} {label}")
+
+
+def generate(connection, sizes, seed=0.5, chunk_size=1_000_000):
+    # {table: [rows, seconds]}, the reference tables and derived stats are not timed separately
+    timings = {}
+    with connection.cursor() as cursor:
+        # Skips the per-row change notifications, owner and stats updates, DERIVED_SQL does those once
+        cursor.execute("SET app.bulk_import = 'on';")
+        cursor.execute("SELECT setseed(%s);", (seed,))
+        cursor.execute(REFERENCE_SQL)
+        cursor.execute("SELECT (SELECT COUNT(*) FROM car_types), (SELECT COUNT(*) FROM brands), (SELECT COUNT(*) FROM fuel_types);")
+        car_types, brands, fuel_types = cursor.fetchone()
+    connection.commit()
+
+    params = {**sizes, "car_types": car_types, "brands": brands, "fuel_types": fuel_types}
+    steps = [
+        ("users", USERS_SQL, sizes["users"]),
+        ("cars", CARS_SQL, sizes["cars"]),
+        ("car_images", IMAGES_SQL, sizes["cars"]),
+        ("reviews", REVIEWS_SQL, sizes["reviews"]),
+        ("favorite_cars", FAVOURITES_SQL, sizes["favourites"]),
+        ("rental_deals", DEALS_SQL, sizes["deals"]),
+    ]
+    for table, statement, rows in steps:
+        started = time.perf_counter()
+        # Images come images_per_car to a car, chunks count cars
+        step_chunk = max(chunk_size // max(sizes["images_per_car"], 1), 1) if table == "car_images" else chunk_size
+        insert_chunks(connection, statement, rows, step_chunk, params, table)
+        inserted = rows * sizes["images_per_car"] if table == "car_images" else rows
+        timings[table] = [inserted, time.perf_counter() - started]
+        print(f"{table:<16} {inserted:>12,} rows {timings[table][1]:8.1f} s")
+
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(DERIVED_SQL)
+        cursor.execute("RESET app.bulk_import;")
+    connection.commit()
+
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    connection.autocommit = False
+    print(f"{'stats, vacuum':<16} {'':>17} {time.perf_counter() - started:8.1f} s")
+    return timings
+
+
+def table_sizes(connection):
+    # Planner estimates, exact after the VACUUM ANALYZE that generate ends with
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relname, reltuples::BIGINT FROM pg_class WHERE relname = ANY(%s) AND relkind = 'r';", (TABLES,)
+        )
+        return dict(cursor.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--database", default=None)
+    args = parser.parse_args()
+
+    sizes = dataset_sizes(args)
+    database = args.database or f"{os.getenv('PG_DB')}_bench"
+    recreate_database(database)
+    MigrationRunner(lambda: connect(database)).run()
+
+    connection = connect(database)
+    try:
+        started = time.perf_counter()
+        timings = generate(connection, sizes, args.seed, args.chunk_size)
+    finally:
+        connection.close()
+
+    elapsed = time.perf_counter() - started
+    rows = sum(inserted for inserted, _ in timings.values())
+    print(f"Loaded {rows:,} rows into {database} in {elapsed:.1f} s ({rows / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
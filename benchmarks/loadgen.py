@@ -0,0 +1,461 @@
+"""Latency and throughput of the sync app under a realistic mix of endpoints.
+
+Fills a database next to PG_DB with benchmarks.datagen, or reuses one it
+filled with --reuse, starts the sync app with uvicorn, or with gunicorn
+and server/gunicorn.conf.py given --gunicorn, in a subprocess and
+drives it from --concurrency client threads for --warmup plus --duration
+seconds. Every thread keeps one keep-alive connection, logs users in on
+first use and revalidates what it has already fetched with If-None-Match,
+like a browser. Cars are picked with a skew towards popular ones, rentals
+book weeks after the last deal in the database, so they never conflict.
+
+Reports p50/p95/p99 latency, status codes and throughput per endpoint and
+writes them as JSON to --output. --compare prints the change against an
+earlier report. Exits with status 1 if more than --max-error-rate of the
+requests got anything but 200 or 304. A generated database is dropped
+afterwards unless --keep is given.
+
+Run from the repository root:
+    python -m benchmarks.loadgen --cars 1000000 --duration 60 --output baseline.json --keep
+    python -m benchmarks.loadgen --reuse --database car_rental_bench --compare baseline.json
+    python -m benchmarks.loadgen --reuse --database car_rental_bench --gunicorn --workers 4
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import secrets
+import argparse
+import datetime
+import itertools
+import threading
+import subprocess
+import http.client
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+from server.migrations import MigrationRunner
+from benchmarks.bench_export import wait_until_ready
+from benchmarks.check_query_plans import connect, recreate_database, drop_database
+from benchmarks.datagen import add_arguments, dataset_sizes, generate, table_sizes, available_car, renter
+
+
+# Weights of the route templates, roughly what a browsing renter does
+DEFAULT_MIX = {
+    "GET /cars": 25,
+    "GET /cars/{car_id}": 20,
+    "GET /cars/{car_id}/get_reviews": 10,
+    "GET /cars/search": 8,
+    "GET /cars/available": 6,
+    "GET /cars/batch": 4,
+    "GET /user/{user_id}/profile": 5,
+    "GET /user/{user_id}/get_favourites": 6,
+    "GET /user/{user_id}/analytics": 2,
+    "PUT /login": 3,
+    "POST /user/{user_id}/cars/{car_id}/make_review": 4,
+    "POST /user/{user_id}/cars/{car_id}/add_to_favourites": 4,
+    "POST /user/{user_id}/cars/{car_id}/make_rent": 3,
+}
+
+OK_STATUSES = {200, 304}
+
+# Statuses of requests that did not get an answer
+CONNECTION_ERROR = 0
+
+REPORT_PERCENTILES = [("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)]
+
+
+class Workload(object):
+
+    def __init__(self, users, cars, first_free_date, brands, active_users, skew, seed):
+        self.users = users
+        self.cars = cars
+        self.available = cars - cars // 10
+        self.first_free_date = first_free_date
+        self.brands = brands
+        self.skew = skew
+        # Sessions are spread over a fixed set of users, each logs in once
+        self.active_users = random.Random(seed).sample(range(1, users + 1), min(active_users, users))
+        self.bookings = itertools.count()
+
+        searches = []
+        for brand in brands:
+            word = brand.split("-")[0].lower()
+            # Exact, with a model, and misspelled by a dropped letter
+            searches += [word, f"{word} m{1 + len(searches) % 20}", word[:1] + word[2:] if len(word) > 3 else word]
+        self.searches = searches + ["family car", "sporty navigation", "economical city"]
+
+
+    def car(self, rng):
+        # Popular cars come first, rng.random() ** skew crowds the low ones
+        return available_car(int(self.available * rng.random() ** self.skew), self.cars)
+
+
+    def user(self, rng):
+        return rng.choice(self.active_users)
+
+
+    def booking(self):
+        i = next(self.bookings)
+        car_id = available_car(i, self.cars)
+        start = self.first_free_date + datetime.timedelta(days=7 * (i // self.available))
+        return renter(car_id, self.users), car_id, {
+            "start_location": "Airport", "end_location": "City centre",
+            "start_date": start.isoformat(), "end_date": (start + datetime.timedelta(days=3)).isoformat(),
+        }
+
+
+    # (method, path, JSON body, user whose token it needs)
+    def request(self, endpoint, rng):
+        if endpoint == "GET /cars":
+            choice = rng.random()
+            if choice < 0.5:
+                query = {}
+            elif choice < 0.7:
+                query = {"after": rng.randint(1, self.cars)}
+            elif choice < 0.85:
+                query = {"brand": rng.choice(self.brands)}
+            else:
+                low = rng.randrange(20, 280, 10)
+                query = {"min_price": low, "max_price": low + 20}
+            return "GET", f"/cars?{urlencode(query)}" if query else "/cars", None, None
+
+        if endpoint == "GET /cars/{car_id}":
+            return "GET", f"/cars/{self.car(rng)}", None, None
+
+        if endpoint == "GET /cars/{car_id}/get_reviews":
+            return "GET", f"/cars/{self.car(rng)}/get_reviews", None, None
+
+        if endpoint == "GET /cars/search":
+            return "GET", f"/cars/search?{urlencode({'q': rng.choice(self.searches)})}", None, None
+
+        if endpoint == "GET /cars/available":
+            # Where the seeded deals are
+            start = datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(700))
+            end = start + datetime.timedelta(days=rng.randint(1, 7))
+            return "GET", f"/cars/available?start={start}&end={end}", None, None
+
+        if endpoint == "GET /cars/batch":
+            ids = ",".join(str(self.car(rng)) for _ in range(20))
+            return "GET", f"/cars/batch?ids={ids}", None, None
+
+        if endpoint == "PUT /login":
+            user_id = self.user(rng)
+            return "PUT", "/login", {"email": f"u{user_id}@mail.com", "password": f"pw{user_id}"}, None
+
+        if endpoint == "POST /user/{user_id}/cars/{car_id}/make_rent":
+            user_id, car_id, deal = self.booking()
+            return "POST", f"/user/{user_id}/cars/{car_id}/make_rent", deal, user_id
+
+        user_id = self.user(rng)
+        if endpoint == "POST /user/{user_id}/cars/{car_id}/make_review":
+            message = urlencode({"message": "Load test review"})
+            return "POST", f"/user/{user_id}/cars/{self.car(rng)}/make_review?{message}", None, user_id
+        if endpoint == "POST /user/{user_id}/cars/{car_id}/add_to_favourites":
+            return "POST", f"/user/{user_id}/cars/{self.car(rng)}/add_to_favourites", None, user_id
+
+        # GET /user/{user_id}/profile, get_favourites and analytics
+        return "GET", endpoint.replace("{user_id}", str(user_id)).split(" ", 1)[1], None, user_id
+
+
+class Client(object):
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.connection = None
+        self.etags = {}
+
+
+    def send(self, method, path, body=None, headers=None):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return CONNECTION_ERROR, None, None, time.perf_counter() - started
+        return response.status, response.getheader("ETag"), data, time.perf_counter() - started
+
+
+class LoadRun(object):
+
+    def __init__(self, base_url, workload, mix, started, warmup, duration):
+        self.base_url = base_url
+        self.workload = workload
+        self.endpoints = list(mix)
+        self.weights = [mix[endpoint] for endpoint in self.endpoints]
+        self.measured_from = started + warmup
+        self.deadline = started + warmup + duration
+        # A user logs in once and every thread uses the token
+        self.tokens = {}
+        # (endpoint, status, seconds), appended to by every thread
+        self.samples = []
+        self.lock = threading.Lock()
+
+
+    def record(self, samples, endpoint, status, elapsed, started):
+        if started >= self.measured_from:
+            samples.append((endpoint, status, elapsed))
+
+
+    def token(self, client, samples, user_id):
+        if user_id not in self.tokens:
+            started = time.monotonic()
+            status, _, data, elapsed = client.send(
+                "PUT", "/login", {"email": f"u{user_id}@mail.com", "password": f"pw{user_id}"}
+            )
+            self.record(samples, "PUT /login", status, elapsed, started)
+            if status != 200:
+                return None
+            self.tokens[user_id] = json.loads(data)["token"]
+        return self.tokens[user_id]
+
+
+    def drive(self, seed):
+        rng = random.Random(seed)
+        client = Client(self.base_url)
+        samples = []
+        while time.monotonic() < self.deadline:
+            endpoint = rng.choices(self.endpoints, self.weights)[0]
+            method, path, body, user_id = self.workload.request(endpoint, rng)
+
+            headers = {}
+            if user_id is not None:
+                token = self.token(client, samples, user_id)
+                if token is None:
+                    continue
+                headers["Authorization"] = f"Bearer {token}"
+            if method == "GET" and path in client.etags:
+                headers["If-None-Match"] = client.etags[path]
+
+            started = time.monotonic()
+            status, etag, _, elapsed = client.send(method, path, body, headers)
+            self.record(samples, endpoint, status, elapsed, started)
+            if etag is not None and status == 200:
+                client.etags[path] = etag
+
+        with self.lock:
+            self.samples += samples
+
+
+    def run(self, concurrency, seed):
+        threads = [threading.Thread(target=self.drive, args=(seed + i,), daemon=True) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.samples
+
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    return ordered[max(math.ceil(len(ordered) * fraction) - 1, 0)]
+
+
+def summarize(samples, duration):
+    latencies = sorted(elapsed for _, status, elapsed in samples if status != CONNECTION_ERROR)
+    statuses = Counter(status for _, status, _ in samples)
+    summary = {
+        "requests": len(samples),
+        "errors": sum(count for status, count in statuses.items() if status not in OK_STATUSES),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_rps": round(len(samples) / duration, 1),
+    }
+    for name, fraction in REPORT_PERCENTILES:
+        summary[name] = round(percentile(latencies, fraction) * 1000, 3) if latencies else None
+    summary["max_ms"] = round(latencies[-1] * 1000, 3) if latencies else None
+    return summary
+
+
+def report(samples, args, mix, dataset):
+    by_endpoint = {}
+    for sample in samples:
+        by_endpoint.setdefault(sample[0], []).append(sample)
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "config": {
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "server_workers": None if args.url else args.workers,
+            "server_launcher": None if args.url else ("gunicorn" if args.gunicorn else "uvicorn"),
+            "active_users": args.active_users,
+            "skew": args.skew,
+            "client_seed": args.client_seed,
+            "mix": mix,
+        },
+        "dataset": dataset,
+        "overall": summarize(samples, args.duration),
+        "endpoints": {
+            endpoint: summarize(by_endpoint[endpoint], args.duration) for endpoint in mix if endpoint in by_endpoint
+        },
+    }
+
+
+def change(new, old):
+    if new is None or not old:
+        return ""
+    return f"({(new - old) / old * 100:+.0f}%)"
+
+
+def print_report(result, baseline=None):
+    rows = [("overall", result["overall"])] + list(result["endpoints"].items())
+    previous = {"overall": baseline["overall"], **baseline["endpoints"]} if baseline else {}
+
+    print(f"{'endpoint':<54} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, summary in rows:
+        line = (f"{endpoint:<54} {summary['requests']:>9,} {summary['errors']:>7,} {summary['throughput_rps']:>8,.0f} "
+                f"{summary['p50_ms'] or 0:>9.2f} {summary['p95_ms'] or 0:>9.2f} {summary['p99_ms'] or 0:>9.2f}")
+        print(line)
+        if endpoint in previous:
+            old = previous[endpoint]
+            print(f"{'  vs baseline':<54} {'':>9} {'':>7} {change(summary['throughput_rps'], old['throughput_rps']):>8} "
+                  f"{change(summary['p50_ms'], old['p50_ms']):>9} {change(summary['p95_ms'], old['p95_ms']):>9} "
+                  f"{change(summary['p99_ms'], old['p99_ms']):>9}")
+
+
+def parse_mix(value):
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, value.split(",")):
+        endpoint, _, weight = item.rpartition("=")
+        if endpoint not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint '{endpoint}', expected one of {', '.join(DEFAULT_MIX)}")
+        mix[endpoint] = float(weight)
+    return {endpoint: weight for endpoint, weight in mix.items() if weight > 0}
+
+
+def workload_for(connection, args):
+    with connection.cursor() as cursor:
+        cursor.execute(
+        """
+            SELECT (SELECT max(id) FROM users), (SELECT max(id) FROM cars),
+                   GREATEST((SELECT max(end_date) FROM rental_deals), CURRENT_DATE) + 1,
+                   ARRAY(SELECT DISTINCT name::text FROM brands ORDER BY 1);
+        """
+        )
+        users, cars, first_free_date, brands = cursor.fetchone()
+    connection.commit()
+    if not users or not cars:
+        raise SystemExit("The database has no users or cars, fill it with benchmarks.datagen first")
+    return Workload(users, cars, first_free_date, brands, args.active_users, args.skew, args.client_seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--reuse", action="store_true", help="drive a database benchmarks.datagen already filled")
+    parser.add_argument("--keep", action="store_true", help="keep a generated database afterwards")
+    parser.add_argument("--url", default=None, help="drive a server that is already running on --database")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--gunicorn", action="store_true", help="start the server the way production does")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads")
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds driven before measuring")
+    parser.add_argument("--active-users", type=int, default=1000)
+    parser.add_argument("--skew", type=float, default=2.0, help="popularity skew of cars, 1 is uniform")
+    parser.add_argument("--client-seed", type=int, default=1)
+    parser.add_argument("--mix", type=parse_mix, default=dict(DEFAULT_MIX),
+                        help='weight overrides, "GET /cars=10,PUT /login=0"')
+    parser.add_argument("--output", default=None, help="write the report here as JSON")
+    parser.add_argument("--compare", default=None, help="an earlier report to compare with")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as report_file:
+            baseline = json.load(report_file)
+
+    reuse = args.reuse or args.url is not None
+    database = args.database or f"{os.getenv('PG_DB')}_bench"
+    dataset = {}
+    if not reuse:
+        sizes = dataset_sizes(args)
+        recreate_database(database)
+
+    server = None
+    try:
+        connection = connect(database)
+        try:
+            if not reuse:
+                MigrationRunner(lambda: connect(database)).run()
+                started = time.perf_counter()
+                dataset["load_s"] = {table: round(seconds, 1) for table, (_, seconds) in generate(
+                    connection, sizes, args.seed, args.chunk_size
+                ).items()}
+                print(f"Loaded the dataset in {time.perf_counter() - started:.1f} s")
+                dataset["sizes"] = sizes
+            dataset["rows"] = table_sizes(connection)
+            workload = workload_for(connection, args)
+        finally:
+            connection.close()
+
+        base_url = args.url
+        if base_url is None:
+            if args.gunicorn:
+                command = ["gunicorn", "-c", "server/gunicorn.conf.py", "server.main:app",
+                           "--bind", f"127.0.0.1:{args.port}", "--workers", str(args.workers), "--log-level", "warning"]
+            else:
+                command = ["uvicorn", "server.main:app", "--port", str(args.port),
+                           "--workers", str(args.workers), "--log-level", "warning"]
+            server = subprocess.Popen(
+                [sys.executable, "-m", *command],
+                # Workers have to verify each other's session tokens
+                env={**os.environ, "PG_DB": database, "SESSION_SECRET": secrets.token_hex(32)},
+            )
+            base_url = f"http://127.0.0.1:{args.port}"
+            wait_until_ready(server, f"{base_url}/ready")
+
+        print(f"Driving {base_url} from {args.concurrency} threads for {args.warmup:.0f} + {args.duration:.0f} s")
+        samples = LoadRun(base_url, workload, args.mix, time.monotonic(), args.warmup, args.duration).run(
+            args.concurrency, args.client_seed
+        )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if not reuse and not args.keep:
+            drop_database(database)
+
+    result = report(samples, args, args.mix, dataset)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(result, report_file, indent=2)
+        print(f"Report written to {args.output}")
+
+    overall = result["overall"]
+    if not overall["requests"]:
+        raise SystemExit("No requests completed")
+    if overall["errors"] > overall["requests"] * args.max_error_rate:
+        failing = {endpoint: summary["statuses"] for endpoint, summary in result["endpoints"].items() if summary["errors"]}
+        raise SystemExit(f"{overall['errors']:,} of {overall['requests']:,} requests failed: {failing}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import time
+import queue
+import threading
+from datetime import datetime, timezone
+import psycopg2
+
+
+MAX_MESSAGE_LENGTH = 500
+
+# One statement per batch. Events of users deleted since are kept with a
+# NULL user_id, as ON DELETE SET NULL does for the rows already written
+INSERT_EVENTS_SQL = """
+    INSERT INTO user_logs (user_id, message, time)
+    SELECT users.id, events.message, events.time
+    FROM unnest(%s::INT[], %s::VARCHAR[], %s::TIMESTAMPTZ[]) AS events (user_id, message, time)
+    LEFT JOIN users ON users.id = events.user_id;
+"""
+
+
+class ActivityLog(object):
+    # Service methods record events, a writer thread inserts them into user_logs in batches
+
+    def __init__(self, connect, max_queue_size=10000, batch_size=500, flush_interval=1.0, block_timeout=0.0,
+                 max_attempts=3, retry_delay=1.0, metrics=None):
+        if max_queue_size < 1 or batch_size < 1:
+            raise ValueError("Queue and batch sizes should be positive numbers")
+
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # How long record() waits for room in a full queue before dropping the event
+        self.block_timeout = block_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.metrics = metrics
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.__queue = queue.Queue(maxsize=max_queue_size)
+        self.__connection = None
+        self.__counts_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        if metrics is not None:
+            metrics.watch_activity_log(self)
+
+
+    @property
+    def size(self):
+        return self.__queue.qsize()
+
+
+    @property
+    def max_size(self):
+        return self.__queue.maxsize
+
+
+    def __count(self, outcome, amount=1):
+        with self.__counts_lock:
+            setattr(self, outcome, getattr(self, outcome) + amount)
+        if self.metrics is not None:
+            self.metrics.activity_events.inc(outcome, amount=amount)
+
+
+    def record(self, user_id, message):
+        event = (user_id, message[:MAX_MESSAGE_LENGTH], datetime.now(timezone.utc))
+        try:
+            if self.block_timeout > 0:
+                self.__queue.put(event, timeout=self.block_timeout)
+            else:
+                self.__queue.put_nowait(event)
+        except queue.Full:
+            # The request goes on, a slow or unreachable database must not hold it up
+            self.__count("dropped")
+            return False
+        self.__count("queued")
+        return True
+
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name="activity-log-writer", daemon=True)
+        self.__thread.start()
+
+
+    def stop(self, timeout=10.0):
+        # The writer flushes what is queued before it exits
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=timeout)
+            self.__thread = None
+
+
+    def stats(self):
+        with self.__counts_lock:
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "written": self.written,
+                "failed": self.failed,
+            }
+
+
+    def __next_batch(self):
+        # Up to batch_size events, waiting at most flush_interval after the first one
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if self.__stopped.is_set():
+                timeout = 0
+            elif deadline is None:
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+            try:
+                event = self.__queue.get(timeout=timeout) if timeout > 0 else self.__queue.get_nowait()
+            except queue.Empty:
+                if batch or self.__stopped.is_set():
+                    break
+                continue
+
+            batch.append(event)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+
+    def __write(self, batch):
+        if self.__connection is None or self.__connection.closed:
+            self.__connection = self.connect()
+
+        user_ids, messages, times = zip(*batch)
+        with self.__connection.cursor() as cursor:
+            cursor.execute(INSERT_EVENTS_SQL, (list(user_ids), list(messages), list(times)))
+        self.__connection.commit()
+
+
+    def __flush(self, batch):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.__write(batch)
+            except psycopg2.Error as e:
+                print(f"Activity log writer error '{str(e).splitlines()[0]}', attempt {attempt} of {self.max_attempts}")
+                # Its transaction is left aborted or the connection broken, the next attempt reconnects
+                self.__close_connection()
+                # Retried at once on shutdown, the queue behind it still has to be flushed
+                if attempt < self.max_attempts and not self.__stopped.is_set():
+                    self.__stopped.wait(self.retry_delay)
+            else:
+                self.__count("written", len(batch))
+                return
+        self.__count("failed", len(batch))
+
+
+    def __close_connection(self):
+        if self.__connection is not None:
+            try:
+                self.__connection.close()
+            except psycopg2.Error:
+                pass
+            self.__connection = None
+
+
+    def __run(self):
+        try:
+            while True:
+                batch = self.__next_batch()
+                if batch:
+                    self.__flush(batch)
+                elif self.__stopped.is_set():
+                    return
+        finally:
+            self.__close_connection()
@@ -0,0 +1,198 @@
+import time
+import asyncio
+import weakref
+import psycopg2
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from psycopg import AsyncClientCursor, OperationalError
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool
+from server.db import VERIFIED_USER_SQL
+from server.migrations import MigrationRunner
+
+
+class AsyncDatabaseHandler(object):
+
+    def __init__(self, db_name, db_user, db_password, db_host, db_port,
+                 pool_min_size=1, pool_max_size=10, pool_timeout=30.0, pool_health_check_interval=30.0):
+        self.db_name = db_name
+        self.db_user = db_user
+        self.db_password = db_password
+        self.db_host = db_host
+        self.db_port = db_port
+        self.pool_health_check_interval = pool_health_check_interval
+        self.__connection = ContextVar("connection", default=None)
+        self.__verified_user_id = ContextVar("verified_user_id", default=None)
+        self.__snapshot = ContextVar("snapshot", default=False)
+        self.__last_used = weakref.WeakKeyDictionary()
+        self.pool = AsyncConnectionPool(
+            kwargs={
+                "dbname": self.db_name,
+                "user": self.db_user,
+                "password": self.db_password,
+                "host": self.db_host,
+                "port": self.db_port,
+                "cursor_factory": AsyncClientCursor,
+            },
+            min_size=pool_min_size,
+            max_size=pool_max_size,
+            timeout=pool_timeout,
+            check=self.__check_connection,
+            reset=self.__reset_connection,
+            open=False,
+        )
+
+
+    async def open(self, migrate=True):
+        print("==========================================")
+        try:
+            await self.pool.open(wait=True)
+            print("Async connection pool to PostgreSQL DB is ready")
+        except Exception as e:
+            print(f"The error '{e}' occurred")
+            raise
+        finally:
+            print("==========================================")
+        if migrate:
+            await self.__init_db()
+
+
+    async def close(self):
+        await self.pool.close()
+
+
+    async def __check_connection(self, connection):
+        last_used = self.__last_used.get(connection)
+        if last_used is not None and time.monotonic() - last_used < self.pool_health_check_interval:
+            return
+        await AsyncConnectionPool.check_connection(connection)
+
+
+    async def __reset_connection(self, connection):
+        self.__last_used[connection] = time.monotonic()
+
+
+    @property
+    def connection(self):
+        connection = self.__connection.get()
+        if connection is None:
+            raise RuntimeError("No transaction scope is active in this task")
+        return connection
+
+
+    @asynccontextmanager
+    async def transaction(self):
+        if self.__connection.get() is not None:
+            yield self.__connection.get()
+            return
+
+        async with self.pool.connection() as connection:
+            token = self.__connection.set(connection)
+            try:
+                yield connection
+            finally:
+                self.__connection.reset(token)
+
+
+    @contextmanager
+    def verified_user(self, user_id):
+        # check_user_status skips the user the caller already checked
+        token = self.__verified_user_id.set(user_id)
+        try:
+            yield
+        finally:
+            self.__verified_user_id.reset(token)
+
+
+    @asynccontextmanager
+    async def snapshot(self):
+        # Statements in the block share one REPEATABLE READ transaction instead
+        # of committing one by one, the caller commits or rolls it back
+        connection = self.connection
+        if connection.info.transaction_status != TransactionStatus.IDLE:
+            await connection.commit()
+        await connection.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        token = self.__snapshot.set(True)
+        try:
+            yield connection
+        finally:
+            self.__snapshot.reset(token)
+
+
+    async def raw_sql(self, query, params=None):
+        async with self.transaction() as connection:
+            verified_user_id = self.__verified_user_id.get()
+            if verified_user_id is not None:
+                query = VERIFIED_USER_SQL + query
+                params = (str(verified_user_id), *(params or ()))
+
+            cursor = connection.cursor()
+            try:
+                await cursor.execute(query, params)
+                if verified_user_id is not None:
+                    # psycopg 3 stops at the first result, set_config's
+                    cursor.nextset()
+                if not self.__snapshot.get():
+                    await connection.commit()
+                return cursor
+            except OperationalError as e:
+                return None, e
+
+
+    async def ping(self, timeout=1.0):
+        # Waits at most timeout for a pooled connection, a saturated pool is not ready for more requests
+        async with self.pool.connection(timeout=timeout) as connection:
+            await connection.execute("SELECT 1;")
+
+
+    def pool_state(self):
+        pool_stats = self.pool.get_stats()
+        return {
+            "primary": {"size": pool_stats["pool_size"], "idle": pool_stats["pool_available"], "max_size": self.pool.max_size},
+            "replicas": [],
+        }
+
+
+    def connect(self):
+        # A psycopg2 connection of its own, for the helpers shared with the
+        # sync app: migrations, the activity log, LISTEN and the ledger
+        return psycopg2.connect(
+            database = self.db_name,
+            user = self.db_user,
+            password = self.db_password,
+            host = self.db_host,
+            port = self.db_port,
+        )
+
+
+    @contextmanager
+    def sync_transaction(self):
+        # For the bulk importer, which runs in a worker thread off the event loop
+        connection = self.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+
+    def stream(self, query, params=None, batch_size=1000):
+        # Same as DatabaseHandler.stream, on a connection of its own: a streaming
+        # response iterates a plain generator in the threadpool, not on the event loop
+        connection = self.connect()
+        try:
+            with connection.cursor(name="stream") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(query, params)
+                rows = cursor.fetchmany(batch_size)
+                yield cursor.description
+
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(batch_size)
+        finally:
+            connection.close()
+
+
+    async def __init_db(self):
+        # The runner blocks on the advisory lock, keep it off the event loop
+        await asyncio.to_thread(MigrationRunner(self.connect).run)
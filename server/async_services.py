@@ -0,0 +1,768 @@
+import os
+import asyncio
+import functools
+import psycopg
+import psycopg2
+from fastapi import status
+from psycopg_pool import PoolTimeout
+from server.async_db import AsyncDatabaseHandler
+from server.cache import MISSING, LRUCache, NotifyListener
+from server.reference import AsyncReferenceCache
+from server.sessions import SessionTokens
+from server.bulk import BulkCarImporter, parse_rows
+from server.activity import ActivityLog
+from server.ledger import LedgerError, LedgerExporter, SettleTimeout
+from server.decoding import decode_row, decode_rows
+from server.models import UserRegister, UserLogin, UserProfile, EditUser, AddCar, Cars, CurrentCar, CarDetails, CarBatch, UpdateCar, Review, RentalDeal, OwnerAnalytics, CarAnalytics
+
+
+def transactional(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        async with self.db_handler.transaction():
+            return await method(self, *args, **kwargs)
+    return wrapper
+
+
+def cached(cache_name):
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args):
+            cache = getattr(self, cache_name)
+            value = cache.get(args)
+            if value is not MISSING:
+                return value, status.HTTP_200_OK
+            
+            generation = cache.generation
+            data, stat_code = await method(self, *args)
+            if stat_code == status.HTTP_200_OK:
+                cache.set(args, data, generation)
+            return data, stat_code
+        return wrapper
+    return decorator
+
+
+def verified_user(method):
+    @functools.wraps(method)
+    async def wrapper(self, user_id, *args, **kwargs):
+        error = await self.check_user(user_id)
+        if error is not None:
+            return error, status.HTTP_401_UNAUTHORIZED
+        
+        with self.db_handler.verified_user(user_id):
+            return await method(self, user_id, *args, **kwargs)
+    return wrapper
+
+
+# ServiceHandler on psycopg 3 and the event loop. The session tokens, caches,
+# activity log and ledger exports are the sync app's, the helpers among them
+# that block run off the loop on psycopg2 connections of their own
+class AsyncServiceHandler(object):
+
+    def __init__(self):
+        self.db_handler = AsyncDatabaseHandler(
+            db_user=os.getenv("PG_USER"),
+            db_password=os.getenv("PG_PASSWORD"),
+            db_name=os.getenv("PG_DB"),
+            db_host=os.getenv("PG_HOST"),
+            db_port=os.getenv("PG_PORT"),
+            pool_min_size=int(os.getenv("PG_POOL_MIN_SIZE", 1)),
+            pool_max_size=int(os.getenv("PG_POOL_MAX_SIZE", 10)),
+            pool_timeout=float(os.getenv("PG_POOL_TIMEOUT", 30)),
+            pool_health_check_interval=float(os.getenv("PG_POOL_HEALTH_CHECK_INTERVAL", 30)),
+        )
+        self.migrate_on_startup = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+        self.readiness_timeout = float(os.getenv("READINESS_TIMEOUT", 1))
+        self.state = "starting"
+        self.cars_cache = LRUCache(
+            max_size=int(os.getenv("CARS_CACHE_SIZE", 1024)),
+            ttl=float(os.getenv("CARS_CACHE_TTL", 30)),
+        )
+        self.car_cache = LRUCache(
+            max_size=int(os.getenv("CAR_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("CAR_CACHE_TTL", 300)),
+        )
+        # (status, role_id, session_generation) per user id, None for a user that does not exist
+        self.session_cache = LRUCache(
+            max_size=int(os.getenv("SESSION_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("SESSION_CACHE_TTL", 60)),
+        )
+        # A random secret is lost on restart and differs between hosts, so only development runs without one
+        session_secret = os.getenv("SESSION_SECRET") or None
+        if session_secret is None and os.getenv("APP_ENV", "production") != "development":
+            raise RuntimeError("SESSION_SECRET is not set, set it or APP_ENV=development to sign with a random secret")
+        self.session_tokens = SessionTokens(
+            secret=session_secret,
+            ttl=float(os.getenv("SESSION_TOKEN_TTL", 86400)),
+        )
+        self.reference_cache = AsyncReferenceCache(self.db_handler)
+        self.bulk_importer = BulkCarImporter(
+            self.db_handler.sync_transaction,
+            self.reference_cache,
+            chunk_size=int(os.getenv("BULK_IMPORT_CHUNK_SIZE", 1000)),
+        )
+        self.export_batch_size = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+        self.ledger_token = os.getenv("LEDGER_TOKEN") or None
+        self.ledger_exporter = LedgerExporter(
+            self.db_handler.connect,
+            chunk_size=int(os.getenv("LEDGER_CHUNK_SIZE", 10000)),
+            settle_timeout=float(os.getenv("LEDGER_SETTLE_TIMEOUT", 10)),
+        )
+        # record() runs on the event loop, so it never waits for room: a full queue drops the event
+        self.activity_log = ActivityLog(
+            self.db_handler.connect,
+            max_queue_size=int(os.getenv("ACTIVITY_LOG_QUEUE_SIZE", 10000)),
+            batch_size=int(os.getenv("ACTIVITY_LOG_BATCH_SIZE", 500)),
+            flush_interval=float(os.getenv("ACTIVITY_LOG_FLUSH_INTERVAL", 1)),
+        )
+        self.notify_listener = NotifyListener(self.db_handler.connect)
+        if os.getenv("CACHE_BACKEND", "local") == "postgres":
+            self.notify_listener.subscribe("car_changes", self.__on_car_change, on_reconnect=self.clear_caches)
+            self.notify_listener.subscribe(
+                "reference_changes", self.reference_cache.invalidate, on_reconnect=self.reference_cache.invalidate
+            )
+            self.notify_listener.subscribe("user_changes", self.__on_user_change, on_reconnect=self.session_cache.clear)
+    
+    
+    async def start(self):
+        await self.db_handler.open(migrate=self.migrate_on_startup)
+        self.notify_listener.start()
+        self.activity_log.start()
+        self.state = "ready"
+    
+    
+    async def close(self):
+        self.state = "stopping"
+        # Both join their threads, the activity log after writing what is queued
+        await asyncio.to_thread(self.notify_listener.stop)
+        await asyncio.to_thread(self.activity_log.stop)
+        await self.db_handler.close()
+    
+    
+    async def readiness(self):
+        readiness = {"status": self.state, "pid": os.getpid(), **self.db_handler.pool_state()}
+        if self.state != "ready":
+            return readiness, status.HTTP_503_SERVICE_UNAVAILABLE
+        
+        try:
+            await self.db_handler.ping(self.readiness_timeout)
+        except (psycopg.Error, PoolTimeout) as e:
+            return {**readiness, "status": "unavailable", "detail": f"{e}".split('\n')[0]}, status.HTTP_503_SERVICE_UNAVAILABLE
+        return readiness, status.HTTP_200_OK
+    
+    
+    def cache_stats(self):
+        return {
+            "cars": self.cars_cache.stats(),
+            "car": self.car_cache.stats(),
+            "reference": self.reference_cache.stats(),
+            "session": self.session_cache.stats(),
+            "activity_log": self.activity_log.stats(),
+        }
+    
+    
+    def clear_caches(self):
+        self.cars_cache.clear()
+        self.car_cache.clear()
+    
+    
+    def invalidate_car(self, car_id: int = None):
+        self.cars_cache.clear()
+        if car_id is not None:
+            self.car_cache.invalidate((car_id,))
+    
+    
+    def __on_car_change(self, payload):
+        self.invalidate_car(int(payload) if payload else None)
+    
+    
+    def __on_user_change(self, payload):
+        self.session_cache.invalidate((int(payload),))
+    
+    
+    async def __version(self, resource, params=()):
+        # The version behind a resource's ETag, see 0012_resource_versions.sql
+        result = await self.db_handler.raw_sql(
+            f"SELECT get_{resource}_version({', '.join(['%s'] * len(params))});", params
+        )
+        return (await result.fetchone())[0]
+    
+    
+    async def check_user(self, user_id: int, token_generation: int = None):
+        # What check_user_status would raise, from the session cache when it is warm.
+        # A token issued before the user's last logout is refused as well
+        session = self.session_cache.get((user_id,))
+        if session is MISSING:
+            generation = self.session_cache.generation
+            # Joins the caller's transaction, or borrows a connection of its own for a token check
+            async with self.db_handler.transaction():
+                try:
+                    result = await self.db_handler.raw_sql(
+                    """
+                        SELECT status, role_id, session_generation FROM users WHERE id = %s;
+                    """, (user_id,)
+                    )
+                except psycopg.Error as e:
+                    await self.db_handler.connection.rollback()
+                    return f"Cannot check user: {e}".split('\n')[0]
+                session = await result.fetchone()
+            self.session_cache.set((user_id,), session, generation)
+        
+        if session is None:
+            return f"User with id {user_id} does not exist"
+        if token_generation is not None and token_generation < session[2]:
+            return "Session token has been revoked by a logout"
+        if session[0] == "inactive":
+            return "User is inactive"
+        return None
+    
+    
+    @transactional
+    async def get_version(self, resource, *params):
+        try:
+            version = await self.__version(resource, params)
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get {resource} version: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            return version, status.HTTP_200_OK
+    
+    
+    @transactional
+    async def get_all_roles(self):
+        try:
+            await self.reference_cache.load()
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get roles: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            return self.reference_cache.roles(), status.HTTP_200_OK
+    
+    
+    @transactional
+    async def register(self, user_register: UserRegister):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT user_registration(
+                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                );
+            """, (
+                user_register.given_name, user_register.surname,
+                user_register.passport_no, user_register.identification_no,
+                user_register.license_no, user_register.telephone_no,
+                user_register.email, user_register.date_of_birth,
+                user_register.password, user_register.avatar_url
+                )
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot register: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            return {"id": (await result.fetchone())[0]}, status.HTTP_200_OK
+    
+    
+    @transactional
+    async def login(self, user_login: UserLogin):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT user_id, status, role_id, session_generation FROM login_user(%s, %s);
+            """, (user_login.email, user_login.password)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot login: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            user_id, user_status, role_id, session_generation = await result.fetchone()
+            self.session_cache.set((user_id,), (user_status, role_id, session_generation))
+            self.activity_log.record(user_id, "login")
+            
+            return {
+                "user_id": user_id,
+                "token": self.session_tokens.issue(user_id, session_generation),
+                "token_type": "bearer",
+                "expires_in": int(self.session_tokens.ttl),
+            }, status.HTTP_200_OK
+    
+    
+    @transactional
+    async def logout(self, user_id: int, choice: bool):
+        try:
+            _ = await self.db_handler.raw_sql(
+            """
+                CALL user_logout(%s, %s);
+            """, (user_id, choice)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot logout: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            self.session_cache.invalidate((user_id,))
+            self.activity_log.record(user_id, "logout")
+            return "Successful logout!", status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def user_profile(self, user_id: int):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT
+                    given_name, surname, passport_no, identification_no,
+                    license_no, telephone_no, email, date_of_birth,
+                    password, is_owner, avatar_url, status,
+                    role_name, permission AS role_permission
+                FROM user_profile(%s);
+            """, (user_id,)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get user profile: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            profile = decode_row(result.description, await result.fetchone(), UserProfile)
+            
+            return profile, status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def edit_profile(self, user_id: int, edit_user: EditUser):
+        try:
+            _ = await self.db_handler.raw_sql(
+            """
+                CALL edit_profile(%s, %s, %s, %s);
+            """, (
+                user_id, edit_user.old_password,
+                edit_user.new_password, edit_user.new_avatar_url
+                )
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot edit profile: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            return "Successful editing!", status.HTTP_200_OK
+    
+    
+    async def __insert_car(self, user_id: int, car: AddCar, reference_ids):
+        return await self.db_handler.raw_sql(
+        """
+            SELECT add_car(
+                %s, %s, %s, %s, %s, %s, %s, %s,
+                ARRAY[%s]::VARCHAR[],
+                %s, %s, %s
+            ) AS id;
+        """, (
+            user_id, car.type_name,
+            car.brand, car.model,
+            car.fuel_type, car.registration_plate,
+            car.price_per_day, car.description,
+            car.images, *reference_ids
+            )
+        )
+    
+    
+    @transactional
+    @verified_user
+    async def add_car(self, user_id: int, car: AddCar):
+        try:
+            await self.reference_cache.load()
+            reference_ids = self.reference_cache.car_ids(car.type_name, car.brand, car.model, car.fuel_type)
+            try:
+                result = await self.__insert_car(user_id, car, reference_ids)
+            except psycopg.errors.ForeignKeyViolation:
+                # A cached id no longer exists, let add_car resolve all of them
+                await self.db_handler.connection.rollback()
+                self.reference_cache.invalidate()
+                reference_ids = (None, None, None)
+                result = await self.__insert_car(user_id, car, reference_ids)
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot add car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            if None in reference_ids:
+                self.reference_cache.invalidate()
+            self.invalidate_car()
+            car_id = (await result.fetchone())[0]
+            self.activity_log.record(user_id, f"add car {car_id}")
+            return {"id": car_id}, status.HTTP_200_OK
+    
+    
+    async def import_cars(self, user_id: int, body: bytes, content_type: str):
+        try:
+            rows = parse_rows(body, content_type)
+        except ValueError as e:
+            return f"Cannot import cars: {e}", status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        
+        try:
+            await self.reference_cache.load()
+            # COPY goes through psycopg2, on a connection of the importer's own in a worker thread
+            result = await asyncio.to_thread(self.bulk_importer.import_cars, user_id, rows)
+        except UnicodeDecodeError as e:
+            return f"Cannot import cars: {e}", status.HTTP_400_BAD_REQUEST
+        except (psycopg.Error, psycopg2.Error) as e:
+            return f"Cannot import cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            if result["inserted"]:
+                self.invalidate_car()
+                self.activity_log.record(user_id, f"import {result['inserted']} cars")
+            return result, status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def delete_car(self, user_id: int, car_id: int):
+        try:
+            _ = await self.db_handler.raw_sql(
+            """
+                CALL delete_car(%s, %s);
+            """, (user_id, car_id)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot delete car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            self.invalidate_car(car_id)
+            self.activity_log.record(user_id, f"delete car {car_id}")
+            return "Successful deliting!", status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def update_car(self, user_id: int, car_id: int, update_car: UpdateCar):
+        try:
+            _ = await self.db_handler.raw_sql(
+            """
+                CALL update_car(%s, %s, %s, %s);
+            """, (
+                user_id, car_id,
+                update_car.new_price_per_day, update_car.new_description
+                )
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot update car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            self.invalidate_car(car_id)
+            self.activity_log.record(user_id, f"update car {car_id}")
+            return "Successful updating!", status.HTTP_200_OK
+    
+    
+    @cached("cars_cache")
+    @transactional
+    async def get_available_cars(self, after_car_id: int = None, page_size: int = 50,
+                           type_name: str = None, brand: str = None, fuel_type: str = None,
+                           min_price: float = None, max_price: float = None):
+        try:
+            # Read before the page, so the page is never older than its version
+            version = await self.__version("catalogue")
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM get_available_cars(%s, %s, %s, %s, %s, %s, %s);
+            """, (
+                after_car_id, page_size,
+                type_name, brand, fuel_type,
+                min_price, max_price
+                )
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get available cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, await result.fetchall(), Cars)
+            
+            return (version, cars), status.HTTP_200_OK
+    
+    
+    @transactional
+    async def search_cars(self, query: str, page_size: int = 20):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM search_cars(%s, %s);
+            """, (query, page_size)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot search cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, await result.fetchall(), Cars)
+            
+            return cars, status.HTTP_200_OK
+    
+    
+    async def export_cars(self):
+        batches = self.db_handler.stream(
+        """
+            SELECT * FROM export_cars();
+        """, batch_size=self.export_batch_size
+        )
+        try:
+            description = await asyncio.to_thread(next, batches)
+        except psycopg2.Error as e:
+            return f"Cannot export cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        
+        # Decoded a batch at a time while the response is being sent
+        return (decode_rows(description, rows, Cars) for rows in batches), status.HTTP_200_OK
+    
+    
+    async def export_ledger(self, table: str, fmt: str, date_from=None, date_to=None, watermark: str = None):
+        try:
+            # Waits for the table's writers to settle, off the event loop
+            export = await asyncio.to_thread(self.ledger_exporter.export, table, fmt, date_from, date_to, watermark)
+        except SettleTimeout as e:
+            return f"Cannot export {table}: {e}", status.HTTP_503_SERVICE_UNAVAILABLE
+        except LedgerError as e:
+            return f"Cannot export {table}: {e}", status.HTTP_400_BAD_REQUEST
+        except psycopg2.Error as e:
+            return f"Cannot export {table}: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        
+        return (export, self.__ledger_chunks(export)), status.HTTP_200_OK
+    
+    
+    def __ledger_chunks(self, export):
+        # The watermark only moves once the last chunk has been handed to the response
+        try:
+            yield from export.chunks()
+            export.advance_watermark()
+        finally:
+            export.close()
+    
+    
+    @transactional
+    async def get_free_cars(self, start_date, end_date, after_car_id: int = None, page_size: int = 50):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM get_free_cars(%s, %s, %s, %s);
+            """, (start_date, end_date, after_car_id, page_size)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get free cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, await result.fetchall(), Cars)
+            
+            return cars, status.HTTP_200_OK
+    
+    
+    @cached("car_cache")
+    @transactional
+    async def get_available_car(self, car_id: int):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM get_available_car(%s);
+            """, (car_id,)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get available car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            row = await result.fetchone()
+            if row is None:
+                return f"Cannot get available car: Car with id {car_id} is not available", status.HTTP_400_BAD_REQUEST
+            
+            car = decode_row(result.description, row, CurrentCar)
+            
+            # get_available_car returns the car's version last
+            return (row[-1], car), status.HTTP_200_OK
+    
+    
+    @transactional
+    async def get_cars_by_ids(self, car_ids):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM get_cars_by_ids(%s);
+            """, (car_ids,)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, await result.fetchall(), CarDetails)
+            found_ids = {car.car_id for car in cars}
+            missing_ids = [car_id for car_id in dict.fromkeys(car_ids) if car_id not in found_ids]
+            
+            return CarBatch(cars=cars, missing_ids=missing_ids), status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def make_review(self, user_id: int, car_id: int, message: str):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT make_review(
+                    %s, %s, %s
+                ) AS id;
+            """, (
+                user_id, car_id, message
+                )
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot make review: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            self.invalidate_car(car_id)
+            review_id = (await result.fetchone())[0]
+            self.activity_log.record(user_id, f"review {review_id} of car {car_id}")
+            return {"id": review_id}, status.HTTP_200_OK
+    
+    
+    @transactional
+    async def get_reviews(self, car_id: int, before_review_id: int = None, page_size: int = 50):
+        try:
+            version = await self.__version("reviews", (car_id,))
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM get_reviews(%s, %s, %s);
+            """, (car_id, before_review_id, page_size)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get reviews: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            reviews = decode_rows(result.description, await result.fetchall(), Review)
+            
+            return (version, reviews), status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def add_to_favourites(self, user_id: int, car_id: int):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT add_to_favourites(
+                    %s, %s
+                ) AS id;
+            """, (user_id, car_id)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot add to favourites: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            return {"id": (await result.fetchone())[0]}, status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def get_favourites(self, user_id: int):
+        try:
+            version = await self.__version("favourites", (user_id,))
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT * FROM get_favourites(%s);
+            """, (user_id,)
+            )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get favourite cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, await result.fetchall(), Cars)
+            
+            return (version, cars), status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def get_favourites_version(self, user_id: int):
+        try:
+            version = await self.__version("favourites", (user_id,))
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get favourites version: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            return version, status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def get_owner_analytics(self, user_id: int):
+        try:
+            # Totals and per-car rows from one snapshot, so they add up under concurrent rentals
+            async with self.db_handler.snapshot():
+                totals = await self.db_handler.raw_sql(
+                """
+                    SELECT * FROM get_owner_analytics(%s);
+                """, (user_id,)
+                )
+                analytics = decode_row(totals.description, await totals.fetchone(), OwnerAnalytics)
+                
+                cars = await self.db_handler.raw_sql(
+                """
+                    SELECT * FROM get_car_analytics(%s);
+                """, (user_id,)
+                )
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot get analytics: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            
+            analytics.cars = decode_rows(cars.description, await cars.fetchall(), CarAnalytics)
+            
+            return analytics, status.HTTP_200_OK
+    
+    
+    @transactional
+    @verified_user
+    async def make_rent(self, user_id, car_id, rental_deal: RentalDeal):
+        try:
+            result = await self.db_handler.raw_sql(
+            """
+                SELECT make_rent(%s, %s, %s, %s, %s, %s);
+            """, (
+                user_id, car_id, rental_deal.start_location, rental_deal.end_location,
+                rental_deal.start_date, rental_deal.end_date
+                )
+            )
+        except psycopg.errors.ExclusionViolation:
+            await self.db_handler.connection.rollback()
+            return (
+                f"Cannot make rent: Car {car_id} is already rented between "
+                f"{rental_deal.start_date} and {rental_deal.end_date}"
+            ), status.HTTP_409_CONFLICT
+        except psycopg.Error as e:
+            await self.db_handler.connection.rollback()
+            return f"Cannot make rent: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            await self.db_handler.connection.commit()
+            self.invalidate_car(car_id)
+            deal_id = (await result.fetchone())[0]
+            self.activity_log.record(
+                user_id, f"rent car {car_id} from {rental_deal.start_date} to {rental_deal.end_date}, deal {deal_id}"
+            )
+            return {"id": deal_id}, status.HTTP_200_OK
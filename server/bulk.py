@@ -0,0 +1,281 @@
+import io
+import re
+import csv
+import json
+import psycopg2
+from server.models import AddCar
+
+
+JSON_LINES_CONTENT_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-lines")
+CSV_CONTENT_TYPES = ("text/csv",)
+
+# Several image urls share one CSV cell
+CSV_IMAGES_SEPARATOR = "|"
+
+# Same rules as the validate_add_car procedure
+REGISTRATION_PLATE_PATTERN = re.compile(r"^[0-9]{4} [A-Z]{2}-[0-9]{1}$")
+MAX_MODEL_LENGTH = 50
+MAX_DESCRIPTION_LENGTH = 500
+MAX_IMAGE_URL_LENGTH = 200
+
+
+def copy_rows(rows):
+    # Read by COPY ... WITH (FORMAT csv), the csv module does the quoting
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+def parse_json_lines(body: bytes):
+    for row_number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            yield row_number, json.loads(line), None
+        except ValueError as e:
+            yield row_number, None, f"Invalid JSON: {e}"
+
+
+def parse_csv(body: bytes):
+    reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+    for row_number, record in enumerate(reader, start=1):
+        images = record.pop("images", None)
+        if images:
+            record["images"] = [url.strip() for url in images.split(CSV_IMAGES_SEPARATOR) if url.strip()]
+        yield row_number, record, None
+
+
+def parse_rows(body: bytes, content_type: str):
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in JSON_LINES_CONTENT_TYPES:
+        return parse_json_lines(body)
+    if media_type in CSV_CONTENT_TYPES:
+        return parse_csv(body)
+    raise ValueError(
+        f"Unsupported content type '{media_type}', "
+        f"expected one of {', '.join(JSON_LINES_CONTENT_TYPES + CSV_CONTENT_TYPES)}"
+    )
+
+
+def validation_message(error):
+    if hasattr(error, "errors"):
+        return "; ".join(
+            f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}" for detail in error.errors()
+        )
+    return str(error)
+
+
+class BulkCarImporter(object):
+
+    def __init__(self, transaction, reference_cache, chunk_size=1000):
+        # transaction() opens a scope yielding a psycopg2 connection, DatabaseHandler.transaction in the sync app
+        self.transaction = transaction
+        self.reference_cache = reference_cache
+        self.chunk_size = chunk_size
+
+
+    def validate(self, record):
+        car = AddCar.model_validate(record)
+
+        if car.type_name not in self.reference_cache.enum_labels("CAR_TYPE"):
+            raise ValueError(f"Unknown car type '{car.type_name}'")
+        if car.brand not in self.reference_cache.enum_labels("CAR_BRAND"):
+            raise ValueError(f"Unknown brand '{car.brand}'")
+        if car.fuel_type not in self.reference_cache.enum_labels("FUEL_TYPE"):
+            raise ValueError(f"Unknown fuel type '{car.fuel_type}'")
+        if len(car.model) > MAX_MODEL_LENGTH:
+            raise ValueError(f"Brands model length should not exceed {MAX_MODEL_LENGTH} characters.")
+        if not REGISTRATION_PLATE_PATTERN.match(car.registration_plate):
+            raise ValueError("Invalid registration plate format. Example: 1234 AB-1")
+        if car.price_per_day <= 0:
+            raise ValueError("Price per day should be a positive number.")
+        if len(car.description) > MAX_DESCRIPTION_LENGTH:
+            raise ValueError(f"Cars description length should not exceed {MAX_DESCRIPTION_LENGTH} characters.")
+        if any(len(url) > MAX_IMAGE_URL_LENGTH for url in car.images):
+            raise ValueError(f"Image url length should not exceed {MAX_IMAGE_URL_LENGTH} characters.")
+        return car
+
+
+    def import_cars(self, user_id: int, rows):
+        with self.transaction() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("CALL check_user_status(%s);", (user_id,))
+            connection.commit()
+
+        result = {"inserted": 0, "ids": [], "errors": []}
+        seen_plates = set()
+        chunk = []
+
+        for row_number, record, error in rows:
+            if error is None:
+                try:
+                    car = self.validate(record)
+                except ValueError as e:
+                    error = validation_message(e)
+                else:
+                    if car.registration_plate in seen_plates:
+                        error = f"Registration plate {car.registration_plate} repeats an earlier row"
+                    seen_plates.add(car.registration_plate)
+
+            if error is not None:
+                result["errors"].append({"row": row_number, "detail": error})
+                continue
+
+            chunk.append((row_number, car))
+            if len(chunk) >= self.chunk_size:
+                self.__load_chunk(user_id, chunk, result)
+                chunk = []
+
+        if chunk:
+            self.__load_chunk(user_id, chunk, result)
+
+        result["errors"].sort(key=lambda error: error["row"])
+        return result
+
+
+    def __load_chunk(self, user_id: int, chunk, result):
+        try:
+            try:
+                car_ids, resolved = self.__insert_chunk(user_id, chunk, use_cache=True)
+            except psycopg2.errors.ForeignKeyViolation:
+                # A cached lookup id no longer exists, resolve all of them in the database
+                self.reference_cache.invalidate()
+                car_ids, resolved = self.__insert_chunk(user_id, chunk, use_cache=False)
+        except psycopg2.Error as e:
+            message = f"Cannot add car: {e}".split('\n')[0]
+            result["errors"].extend({"row": row_number, "detail": message} for row_number, _ in chunk)
+            return
+
+        if resolved:
+            self.reference_cache.invalidate()
+
+        for row_number, car in chunk:
+            car_id = car_ids.get(car.registration_plate)
+            if car_id is None:
+                result["errors"].append({
+                    "row": row_number,
+                    "detail": f"Cannot add car: registration plate {car.registration_plate} already exists",
+                })
+            else:
+                result["ids"].append(car_id)
+                result["inserted"] += 1
+
+
+    def __insert_chunk(self, user_id: int, chunk, use_cache):
+        with self.transaction() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    reference_ids, resolved = self.__reference_ids(cursor, [car for _, car in chunk], use_cache)
+
+                    cursor.execute("SET LOCAL app.bulk_import = 'on';")
+                    cursor.execute(
+                    """
+                        CREATE TEMPORARY TABLE bulk_cars (
+                            position INT NOT NULL,
+                            car_type_id INT NOT NULL,
+                            brand_id INT NOT NULL,
+                            fuel_type_id INT NOT NULL,
+                            registration_plate VARCHAR(9) NOT NULL,
+                            price_per_day NUMERIC NOT NULL,
+                            description VARCHAR(500)
+                        ) ON COMMIT DROP;
+
+                        CREATE TEMPORARY TABLE bulk_car_images (
+                            car_position INT NOT NULL,
+                            position INT NOT NULL,
+                            url VARCHAR(200) NOT NULL
+                        ) ON COMMIT DROP;
+                    """
+                    )
+                    cursor.copy_expert("COPY bulk_cars FROM STDIN WITH (FORMAT csv);", copy_rows(
+                        (position, *ids, car.registration_plate, car.price_per_day, car.description)
+                        for position, ((_, car), ids) in enumerate(zip(chunk, reference_ids))
+                    ))
+                    cursor.copy_expert("COPY bulk_car_images FROM STDIN WITH (FORMAT csv);", copy_rows(
+                        (car_position, position, url)
+                        for car_position, (_, car) in enumerate(chunk)
+                        for position, url in enumerate(car.images)
+                    ))
+
+                    # Rows go in import order, so the first image of a car gets its lowest id and stays the main one
+                    cursor.execute(
+                    """
+                        WITH inserted AS (
+                            INSERT INTO cars (
+                                owner_id, car_type_id, brand_id, fuel_type_id,
+                                registration_plate, price_per_day, description
+                            )
+                            SELECT %s, car_type_id, brand_id, fuel_type_id, registration_plate, price_per_day, description
+                            FROM bulk_cars
+                            ORDER BY position
+                            ON CONFLICT (registration_plate) DO NOTHING
+                            RETURNING id, registration_plate
+                        ), images AS (
+                            INSERT INTO car_images (car_id, url)
+                            SELECT inserted.id, bulk_car_images.url
+                            FROM inserted
+                            JOIN bulk_cars ON bulk_cars.registration_plate = inserted.registration_plate
+                            JOIN bulk_car_images ON bulk_car_images.car_position = bulk_cars.position
+                            ORDER BY bulk_cars.position, bulk_car_images.position
+                        )
+                        SELECT registration_plate, id FROM inserted;
+                    """, (user_id,)
+                    )
+                    car_ids = dict(cursor.fetchall())
+
+                    # Done here once instead of by the row triggers, see app.bulk_import
+                    if car_ids:
+                        cursor.execute("UPDATE users SET is_owner = TRUE WHERE id = %s AND NOT is_owner;", (user_id,))
+                        cursor.execute("SELECT pg_notify('car_changes', '');")
+            except psycopg2.Error:
+                connection.rollback()
+                raise
+            connection.commit()
+        return car_ids, resolved
+
+
+    def __reference_ids(self, cursor, cars, use_cache):
+        car_types, brands, fuel_types = {}, {}, {}
+        for car in cars:
+            car_type_id, brand_id, fuel_type_id = (
+                self.reference_cache.car_ids(car.type_name, car.brand, car.model, car.fuel_type)
+                if use_cache else (None, None, None)
+            )
+            car_types[car.type_name] = car_type_id
+            brands[(car.brand, car.model)] = brand_id
+            fuel_types[car.fuel_type] = fuel_type_id
+
+        missing_car_types = [name for name, car_type_id in car_types.items() if car_type_id is None]
+        missing_brands = [key for key, brand_id in brands.items() if brand_id is None]
+        missing_fuel_types = [name for name, fuel_type_id in fuel_types.items() if fuel_type_id is None]
+
+        # One upsert round trip per dimension, only for values the cache does not know yet
+        if missing_car_types:
+            cursor.execute(
+                "SELECT name, create_car_type(name::CAR_TYPE) FROM unnest(%s::text[]) AS name;",
+                (missing_car_types,)
+            )
+            car_types.update(cursor.fetchall())
+        if missing_brands:
+            cursor.execute(
+                """
+                    SELECT name, model, create_brand(name::CAR_BRAND, model)
+                    FROM unnest(%s::text[], %s::varchar[]) AS brand (name, model);
+                """,
+                ([name for name, _ in missing_brands], [model for _, model in missing_brands])
+            )
+            brands.update(((name, model), brand_id) for name, model, brand_id in cursor.fetchall())
+        if missing_fuel_types:
+            cursor.execute(
+                "SELECT name, create_fuel_type(name::FUEL_TYPE) FROM unnest(%s::text[]) AS name;",
+                (missing_fuel_types,)
+            )
+            fuel_types.update(cursor.fetchall())
+
+        reference_ids = [
+            (car_types[car.type_name], brands[(car.brand, car.model)], fuel_types[car.fuel_type])
+            for car in cars
+        ]
+        resolved = bool(missing_car_types or missing_brands or missing_fuel_types)
+        return reference_ids, resolved
@@ -0,0 +1,158 @@
+import time
+import select
+import threading
+from collections import OrderedDict
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+
+MISSING = object()
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size=1024, ttl=60.0):
+        if max_size < 1:
+            raise ValueError("Cache size should be a positive number")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.__entries = OrderedDict()
+        self.__generation = 0
+        self.__lock = threading.Lock()
+
+
+    @property
+    def generation(self):
+        return self.__generation
+
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.__entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value, generation=None):
+        with self.__lock:
+            # A write happened while the value was being loaded, so it may already be stale
+            if generation is not None and generation != self.__generation:
+                return
+
+            self.__entries[key] = (value, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__generation += 1
+            if self.__entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.invalidations += len(self.__entries)
+            self.__entries.clear()
+
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+class NotifyListener(object):
+
+    def __init__(self, connect, poll_interval=5.0, reconnect_delay=1.0):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+        self.__callbacks = {}
+        self.__on_reconnect = []
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+
+    def subscribe(self, channel, callback, on_reconnect=None):
+        self.__callbacks.setdefault(channel, []).append(callback)
+        if on_reconnect is not None:
+            self.__on_reconnect.append(on_reconnect)
+
+
+    def start(self):
+        if self.__thread is not None or not self.__callbacks:
+            return
+
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name="notify-listener", daemon=True)
+        self.__thread.start()
+
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=self.poll_interval + 1)
+            self.__thread = None
+
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            connection = None
+            try:
+                connection = self.connect()
+                connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as cursor:
+                    for channel in self.__callbacks:
+                        cursor.execute(f"LISTEN {channel};")
+
+                # Notifications sent while we were disconnected are lost
+                for callback in self.__on_reconnect:
+                    callback()
+
+                while not self.__stopped.is_set():
+                    if select.select([connection], [], [], self.poll_interval) == ([], [], []):
+                        continue
+
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        for callback in self.__callbacks.get(notify.channel, []):
+                            callback(notify.payload)
+            except (psycopg2.Error, OSError) as e:
+                print(f"Notify listener error '{e}', reconnecting")
+                self.__stopped.wait(self.reconnect_delay)
+            finally:
+                if connection is not None:
+                    connection.close()
@@ -1,46 +1,550 @@
+import os
+import re
+import time
+import weakref
+import itertools
+import threading
+from contextlib import contextmanager
+import functools
 import psycopg2
 from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, cursor, parse_dsn
+from psycopg2.pool import PoolError
+from server.migrations import MigrationRunner
+
+
+# Sent ahead of a statement in the same round trip, lasts until its commit
+VERIFIED_USER_SQL = "SELECT set_config('app.verified_user_id', %s, true);\n"
+
+PLACEHOLDER_PATTERN = re.compile(r"%(%|s)")
+
+# Seconds the replica's last replayed transaction is behind, 0 once it has
+# replayed everything it received, which an idle primary leaves it at
+REPLICATION_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+
+def positional_parameters(query):
+    # "%s" placeholders to the "$1", "$2", ... PREPARE takes, "%%" back to "%"
+    numbers = itertools.count(1)
+    return PLACEHOLDER_PATTERN.sub(lambda match: "%" if match.group(1) == "%" else f"${next(numbers)}", query)
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class InstrumentedCursor(cursor):
+
+    def __init__(self, connection, name=None, metrics=None):
+        super().__init__(connection, name)
+        self.metrics = metrics
+
+
+    def __query_text(self, query):
+        if isinstance(query, str):
+            return query
+        if isinstance(query, bytes):
+            return query.decode()
+        return query.as_string(self)
+
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            result = cursor.execute(self, query, vars)
+        except psycopg2.Error as e:
+            self.metrics.observe_query(self.__query_text(query), time.perf_counter() - started, error=e)
+            raise
+        self.metrics.observe_query(self.__query_text(query), time.perf_counter() - started, self.rowcount)
+        return result
+
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            result = cursor.copy_expert(self, sql, file, size)
+        except psycopg2.Error as e:
+            self.metrics.observe_query(self.__query_text(sql), time.perf_counter() - started, error=e)
+            raise
+        self.metrics.observe_query(self.__query_text(sql), time.perf_counter() - started, self.rowcount)
+        return result
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0, health_check_interval=30.0, metrics=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool size must satisfy 0 <= min_size <= max_size and max_size >= 1")
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.metrics = metrics
+        self.__idle = []
+        self.__size = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        # Connections do not survive a fork, the socket would be shared with the parent
+        self.__pid = os.getpid()
+
+        for _ in range(self.min_size):
+            self.__size += 1
+            self.__idle.append((self.__open_connection(), time.monotonic()))
+
+
+    @property
+    def size(self):
+        return self.__size
+
+
+    @property
+    def idle(self):
+        return len(self.__idle)
+
+
+    def __open_connection(self):
+        try:
+            return self.connect()
+        except Exception:
+            with self.__condition:
+                self.__size -= 1
+                self.__condition.notify()
+            raise
+
+
+    def __is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+    def __discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+        with self.__condition:
+            self.__size -= 1
+            self.__condition.notify()
+
+
+    def getconn(self, timeout=None):
+        if self.metrics is None:
+            return self.__getconn(timeout)
+
+        started = time.perf_counter()
+        try:
+            connection = self.__getconn(timeout)
+        except PoolTimeout:
+            self.metrics.pool_timeouts.inc()
+            raise
+        self.metrics.pool_wait.observe(time.perf_counter() - started)
+        return connection
+
+
+    def __getconn(self, timeout=None):
+        if os.getpid() != self.__pid:
+            raise PoolError("Connection pool was opened before a fork, open one in each worker process")
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            with self.__condition:
+                while True:
+                    if self.__closed:
+                        raise PoolError("Connection pool is closed")
+                    if self.__idle:
+                        connection, last_used = self.__idle.pop()
+                        break
+                    if self.__size < self.max_size:
+                        self.__size += 1
+                        connection, last_used = None, None
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            f"Could not get a connection within {timeout} seconds "
+                            f"({self.max_size} connections in use)"
+                        )
+                    self.__condition.wait(remaining)
+
+            if connection is None:
+                return self.__open_connection()
+
+            if self.__is_healthy(connection, last_used):
+                return connection
+
+            self.__discard(connection)
+
+
+    def putconn(self, connection, discard=False):
+        if not discard and not connection.closed:
+            try:
+                if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or connection.closed or self.__closed:
+            self.__discard(connection)
+            return
+
+        with self.__condition:
+            self.__idle.append((connection, time.monotonic()))
+            self.__condition.notify()
+
+
+    def closeall(self):
+        with self.__condition:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__condition.notify_all()
+
+        for connection, _ in idle:
+            connection.close()
+
+
+class Replica(object):
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+        # Seconds behind the primary when last checked, and when that was
+        self.lag = 0.0
+        self.checked_at = None
+
+
+    def check_due(self, interval):
+        return self.checked_at is None or time.monotonic() - self.checked_at >= interval
+
+
+    def usable(self, max_lag):
+        return self.healthy and self.lag <= max_lag
 
 
 class DatabaseHandler(object):
-    
-    def __init__(self, db_name, db_user, db_password, db_host, db_port):
+
+    def __init__(self, db_name, db_user, db_password, db_host, db_port,
+                 pool_min_size=1, pool_max_size=10, pool_timeout=30.0, pool_health_check_interval=30.0,
+                 metrics=None, dsn=None, replica_dsns=(), max_replica_lag=5.0, replica_check_interval=1.0, lazy=False):
         self.db_name = db_name
         self.db_user = db_user
         self.db_password = db_password
         self.db_host = db_host
         self.db_port = db_port
-        self.connection = self.__create_db_connection()
-        self.__init_db()
-        
-        
-    def __create_db_connection(self):
+        self.metrics = metrics
+        # Settings the DSN leaves out come from the separate arguments
+        self.__primary_params = {
+            key: value for key, value in (
+                ("dbname", db_name), ("user", db_user), ("password", db_password), ("host", db_host), ("port", db_port)
+            ) if value is not None
+        }
+        self.__primary_params.update(parse_dsn(dsn) if dsn else {})
+        self.max_replica_lag = max_replica_lag
+        self.replica_check_interval = replica_check_interval
+        # Every statement of every connection is timed, service queries, bulk COPYs and migrations alike
+        self.__cursor_factory = functools.partial(InstrumentedCursor, metrics=metrics) if metrics is not None else None
+        self.__local = threading.local()
+        # Names prepared on each connection. A connection the pool discards
+        # drops out with its entry, its replacement prepares them again
+        self.__prepared = weakref.WeakKeyDictionary()
+        self.__prepared_lock = threading.Lock()
+        self.__pool_settings = {
+            "min_size": pool_min_size,
+            "max_size": pool_max_size,
+            "timeout": pool_timeout,
+            "health_check_interval": pool_health_check_interval,
+        }
+        self.__replica_dsns = list(replica_dsns)
+        self.pool = None
+        self.replicas = []
+        # Lazy handlers connect on open(), after a server forks its workers
+        if not lazy:
+            self.open()
+
+
+    def open(self, migrate=True):
+        if self.pool is not None:
+            return
+
+        self.pool = ConnectionPool(self.__create_db_connection, metrics=self.metrics, **self.__pool_settings)
+        # Replicas inherit whatever their DSN leaves out, the database and credentials usually
+        for replica_dsn in self.__replica_dsns:
+            params = {**self.__primary_params, **parse_dsn(replica_dsn)}
+            self.replicas.append(Replica(
+                f"{params.get('host', 'localhost')}:{params.get('port', 5432)}",
+                ConnectionPool(
+                    functools.partial(self.__create_db_connection, params, read_only=True),
+                    # Replicas that are down are skipped, nothing is opened up front
+                    **{**self.__pool_settings, "min_size": 0},
+                ),
+            ))
+        self.__replica_order = itertools.cycle(self.replicas)
+        if self.metrics is not None:
+            self.metrics.watch_pool(self.pool)
+            self.metrics.watch_replicas(self.replicas)
+        if migrate:
+            self.migrate()
+
+
+    def __create_db_connection(self, params=None, read_only=False):
         connection = None
         print("==========================================")
         try:
-            connection = psycopg2.connect(
-                database = self.db_name,
-                user = self.db_user,
-                password = self.db_password,
-                host = self.db_host,
-                port = self.db_port,
-            )
+            connection = psycopg2.connect(cursor_factory=self.__cursor_factory, **(params or self.__primary_params))
+            if read_only:
+                # Fails writes on a replica that is not a hot standby too
+                connection.set_session(readonly=True)
             print("Connection to PostgreSQL DB successful")
         except OperationalError as e:
             print(f"The error '{e}' occurred")
-        print("==========================================")
+            raise
+        finally:
+            print("==========================================")
+        return connection
+
+
+    def connect(self):
+        return self.__create_db_connection()
+
+
+    @property
+    def connection(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            raise RuntimeError("No transaction scope is active in this thread")
         return connection
-    
-    
+
+
+    @property
+    def read_only(self):
+        return getattr(self.__local, "read_only", False)
+
+
+    @contextmanager
+    def transaction(self, read_only=False, primary=False):
+        # Read-only scopes are served by a replica unless the caller needs the primary's latest writes
+        if getattr(self.__local, "connection", None) is not None:
+            yield self.__local.connection
+            return
+
+        pool, connection = self.__replica_connection() if read_only and not primary else (None, None)
+        if connection is None:
+            pool, connection = self.pool, self.pool.getconn()
+        self.__local.connection = connection
+        self.__local.read_only = read_only
+        try:
+            yield connection
+        finally:
+            self.__local.connection = None
+            self.__local.read_only = False
+            pool.putconn(connection)
+
+
+    def __replication_lag(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(REPLICATION_LAG_SQL)
+            lag = float(cursor.fetchone()[0])
+        connection.rollback()
+        return lag
+
+
+    def __replica_connection(self):
+        # Round robin over the replicas that answer and are at most max_replica_lag
+        # seconds behind, checked once every replica_check_interval on the connection
+        # borrowed for a read. (None, None) sends the read to the primary
+        for _ in range(len(self.replicas)):
+            replica = next(self.__replica_order)
+            check_due = replica.check_due(self.replica_check_interval)
+            if not check_due and not replica.usable(self.max_replica_lag):
+                continue
+
+            try:
+                connection = replica.pool.getconn()
+            except OperationalError:
+                replica.healthy, replica.checked_at = False, time.monotonic()
+                continue
+            except PoolError:
+                continue
+
+            if check_due:
+                try:
+                    replica.lag = self.__replication_lag(connection)
+                    replica.healthy = True
+                except psycopg2.Error:
+                    replica.pool.putconn(connection, discard=True)
+                    replica.healthy = False
+                    continue
+                finally:
+                    replica.checked_at = time.monotonic()
+
+                if not replica.usable(self.max_replica_lag):
+                    replica.pool.putconn(connection)
+                    continue
+
+            return replica.pool, connection
+        return None, None
+
+
+    @contextmanager
+    def verified_user(self, user_id):
+        # check_user_status skips the user the caller already checked
+        self.__local.verified_user_id = user_id
+        try:
+            yield
+        finally:
+            self.__local.verified_user_id = None
+
+
+    @contextmanager
+    def snapshot(self):
+        # Statements in the block share one REPEATABLE READ transaction instead
+        # of committing one by one, the caller commits or rolls it back
+        connection = self.connection
+        if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            connection.commit()
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        self.__local.snapshot = True
+        try:
+            yield connection
+        finally:
+            self.__local.snapshot = False
+
+
+    def __execute(self, connection, query, params):
+        verified_user_id = getattr(self.__local, "verified_user_id", None)
+        if verified_user_id is not None:
+            query = VERIFIED_USER_SQL + query
+            params = (str(verified_user_id), *(params or ()))
+
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        if not getattr(self.__local, "snapshot", False):
+            connection.commit()
+        return cursor
+
+
     def raw_sql(self, query, params=None):
-        cursor = self.connection.cursor()
+        with self.transaction() as connection:
+            try:
+                return self.__execute(connection, query, params)
+            except OperationalError as e:
+                return None, e
+
+
+    def __prepared_names(self, connection):
+        with self.__prepared_lock:
+            return self.__prepared.setdefault(connection, set())
+
+
+    def prepared_sql(self, name, query, params=()):
+        # Same as raw_sql, but the statement is parsed and planned once per
+        # connection, as name, and then only executed
+        execute = f"EXECUTE {name}({', '.join(['%s'] * len(params))});" if params else f"EXECUTE {name};"
+
+        with self.transaction() as connection:
+            prepared = self.__prepared_names(connection)
+            try:
+                if name not in prepared:
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"PREPARE {name} AS {positional_parameters(query.strip().rstrip(';'))};")
+                    prepared.add(name)
+
+                try:
+                    return self.__execute(connection, execute, params)
+                except psycopg2.errors.InvalidSqlStatementName:
+                    # Deallocated behind the registry's back, by DISCARD ALL or DEALLOCATE
+                    connection.rollback()
+                    prepared.discard(name)
+                    return self.prepared_sql(name, query, params)
+            except OperationalError as e:
+                return None, e
+
+
+    def stream(self, query, params=None, batch_size=1000, read_only=False):
+        # Yields the column description once, then lists of at most batch_size rows.
+        # Holds its own connection instead of the thread-local scope: a streaming
+        # response resumes the generator on whichever threadpool thread is free
+        pool, connection = self.__replica_connection() if read_only else (None, None)
+        if connection is None:
+            pool, connection = self.pool, self.pool.getconn()
         try:
-            cursor.execute(query, params)
-            self.connection.commit()
-            return cursor
-        except OperationalError as e:
-            return None, e
-    
-    
-    def __init_db(self):
-        self.raw_sql(open("server/sql/init_db.sql", "r").read())
\ No newline at end of file
+            with connection.cursor(name="stream") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(query, params)
+                rows = cursor.fetchmany(batch_size)
+                yield cursor.description
+
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(batch_size)
+        finally:
+            # Read only, putconn rolls the transaction back
+            pool.putconn(connection)
+
+
+    def pool_state(self):
+        if self.pool is None:
+            return {"primary": None, "replicas": []}
+
+        return {
+            "primary": {"size": self.pool.size, "idle": self.pool.idle, "max_size": self.pool.max_size},
+            "replicas": [
+                {
+                    "name": replica.name,
+                    "healthy": replica.healthy,
+                    "lag": replica.lag,
+                    "size": replica.pool.size,
+                    "idle": replica.pool.idle,
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+    def ping(self, timeout=1.0):
+        # Waits at most timeout for a pooled connection, a saturated pool is not ready for more requests
+        connection = self.pool.getconn(timeout)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+        except psycopg2.Error:
+            self.pool.putconn(connection, discard=True)
+            raise
+        self.pool.putconn(connection)
+
+
+    def close(self):
+        if self.pool is None:
+            return
+
+        self.pool.closeall()
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+
+    def migrate(self):
+        return MigrationRunner(self.connect).run()
@@ -0,0 +1,42 @@
+import functools
+from typing import List
+from pydantic import TypeAdapter
+
+
+def column_names(description):
+    return [column[0] for column in description]
+
+
+@functools.lru_cache(maxsize=None)
+def type_adapter(pydantic_type):
+    return TypeAdapter(pydantic_type)
+
+
+def decode_row(description, row, pydantic_model):
+    return pydantic_model.model_validate(dict(zip(column_names(description), row)))
+
+
+def decode_rows(description, rows, pydantic_model):
+    names = column_names(description)
+    return type_adapter(List[pydantic_model]).validate_python([dict(zip(names, row)) for row in rows])
+
+
+def encode_json(data, pydantic_type):
+    return type_adapter(pydantic_type).dump_json(data)
+
+
+def encode_json_lines(batches, pydantic_type):
+    adapter = type_adapter(pydantic_type)
+    for batch in batches:
+        yield b"".join(adapter.dump_json(item) + b"\n" for item in batch)
+
+
+def encode_json_array(batches, pydantic_type):
+    # Same output as encode_json on the whole list, one chunk per batch
+    adapter = type_adapter(pydantic_type)
+    separator = b"["
+    for batch in batches:
+        if batch:
+            yield separator + b",".join(adapter.dump_json(item) for item in batch)
+            separator = b","
+    yield b"[]" if separator == b"[" else b"]"
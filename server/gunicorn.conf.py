@@ -0,0 +1,29 @@
+# Production launch: gunicorn -c server/gunicorn.conf.py server.main:app
+import os
+import multiprocessing
+
+
+bind = os.getenv("BIND", f"{os.getenv('MAIN_HOST', '0.0.0.0')}:{os.getenv('MAIN_PORT', 8000)}")
+# One worker per core, request handlers hold the GIL for most of a cached read
+workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+worker_class = "uvicorn.workers.UvicornWorker"
+# The app is imported once in the master and forked, ServiceHandler connects
+# in each worker's startup. Under APP_ENV=development without SESSION_SECRET,
+# workers share the master's random secret
+preload_app = True
+# On SIGTERM or SIGHUP a worker stops accepting, finishes its requests for at
+# most this long, then closes its pools
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+keepalive = int(os.getenv("KEEPALIVE_TIMEOUT", 5))
+accesslog = os.getenv("ACCESS_LOG") or None
+
+# Read by ServiceHandler when the master imports the app
+os.environ["MIGRATE_ON_STARTUP"] = "0"
+
+
+def on_starting(server):
+    # Once, before any worker exists, a failing migration stops the server here
+    from server.main import serv_handler
+    applied = serv_handler.db_handler.migrate()
+    server.log.info("Applied migrations: %s", applied if applied else "none, schema is up to date")
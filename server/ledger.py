@@ -0,0 +1,407 @@
+import io
+import os
+import sys
+import time
+import argparse
+from datetime import date
+import psycopg2
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = ("csv", "parquet")
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Finance columns carry more decimals than any price here has
+PARQUET_DECIMAL_SCALE = 10
+
+COPY_CHUNK_SQL = """
+    COPY (
+        SELECT {columns} FROM {source}
+        WHERE {table}.id > %(after_id)s AND {table}.id <= %(upper_id)s{date_filter}
+        ORDER BY {table}.id
+        LIMIT %(chunk_size)s
+    ) TO STDOUT WITH (FORMAT csv);
+"""
+
+# The sequence is read before the lock holders, any transaction that already
+# holds an id up to it has taken its row exclusive lock on the table and is
+# then either finished or among them
+LAST_ALLOCATED_ID_SQL = """
+    SELECT COALESCE(pg_sequence_last_value(pg_get_serial_sequence(%s, 'id')::regclass), 0);
+"""
+WRITERS_SQL = """
+    SELECT ARRAY(
+        SELECT DISTINCT virtualtransaction FROM pg_locks
+        WHERE locktype = 'relation' AND relation = %s::regclass AND mode = 'RowExclusiveLock' AND granted
+            AND pid IS DISTINCT FROM pg_backend_pid()
+    );
+"""
+STILL_WRITING_SQL = """
+    SELECT COUNT(DISTINCT virtualtransaction) FROM pg_locks
+    WHERE locktype = 'relation' AND relation = %s::regclass AND mode = 'RowExclusiveLock'
+        AND virtualtransaction = ANY(%s);
+"""
+
+SETTLE_POLL_INTERVAL = 0.05
+
+
+class LedgerError(Exception):
+    pass
+
+
+class SettleTimeout(LedgerError):
+    pass
+
+
+class LedgerTable(object):
+
+    def __init__(self, name, columns, date_column, source=None):
+        self.name = name
+        # (column, kind), kind is one of int, numeric, date, timestamp, text
+        self.columns = columns
+        # The business date a --from/--to range is matched against
+        self.date_column = date_column
+        self.source = source or name
+
+
+    def select_list(self, fmt):
+        expressions = []
+        for column, kind in self.columns:
+            expression = f"{self.name}.{column}"
+            # Parsed by pyarrow: fixed-scale decimals and ISO timestamps in UTC
+            if fmt == "parquet" and kind == "numeric":
+                expression = f"{expression}::NUMERIC(38, {PARQUET_DECIMAL_SCALE})"
+            elif fmt == "parquet" and kind == "timestamp":
+                expression = f"""to_char({expression} AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"')"""
+            expressions.append(expression)
+        return ", ".join(expressions)
+
+
+    def arrow_schema(self):
+        types = {
+            "int": pyarrow.int64(),
+            "numeric": pyarrow.decimal128(38, PARQUET_DECIMAL_SCALE),
+            "date": pyarrow.date32(),
+            "timestamp": pyarrow.timestamp("us", tz="UTC"),
+            "text": pyarrow.string(),
+        }
+        return pyarrow.schema([(column, types[kind]) for column, kind in self.columns])
+
+
+LEDGER_TABLES = {
+    table.name: table for table in (
+        LedgerTable(
+            "payments",
+            [("id", "int"), ("user_id", "int"), ("payed_price", "numeric"), ("time", "timestamp")],
+            date_column="payments.time::DATE",
+        ),
+        LedgerTable(
+            "rental_deals",
+            [
+                ("id", "int"), ("user_id", "int"), ("car_id", "int"), ("pick_up_id", "int"),
+                ("start_date", "date"), ("end_date", "date"), ("total_price", "numeric"), ("status", "text"),
+            ],
+            date_column="rental_deals.start_date",
+        ),
+        # Taxes have no date of their own, they go with their deal's
+        LedgerTable(
+            "taxes",
+            [("id", "int"), ("rental_deal_id", "int"), ("price", "numeric")],
+            date_column="rental_deals.start_date",
+            source="taxes JOIN rental_deals ON rental_deals.id = taxes.rental_deal_id",
+        ),
+    )
+}
+
+
+class ChunkSink(io.RawIOBase):
+    # What ParquetWriter has written since the last take(), tell() counts from the start of the file
+
+    def __init__(self):
+        super().__init__()
+        self.__pending = []
+        self.__position = 0
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, data):
+        self.__pending.append(bytes(data))
+        self.__position += len(data)
+        return len(data)
+
+
+    def tell(self):
+        return self.__position
+
+
+    def take(self):
+        data, self.__pending = b"".join(self.__pending), []
+        return data
+
+
+class LedgerExport(object):
+    # One run over (after_id, upper_id] of a table, a chunk_size rows COPY per short transaction
+
+    def __init__(self, connection, table, fmt, after_id, upper_id, date_from=None, date_to=None,
+                 watermark=None, chunk_size=10000):
+        self.connection = connection
+        self.table = table
+        self.fmt = fmt
+        self.after_id = after_id
+        self.upper_id = upper_id
+        self.date_from = date_from
+        self.date_to = date_to
+        self.watermark = watermark
+        self.chunk_size = chunk_size
+        self.rows = 0
+
+
+    @property
+    def media_type(self):
+        return MEDIA_TYPES[self.fmt]
+
+
+    @property
+    def filename(self):
+        parts = [self.table.name, self.watermark, self.date_from, self.date_to, f"{self.after_id + 1}-{self.upper_id}"]
+        return "_".join(str(part) for part in parts if part is not None) + f".{self.fmt}"
+
+
+    def __copy_chunk(self, after_id):
+        date_filter = ""
+        if self.date_from is not None:
+            date_filter += f" AND {self.table.date_column} >= %(date_from)s"
+        if self.date_to is not None:
+            date_filter += f" AND {self.table.date_column} <= %(date_to)s"
+        query = COPY_CHUNK_SQL.format(
+            columns=self.table.select_list(self.fmt), source=self.table.source, table=self.table.name,
+            date_filter=date_filter,
+        )
+
+        buffer = io.BytesIO()
+        with self.connection.cursor() as cursor:
+            # COPY takes no parameters, they are bound client side
+            cursor.copy_expert(cursor.mogrify(query, {
+                "after_id": after_id, "upper_id": self.upper_id, "chunk_size": self.chunk_size,
+                "date_from": self.date_from, "date_to": self.date_to,
+            }).decode(), buffer)
+            rows = cursor.rowcount
+        # Each chunk is its own transaction, no snapshot or lock outlives it
+        self.connection.commit()
+        return buffer.getvalue(), rows
+
+
+    def __csv_chunks(self):
+        # The id leads every row, the last one is where the next chunk starts
+        after_id = self.after_id
+        while True:
+            data, rows = self.__copy_chunk(after_id)
+            if rows <= 0:
+                return
+            self.rows += rows
+            yield data
+            if rows < self.chunk_size:
+                return
+            last_row = data[data.rstrip(b"\n").rfind(b"\n") + 1:]
+            after_id = int(last_row.split(b",", 1)[0])
+
+
+    def chunks(self):
+        if self.fmt == "csv":
+            yield (",".join(column for column, _ in self.table.columns) + "\n").encode()
+            yield from self.__csv_chunks()
+        else:
+            yield from self.__parquet_chunks()
+
+
+    def __parquet_chunks(self):
+        # One row group per chunk, only the chunk being converted is held in memory
+        schema = self.table.arrow_schema()
+        convert_options = pyarrow.csv.ConvertOptions(column_types=schema)
+        read_options = pyarrow.csv.ReadOptions(column_names=schema.names)
+        sink = ChunkSink()
+        with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+            for data in self.__csv_chunks():
+                writer.write_table(pyarrow.csv.read_csv(
+                    io.BytesIO(data), read_options=read_options, convert_options=convert_options
+                ))
+                yield sink.take()
+        yield sink.take()
+
+
+    def advance_watermark(self):
+        # Once the output is complete, a failed export leaves its rows to the next run
+        if self.watermark is None:
+            return
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+            """
+                INSERT INTO ledger_watermarks (name, table_name, last_id) VALUES (%(name)s, %(table)s, %(upper_id)s)
+                ON CONFLICT (name, table_name) DO UPDATE SET last_id = EXCLUDED.last_id, exported_at = NOW()
+                WHERE ledger_watermarks.last_id = %(after_id)s;
+            """, {"name": self.watermark, "table": self.table.name, "upper_id": self.upper_id, "after_id": self.after_id}
+            )
+            advanced = cursor.rowcount == 1
+        self.connection.commit()
+        if not advanced:
+            raise LedgerError(
+                f"Watermark {self.watermark} of {self.table.name} moved during the export, "
+                f"rows after {self.after_id} may have been handed out twice"
+            )
+
+
+    def close(self):
+        self.connection.close()
+
+
+class LedgerExporter(object):
+
+    def __init__(self, connect, chunk_size=10000, settle_timeout=10.0):
+        self.connect = connect
+        self.chunk_size = chunk_size
+        # How long a watermarked export waits for transactions still writing to its table
+        self.settle_timeout = settle_timeout
+
+
+    def __watermark(self, connection, name, table):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT last_id FROM ledger_watermarks WHERE name = %s AND table_name = %s;", (name, table.name)
+            )
+            row = cursor.fetchone()
+        return row[0] if row is not None else 0
+
+
+    def __settled_upper_id(self, connection, table):
+        # Ids are handed out in order but committed in any order, an id
+        # below the upper one that commits later would be skipped for good
+        with connection.cursor() as cursor:
+            cursor.execute(LAST_ALLOCATED_ID_SQL, (table.name,))
+            upper_id = cursor.fetchone()[0]
+            cursor.execute(WRITERS_SQL, (table.name,))
+            writers = cursor.fetchone()[0]
+            connection.commit()
+
+            # Only transactions writing to this table, a long one elsewhere does not hold the export up
+            deadline = time.monotonic() + self.settle_timeout
+            while writers:
+                cursor.execute(STILL_WRITING_SQL, (table.name, writers))
+                still_writing = cursor.fetchone()[0]
+                connection.commit()
+                if not still_writing:
+                    break
+                if time.monotonic() >= deadline:
+                    raise SettleTimeout(
+                        f"{still_writing} transactions writing to {table.name} were still open after "
+                        f"{self.settle_timeout} seconds, try the export again"
+                    )
+                time.sleep(SETTLE_POLL_INTERVAL)
+        return upper_id
+
+
+    def export(self, table_name, fmt="csv", date_from=None, date_to=None, watermark=None):
+        table = LEDGER_TABLES.get(table_name)
+        if table is None:
+            raise LedgerError(f"Unknown ledger table {table_name}, expected one of {', '.join(LEDGER_TABLES)}")
+        if fmt not in FORMATS:
+            raise LedgerError(f"Unknown format {fmt}, expected one of {', '.join(FORMATS)}")
+        if fmt == "parquet" and pyarrow is None:
+            raise LedgerError("Parquet exports need pyarrow, pip install pyarrow")
+        if date_from is not None and date_to is not None and date_from > date_to:
+            raise LedgerError("The start date should not be after the end date")
+        # The watermark moves past every id of the run, rows outside the
+        # dates would never be handed out by the next one
+        if watermark is not None and (date_from is not None or date_to is not None):
+            raise LedgerError("A watermarked export reads every new row, it takes no date range")
+
+        connection = self.connect()
+        try:
+            # Dates and timestamps in the files do not depend on the server's time zone
+            with connection.cursor() as cursor:
+                cursor.execute("SET TIME ZONE 'UTC';")
+            connection.commit()
+
+            if watermark is None:
+                after_id = 0
+                with connection.cursor() as cursor:
+                    cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table.name};")
+                    upper_id = cursor.fetchone()[0]
+                connection.commit()
+            else:
+                after_id = self.__watermark(connection, watermark, table)
+                upper_id = max(self.__settled_upper_id(connection, table), after_id)
+        except BaseException:
+            connection.close()
+            raise
+
+        return LedgerExport(
+            connection, table, fmt, after_id, upper_id, date_from, date_to, watermark, self.chunk_size
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export payments, taxes or rental deals for finance")
+    parser.add_argument("table", choices=sorted(LEDGER_TABLES))
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, default=None,
+                        help="first date, payment date or deal start date")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, default=None, help="last date, included")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--watermark", default=None,
+                        help="name of an incremental export, only rows after its last run are read, no --from/--to")
+    parser.add_argument("--output", default=None, help="file to write, default <table>_..._<ids>.<format>, - for stdout")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows per COPY")
+    args = parser.parse_args()
+
+    def connect():
+        return psycopg2.connect(
+            database=os.getenv("PG_DB"),
+            user=os.getenv("PG_USER"),
+            password=os.getenv("PG_PASSWORD"),
+            host=os.getenv("PG_HOST"),
+            port=os.getenv("PG_PORT"),
+        )
+
+    exporter = LedgerExporter(connect, chunk_size=args.chunk_size)
+    try:
+        export = exporter.export(args.table, args.format, args.date_from, args.date_to, args.watermark)
+    except (LedgerError, psycopg2.Error) as e:
+        raise SystemExit(f"Cannot export {args.table}: {e}".split('\n')[0])
+
+    output = args.output or export.filename
+    try:
+        if output == "-":
+            for chunk in export.chunks():
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            # Renamed into place once complete, the watermark moves after that
+            with open(f"{output}.part", "wb") as file:
+                for chunk in export.chunks():
+                    file.write(chunk)
+            os.replace(f"{output}.part", output)
+        export.advance_watermark()
+    except (LedgerError, psycopg2.Error) as e:
+        raise SystemExit(f"Cannot export {args.table}: {e}".split('\n')[0])
+    finally:
+        export.close()
+
+    print(f"Exported {export.rows} {args.table} rows with ids {export.after_id + 1} to {export.upper_id} "
+          f"to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,98 @@
-import json
-from fastapi import FastAPI, status, HTTPException
-from typing import List
+import hmac
+from fastapi import FastAPI, Depends, Query, Request, status, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
+from typing import List, Optional
+from datetime import date
+from server.db import PoolTimeout
 from server.services import ServiceHandler
-from server.models import UserRegister, UserLogin, UserProfile, EditUser, AddCar, Cars, CurrentCar, UpdateCar, RentalDeal
+from server.sessions import InvalidToken
+from server.metrics import CONTENT_TYPE, MetricsMiddleware
+from server.decoding import encode_json_lines, encode_json_array
+from server.responses import json_response, etag_matches, not_modified
+from server.models import UserRegister, UserLogin, UserProfile, EditUser, AddCar, Cars, CurrentCar, CarBatch, UpdateCar, Review, RentalDeal, OwnerAnalytics
 
 app = FastAPI(
     title="Car Rental App"
 )
 
+MAX_PAGE_SIZE = 200
+MAX_SEARCH_QUERY_LENGTH = 200
+MAX_BATCH_SIZE = 500
+
 serv_handler = ServiceHandler()
 
+app.add_middleware(MetricsMiddleware, metrics=serv_handler.metrics)
+
+bearer_token = HTTPBearer(auto_error=False)
+
+
+def authenticated_user(user_id: int, credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_token)):
+    # The token from PUT /login has to belong to the user in the path and predate no logout of theirs
+    if credentials is None:
+        detail = "Missing session token"
+    else:
+        try:
+            token_user_id, generation = serv_handler.session_tokens.verify(credentials.credentials)
+            if token_user_id == user_id:
+                detail = serv_handler.check_user(user_id, generation)
+                if detail is None:
+                    return user_id
+            else:
+                detail = "Session token belongs to another user"
+        except InvalidToken as e:
+            detail = str(e)
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED, detail=detail, headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+def ledger_client(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_token)):
+    # Finance jobs present LEDGER_TOKEN, user session tokens are not enough
+    if serv_handler.ledger_token is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Ledger exports are disabled")
+    if credentials is None or not hmac.compare_digest(credentials.credentials.encode(), serv_handler.ledger_token.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid ledger token", headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+@app.exception_handler(PoolTimeout)
+def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": f"Database is busy: {exc}"},
+    )
+
+
+@app.on_event("startup")
+def startup():
+    serv_handler.start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    serv_handler.close()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(serv_handler.metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/ready")
+def ready():
+    # Load balancers route to a worker while this answers 200, it turns 503 once shutdown starts
+    data, stat_code = serv_handler.readiness()
+    return JSONResponse(status_code=stat_code, content=data)
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return serv_handler.cache_stats()
+
 
 @app.get("/roles")
 def get_all_roles():
@@ -38,7 +121,7 @@ def login(user_login: UserLogin):
     return data
 
 
-@app.put("/user/{user_id}/logout")
+@app.put("/user/{user_id}/logout", dependencies=[Depends(authenticated_user)])
 def logout(user_id: int, choice: bool = True):
     data, stat_code  = serv_handler.logout(user_id, choice)
     
@@ -47,19 +130,16 @@ def logout(user_id: int, choice: bool = True):
     return data
 
 
-@app.get("/user/{user_id}/profile", response_model=UserProfile)
+@app.get("/user/{user_id}/profile", response_model=UserProfile, dependencies=[Depends(authenticated_user)])
 def user_profile(user_id: int):
-    json_data, stat_code  = serv_handler.user_profile(user_id)
+    profile, stat_code  = serv_handler.user_profile(user_id)
     
     if stat_code != status.HTTP_200_OK:
-        raise HTTPException(status_code=stat_code, detail=json_data)
-    
-    data_dict = json.loads(json_data)
-    user_profile_data = UserProfile(**data_dict)
-    return user_profile_data
+        raise HTTPException(status_code=stat_code, detail=profile)
+    return json_response(profile, UserProfile)
 
 
-@app.put("/user/{user_id}/profile/edit")
+@app.put("/user/{user_id}/profile/edit", dependencies=[Depends(authenticated_user)])
 def edit_profile(user_id: int, edit_user: EditUser):
     data, stat_code = serv_handler.edit_profile(user_id, edit_user)
     
@@ -68,7 +148,7 @@ def edit_profile(user_id: int, edit_user: EditUser):
     return data
 
 
-@app.post("/user/{user_id}/add_car")
+@app.post("/user/{user_id}/add_car", dependencies=[Depends(authenticated_user)])
 def add_car(user_id: int, car: AddCar):
     data, stat_code = serv_handler.add_car(user_id, car)
     
@@ -77,7 +157,19 @@ def add_car(user_id: int, car: AddCar):
     return data
 
 
-@app.delete("/user/{user_id}/delete_car/{car_id}")
+@app.post("/user/{user_id}/cars/bulk", dependencies=[Depends(authenticated_user)])
+async def import_cars(user_id: int, request: Request):
+    body = await request.body()
+    data, stat_code = await run_in_threadpool(
+        serv_handler.import_cars, user_id, body, request.headers.get("content-type", "")
+    )
+    
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=data)
+    return data
+
+
+@app.delete("/user/{user_id}/delete_car/{car_id}", dependencies=[Depends(authenticated_user)])
 def delete_car(user_id: int, car_id: int):
     data, stat_code = serv_handler.delete_car(user_id, car_id)
     
@@ -86,7 +178,7 @@ def delete_car(user_id: int, car_id: int):
     return data
 
 
-@app.put("/user/{user_id}/update_car/{car_id}")
+@app.put("/user/{user_id}/update_car/{car_id}", dependencies=[Depends(authenticated_user)])
 def update_car(user_id: int, car_id: int, update_car: UpdateCar):
     data, stat_code = serv_handler.update_car(user_id, car_id, update_car)
     
@@ -96,30 +188,147 @@ def update_car(user_id: int, car_id: int, update_car: UpdateCar):
 
 
 @app.get("/cars", response_model=List[Cars])
-def get_cars():
-    json_data, stat_code = serv_handler.get_available_cars()
+def get_cars(
+    request: Request,
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    type_name: Optional[str] = None,
+    brand: Optional[str] = None,
+    fuel_type: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+):
+    # Every page shares the catalogue's version, checking it costs one row
+    if "if-none-match" in request.headers:
+        version, stat_code = serv_handler.get_version("catalogue")
+        etag = f'"cars-{version}"'
+        if stat_code == status.HTTP_200_OK and etag_matches(request, etag):
+            return not_modified(etag)
+    
+    page, stat_code = serv_handler.get_available_cars(
+        after, limit + 1, type_name, brand, fuel_type, min_price, max_price
+    )
+    
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=page)
+    
+    version, cars = page
+    headers = {"ETag": f'"cars-{version}"'}
+    if len(cars) > limit:
+        cars = cars[:limit]
+        headers["X-Next-Cursor"] = str(cars[-1].car_id)
+    return json_response(cars, List[Cars], headers=headers)
+
+
+@app.get("/cars/available", response_model=List[Cars])
+def get_free_cars(
+    start: date,
+    end: date,
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+):
+    cars, stat_code = serv_handler.get_free_cars(start, end, after, limit + 1)
     
     if stat_code != status.HTTP_200_OK:
-        raise HTTPException(status_code=stat_code, detail=json_data)
+        raise HTTPException(status_code=stat_code, detail=cars)
     
-    data_dict = json.loads(json_data)
-    available_cars_data = [Cars(**car_data) for car_data in data_dict]
-    return available_cars_data
+    headers = {}
+    if len(cars) > limit:
+        cars = cars[:limit]
+        headers["X-Next-Cursor"] = str(cars[-1].car_id)
+    return json_response(cars, List[Cars], headers=headers)
+
+
+@app.get("/cars/search", response_model=List[Cars])
+def search_cars(
+    q: str = Query(..., min_length=1, max_length=MAX_SEARCH_QUERY_LENGTH),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+):
+    cars, stat_code = serv_handler.search_cars(q, limit)
+    
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=cars)
+    return json_response(cars, List[Cars])
+
+
+@app.get("/cars/export")
+def export_cars(format: str = Query("ndjson", pattern="^(ndjson|json)$")):
+    batches, stat_code = serv_handler.export_cars()
+    
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=batches)
+    
+    if format == "ndjson":
+        chunks, media_type = encode_json_lines(batches, Cars), "application/x-ndjson"
+    else:
+        chunks, media_type = encode_json_array(batches, Cars), "application/json"
+    # Also runs when the client disconnects halfway, closing the chunks hands the connection back to the pool
+    return StreamingResponse(chunks, media_type=media_type, background=BackgroundTask(chunks.close))
+
+
+def close_ledger_export(export, chunks):
+    chunks.close()
+    export.close()
+
+
+@app.get("/ledger/{table}", dependencies=[Depends(ledger_client)])
+def export_ledger(
+    table: str,
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    watermark: Optional[str] = Query(None, max_length=100),
+):
+    data, stat_code = serv_handler.export_ledger(table, format, date_from, date_to, watermark)
+    
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=data)
+    
+    export, chunks = data
+    headers = {
+        "Content-Disposition": f'attachment; filename="{export.filename}"',
+        "X-Ledger-Ids": f"{export.after_id + 1}-{export.upper_id}",
+    }
+    # Also runs when the client disconnects, before the first chunk too, which leaves the chunks' finally unrun
+    return StreamingResponse(
+        chunks, media_type=export.media_type, headers=headers, background=BackgroundTask(close_ledger_export, export, chunks)
+    )
+
+
+@app.get("/cars/batch", response_model=CarBatch)
+def get_cars_by_ids(ids: str = Query(..., pattern=r"^\d+(,\d+)*$", description="Comma-separated car ids")):
+    car_ids = [int(car_id) for car_id in ids.split(",")]
+    if len(car_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {MAX_BATCH_SIZE} car ids can be asked for at once",
+        )
+    
+    batch, stat_code = serv_handler.get_cars_by_ids(car_ids)
+    
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=batch)
+    return json_response(batch, CarBatch)
 
 
 @app.get("/cars/{car_id}", response_model=CurrentCar)
-def get_car(car_id: int):
-    json_data, stat_code  = serv_handler.get_available_car(car_id)
+def get_car(car_id: int, request: Request):
+    if "if-none-match" in request.headers:
+        version, stat_code = serv_handler.get_version("car", car_id)
+        etag = f'"car-{car_id}-{version}"'
+        if stat_code == status.HTTP_200_OK and version is not None and etag_matches(request, etag):
+            return not_modified(etag)
+    
+    page, stat_code  = serv_handler.get_available_car(car_id)
     
     if stat_code != status.HTTP_200_OK:
-        raise HTTPException(status_code=stat_code, detail=json_data)
+        raise HTTPException(status_code=stat_code, detail=page)
     
-    data_dict = json.loads(json_data)
-    available_car_data = CurrentCar(**data_dict)
-    return available_car_data
+    version, car = page
+    return json_response(car, CurrentCar, headers={"ETag": f'"car-{car_id}-{version}"'})
 
 
-@app.post("/user/{user_id}/cars/{car_id}/make_review")
+@app.post("/user/{user_id}/cars/{car_id}/make_review", dependencies=[Depends(authenticated_user)])
 def make_review(user_id: int, car_id: int, message: str = None):
     data, stat_code = serv_handler.make_review(user_id, car_id, message)
     
@@ -128,18 +337,33 @@ def make_review(user_id: int, car_id: int, message: str = None):
     return data
 
 
-@app.get("/cars/{car_id}/get_reviews")
-def get_reviews(car_id: int):
-    json_data, stat_code = serv_handler.get_reviews(car_id)
+@app.get("/cars/{car_id}/get_reviews", response_model=List[Review])
+def get_reviews(
+    car_id: int,
+    request: Request,
+    before: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+):
+    if "if-none-match" in request.headers:
+        version, stat_code = serv_handler.get_version("reviews", car_id)
+        etag = f'"reviews-{car_id}-{version}"'
+        if stat_code == status.HTTP_200_OK and etag_matches(request, etag):
+            return not_modified(etag)
+    
+    page, stat_code = serv_handler.get_reviews(car_id, before, limit + 1)
     
     if stat_code != status.HTTP_200_OK:
-        raise HTTPException(status_code=stat_code, detail=json_data)
+        raise HTTPException(status_code=stat_code, detail=page)
     
-    data_dict = json.loads(json_data)
-    return data_dict
+    version, reviews = page
+    headers = {"ETag": f'"reviews-{car_id}-{version}"'}
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        headers["X-Next-Cursor"] = str(reviews[-1].review_id)
+    return json_response(reviews, List[Review], headers=headers)
 
 
-@app.post("/user/{user_id}/cars/{car_id}/add_to_favourites")
+@app.post("/user/{user_id}/cars/{car_id}/add_to_favourites", dependencies=[Depends(authenticated_user)])
 def add_to_favourites(user_id: int, car_id: int):
     data, stat_code = serv_handler.add_to_favourites(user_id, car_id)
     
@@ -148,19 +372,33 @@ def add_to_favourites(user_id: int, car_id: int):
     return data
 
 
-@app.get("/user/{user_id}/get_favourites", response_model=List[Cars])
-def get_favourites(user_id: int):
-    json_data, stat_code = serv_handler.get_favourites(user_id)
+@app.get("/user/{user_id}/get_favourites", response_model=List[Cars], dependencies=[Depends(authenticated_user)])
+def get_favourites(user_id: int, request: Request):
+    if "if-none-match" in request.headers:
+        version, stat_code = serv_handler.get_favourites_version(user_id)
+        etag = f'"favourites-{user_id}-{version}"'
+        if stat_code == status.HTTP_200_OK and etag_matches(request, etag):
+            return not_modified(etag)
+    
+    page, stat_code = serv_handler.get_favourites(user_id)
     
     if stat_code != status.HTTP_200_OK:
-        raise HTTPException(status_code=stat_code, detail=json_data)
+        raise HTTPException(status_code=stat_code, detail=page)
+    
+    version, cars = page
+    return json_response(cars, List[Cars], headers={"ETag": f'"favourites-{user_id}-{version}"'})
+
+
+@app.get("/user/{user_id}/analytics", response_model=OwnerAnalytics, dependencies=[Depends(authenticated_user)])
+def get_owner_analytics(user_id: int):
+    analytics, stat_code = serv_handler.get_owner_analytics(user_id)
     
-    data_dict = json.loads(json_data)
-    favourite_cars_data = [Cars(**car_data) for car_data in data_dict]
-    return favourite_cars_data
+    if stat_code != status.HTTP_200_OK:
+        raise HTTPException(status_code=stat_code, detail=analytics)
+    return json_response(analytics, OwnerAnalytics)
 
 
-@app.post("/user/{user_id}/cars/{car_id}/make_rent")
+@app.post("/user/{user_id}/cars/{car_id}/make_rent", dependencies=[Depends(authenticated_user)])
 def make_rent(user_id: int, car_id: int, rental_deal: RentalDeal):
     data, stat_code = serv_handler.make_rent(user_id, car_id, rental_deal)
     
@@ -0,0 +1,332 @@
+import re
+import time
+import bisect
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+LEADING_COMMENTS_PATTERN = re.compile(r"^(?:\s*--[^\n]*\n)*\s*")
+# The set_config DatabaseHandler sends ahead of a statement in a verified user scope
+LEADING_SETTINGS_PATTERN = re.compile(r"^(?:SELECT\s+set_config\([^;]*\);\s*)+", re.IGNORECASE)
+# DatabaseHandler.prepared_sql names its statements after the function they call
+PREPARED_STATEMENT_PATTERN = re.compile(r"^PREPARE\s+(\w+)\s", re.IGNORECASE)
+EXECUTED_STATEMENT_PATTERN = re.compile(r"^EXECUTE\s+(\w+)", re.IGNORECASE)
+# "CALL check_user_status(...)", "SELECT * FROM get_available_cars(...)", "SELECT add_car(...)"
+CALLED_PROCEDURE_PATTERN = re.compile(r"^CALL\s+(\w+)\s*\(", re.IGNORECASE)
+SELECTED_FUNCTION_PATTERN = re.compile(r"\bFROM\s+(\w+)\s*\(", re.IGNORECASE)
+CALLED_FUNCTION_PATTERN = re.compile(r"^SELECT\s+(\w+)\s*\(", re.IGNORECASE)
+TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.IGNORECASE)
+MAX_KNOWN_STATEMENTS = 1000
+MAX_LOGGED_QUERY_LENGTH = 500
+
+
+def statement_name(query):
+    query = LEADING_COMMENTS_PATTERN.sub("", query, count=1)
+    query = LEADING_SETTINGS_PATTERN.sub("", query, count=1)
+    words = query.split(None, 1)
+    if not words:
+        return "empty"
+
+    match = PREPARED_STATEMENT_PATTERN.match(query)
+    if match:
+        return f"prepare {match.group(1).lower()}"
+    match = EXECUTED_STATEMENT_PATTERN.match(query)
+    if match:
+        return match.group(1).lower()
+
+    # Stored functions and procedures are named after themselves, other statements after verb and table
+    for pattern in (CALLED_PROCEDURE_PATTERN, SELECTED_FUNCTION_PATTERN):
+        match = pattern.search(query)
+        if match:
+            return match.group(1).lower()
+
+    table = TABLE_PATTERN.search(query)
+    if table:
+        return f"{words[0].lower()} {table.group(1).lower()}"
+
+    match = CALLED_FUNCTION_PATTERN.match(query)
+    return match.group(1).lower() if match else words[0].lower()
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = [*zip(label_names, label_values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+
+    def inc(self, *label_values, amount=1):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+
+    def render(self):
+        with self.__lock:
+            values = list(self.__values.items())
+
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in values:
+            yield f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+
+
+class Gauge(object):
+
+    def __init__(self, name, documentation, label_names, read):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        # Read at scrape time, returns {label values: value}
+        self.read = read
+
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for label_values, value in self.read().items():
+            yield f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+
+
+class Histogram(object):
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: non-cumulative bucket counts with a last +Inf slot, sum
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.__series.get(label_values)
+            if series is None:
+                series = self.__series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+
+    def render(self):
+        with self.__lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self.__series.items()]
+
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, label_values, [("le", format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Metrics(object):
+
+    def __init__(self, slow_query_threshold=0.2):
+        # None turns the slow-query log off, 0 logs every statement
+        self.slow_query_threshold = slow_query_threshold
+        self.__statements = {}
+        self.__collectors = []
+
+        self.request_duration = self.register(Histogram(
+            "http_request_duration_seconds", "Time spent handling requests, by route template.",
+            ("method", "route"),
+        ))
+        self.requests = self.register(Counter(
+            "http_requests_total", "Handled requests, by route template and response status.",
+            ("method", "route", "status"),
+        ))
+        self.service_call_duration = self.register(Histogram(
+            "service_call_duration_seconds", "Time spent in ServiceHandler methods, cache hits included.",
+            ("method",),
+        ))
+        self.service_calls = self.register(Counter(
+            "service_calls_total", "ServiceHandler method calls, by returned status.",
+            ("method", "status"),
+        ))
+        self.query_duration = self.register(Histogram(
+            "db_query_duration_seconds", "Time spent executing SQL statements, by statement name.",
+            ("statement",),
+        ))
+        self.query_rows = self.register(Counter(
+            "db_query_rows_total", "Rows returned or affected by SQL statements.",
+            ("statement",),
+        ))
+        self.query_errors = self.register(Counter(
+            "db_query_errors_total", "SQL statements that raised, by statement name and error class.",
+            ("statement", "error"),
+        ))
+        self.slow_queries = self.register(Counter(
+            "db_slow_queries_total", "SQL statements slower than the slow-query threshold.",
+            ("statement",),
+        ))
+        self.pool_wait = self.register(Histogram(
+            "db_pool_wait_seconds", "Time spent waiting for a pooled connection, connecting included.",
+            buckets=POOL_WAIT_BUCKETS,
+        ))
+        self.pool_timeouts = self.register(Counter(
+            "db_pool_timeouts_total", "Requests for a pooled connection that timed out.",
+        ))
+        self.activity_events = self.register(Counter(
+            "activity_log_events_total", "Activity log events, by outcome: queued, dropped, written or failed.",
+            ("outcome",),
+        ))
+
+
+    def register(self, collector):
+        self.__collectors.append(collector)
+        return collector
+
+
+    def watch_pool(self, pool):
+        self.register(Gauge(
+            "db_pool_connections", "Pooled connections to the primary, by state.", ("state",),
+            lambda: {("idle",): pool.idle, ("in_use",): pool.size - pool.idle, ("max",): pool.max_size},
+        ))
+
+
+    def watch_replicas(self, replicas):
+        if not replicas:
+            return
+
+        self.register(Gauge(
+            "db_replica_lag_seconds", "Replication lag of each read replica when last checked.", ("replica",),
+            lambda: {(replica.name,): replica.lag for replica in replicas},
+        ))
+        self.register(Gauge(
+            "db_replica_healthy", "Whether each read replica answered its last check.", ("replica",),
+            lambda: {(replica.name,): int(replica.healthy) for replica in replicas},
+        ))
+        self.register(Gauge(
+            "db_replica_pool_connections", "Pooled connections to each read replica, by state.", ("replica", "state"),
+            lambda: {
+                key: value for replica in replicas for key, value in (
+                    ((replica.name, "idle"), replica.pool.idle),
+                    ((replica.name, "in_use"), replica.pool.size - replica.pool.idle),
+                )
+            },
+        ))
+
+
+    def watch_activity_log(self, activity_log):
+        self.register(Gauge(
+            "activity_log_queue_events", "Activity log events waiting for the writer, and the queue bound.", ("state",),
+            lambda: {("queued",): activity_log.size, ("max",): activity_log.max_size},
+        ))
+
+
+    def statement_name(self, query):
+        name = self.__statements.get(query)
+        if name is None:
+            name = statement_name(query)
+            # Queries are literals in the code, the bound only guards against generated SQL
+            if len(self.__statements) < MAX_KNOWN_STATEMENTS:
+                self.__statements[query] = name
+        return name
+
+
+    def observe_request(self, method, route, status_code, duration):
+        self.request_duration.observe(duration, method, route)
+        self.requests.inc(method, route, status_code)
+
+
+    def observe_service_call(self, method, status_code, duration):
+        self.service_call_duration.observe(duration, method)
+        self.service_calls.inc(method, status_code)
+
+
+    def observe_query(self, query, duration, rowcount=-1, error=None):
+        statement = self.statement_name(query)
+        self.query_duration.observe(duration, statement)
+        if rowcount > 0:
+            self.query_rows.inc(statement, amount=rowcount)
+        if error is not None:
+            self.query_errors.inc(statement, type(error).__name__)
+
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            self.slow_queries.inc(statement)
+            # Parameters are left out, they can hold passwords
+            logger.warning(
+                "Slow query %s took %.1f ms: %s",
+                statement, duration * 1000, " ".join(query.split())[:MAX_LOGGED_QUERY_LENGTH],
+            )
+
+
+    def render(self):
+        lines = []
+        for collector in self.__collectors:
+            lines.extend(collector.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(object):
+    # Plain ASGI middleware, BaseHTTPMiddleware would add a task and a stream per request
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+        self.__route_paths = None
+
+
+    def __route(self, scope):
+        # Labels use the route template, /cars/{car_id}, so every car id shares one series
+        if self.__route_paths is None:
+            self.__route_paths = {
+                route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")
+            }
+        return self.__route_paths.get(scope.get("endpoint"), "unmatched")
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.metrics.observe_request(
+                scope["method"], self.__route(scope), status_code, time.perf_counter() - started
+            )
@@ -0,0 +1,219 @@
+import os
+import re
+import argparse
+import psycopg2
+from psycopg2 import errors
+
+
+MIGRATIONS_DIR = "server/sql/migrations"
+
+# Brings a schema created by init_db.sql to the first migration
+LEGACY_UPGRADE_PATH = "server/sql/legacy_init_db.sql"
+
+# Arbitrary key shared by every worker, pg_advisory_lock serializes them on it
+MIGRATIONS_LOCK_KEY = 4_231_007
+
+MIGRATION_FILE_PATTERN = re.compile(r"^(\d+)_([\w-]+)\.sql$")
+
+# What 0001_initial_schema has beyond the first init_db.sql
+BASELINE_SCHEMA_SQL = """
+    SELECT
+        to_regclass('public.cars_available_id_idx') IS NOT NULL
+        AND to_regclass('public.cars_available_car_type_idx') IS NOT NULL
+        AND to_regclass('public.cars_available_brand_idx') IS NOT NULL
+        AND to_regclass('public.cars_available_fuel_type_idx') IS NOT NULL
+        AND to_regclass('public.cars_available_price_idx') IS NOT NULL
+        AND to_regclass('public.brands_name_idx') IS NOT NULL
+        AND to_regclass('public.car_images_car_id_idx') IS NOT NULL
+        AND to_regprocedure('get_available_cars()') IS NULL
+        AND to_regprocedure(
+            'get_available_cars(INT, INT, CAR_TYPE, CAR_BRAND, FUEL_TYPE, NUMERIC, NUMERIC)'
+        ) IS NOT NULL
+        AND EXISTS (
+            SELECT 1 FROM pg_proc
+            WHERE oid = to_regprocedure('delete_car(INT, INT)') AND prosrc LIKE '%delete_car.car_id%'
+        )
+        AND (
+            SELECT COUNT(*) FROM pg_trigger
+            WHERE tgname IN (
+                'cars_notify_change_trigger', 'car_images_notify_change_trigger', 'rental_deals_notify_change_trigger'
+            )
+        ) = 3;
+"""
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration(object):
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+
+    def read(self):
+        with open(self.path, "r", encoding="utf-8") as file:
+            return file.read()
+
+
+def load_migrations(migrations_dir=MIGRATIONS_DIR):
+    migrations = []
+    for file_name in os.listdir(migrations_dir):
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+        if match is None:
+            continue
+        migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(migrations_dir, file_name)))
+
+    migrations.sort(key=lambda migration: migration.version)
+
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise MigrationError(f"Duplicate migration versions in {migrations_dir}")
+    return migrations
+
+
+class MigrationRunner(object):
+
+    def __init__(self, connect, migrations_dir=MIGRATIONS_DIR, legacy_upgrade_path=LEGACY_UPGRADE_PATH):
+        self.connect = connect
+        self.migrations = load_migrations(migrations_dir)
+        self.legacy_upgrade_path = legacy_upgrade_path
+
+
+    @property
+    def latest_version(self):
+        return self.migrations[-1].version if self.migrations else 0
+
+
+    def current_version(self, connection):
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+                version = cursor.fetchone()[0]
+            except errors.UndefinedTable:
+                version = None
+        connection.rollback()
+        return version
+
+
+    def run(self):
+        connection = self.connect()
+        try:
+            # Up-to-date schema: this single query is the whole startup cost
+            if self.current_version(connection) == self.latest_version:
+                return []
+
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s);", (MIGRATIONS_LOCK_KEY,))
+            connection.commit()
+            try:
+                return self.__apply_pending(connection)
+            finally:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s);", (MIGRATIONS_LOCK_KEY,))
+                connection.commit()
+        finally:
+            connection.close()
+
+
+    def __matches_baseline(self, cursor):
+        cursor.execute(BASELINE_SCHEMA_SQL)
+        return cursor.fetchone()[0]
+
+
+    def __apply_pending(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('public.schema_migrations') IS NULL, to_regclass('public.cars') IS NOT NULL;")
+            is_new, has_legacy_schema = cursor.fetchone()
+            cursor.execute(
+            """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY NOT NULL,
+                    name VARCHAR(200) NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+                );
+            """
+            )
+
+            # Databases created by the old drop-and-recreate init_db.sql already hold the initial schema
+            if is_new and has_legacy_schema and self.migrations:
+                baseline = self.migrations[0]
+                # The first init_db.sql lacks the listing indexes, keyset get_available_cars and change triggers
+                if not self.__matches_baseline(cursor):
+                    print(f"Upgrading existing schema to migration {baseline.version:04d}_{baseline.name}")
+                    try:
+                        with open(self.legacy_upgrade_path, "r", encoding="utf-8") as file:
+                            cursor.execute(file.read())
+                        matches = self.__matches_baseline(cursor)
+                    except psycopg2.Error as e:
+                        connection.rollback()
+                        raise MigrationError(f"Upgrading the existing schema failed: {e}") from e
+                    if not matches:
+                        connection.rollback()
+                        raise MigrationError(
+                            f"Existing schema does not match migration {baseline.version:04d}_{baseline.name}, "
+                            f"bring it there by hand before migrating"
+                        )
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                    (baseline.version, baseline.name)
+                )
+                print(f"Existing schema recorded as migration {baseline.version:04d}_{baseline.name}")
+
+            cursor.execute("SELECT version FROM schema_migrations;")
+            applied = {row[0] for row in cursor.fetchall()}
+        connection.commit()
+
+        applied_now = []
+        for migration in self.migrations:
+            if migration.version in applied:
+                continue
+
+            print(f"Applying migration {migration.version:04d}_{migration.name}")
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(migration.read())
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                        (migration.version, migration.name)
+                    )
+                connection.commit()
+            except psycopg2.Error as e:
+                connection.rollback()
+                raise MigrationError(f"Migration {migration.version:04d}_{migration.name} failed: {e}") from e
+            applied_now.append(migration.version)
+        return applied_now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending database migrations")
+    parser.add_argument("--status", action="store_true", help="only print the current and latest versions")
+    args = parser.parse_args()
+
+    def connect():
+        return psycopg2.connect(
+            database=os.getenv("PG_DB"),
+            user=os.getenv("PG_USER"),
+            password=os.getenv("PG_PASSWORD"),
+            host=os.getenv("PG_HOST"),
+            port=os.getenv("PG_PORT"),
+        )
+
+    runner = MigrationRunner(connect)
+    if args.status:
+        connection = connect()
+        try:
+            print(f"current: {runner.current_version(connection)}, latest: {runner.latest_version}")
+        finally:
+            connection.close()
+        return
+
+    applied = runner.run()
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from typing import Optional, List
 from pydantic import BaseModel
-from datetime import date
+from datetime import date, datetime
 
 
 class Role(BaseModel):
@@ -67,7 +67,8 @@ class Cars(BaseModel):
     model: str
     fuel_type: str
     price_per_day: float
-    main_image_url: str
+    main_image_url: Optional[str] = None
+    review_count: int
     
     
 class CurrentCar(BaseModel):
@@ -83,6 +84,23 @@ class CurrentCar(BaseModel):
     telephone_no: str
     
     
+class CarDetails(CurrentCar):
+    car_id: int
+    
+    
+class CarBatch(BaseModel):
+    cars: List[CarDetails]
+    missing_ids: List[int]
+    
+    
+class Review(BaseModel):
+    review_id: int
+    user_id: Optional[int]
+    given_name: Optional[str]
+    message: str
+    created_at: Optional[datetime]
+    
+    
 class UpdateCar(BaseModel):
     new_price_per_day: float
     new_description: str
@@ -92,4 +110,26 @@ class RentalDeal(BaseModel):
     start_location: str
     end_location: str
     start_date: date
-    end_date: date
\ No newline at end of file
+    end_date: date
+    
+    
+class CarAnalytics(BaseModel):
+    car_id: int
+    brand: str
+    model: str
+    deal_count: int
+    days_rented: int
+    revenue: float
+    tax: float
+    first_rental_date: Optional[date]
+    last_rental_date: Optional[date]
+    utilization: float
+    
+    
+class OwnerAnalytics(BaseModel):
+    car_count: int
+    deal_count: int
+    days_rented: int
+    revenue: float
+    tax: float
+    cars: List[CarAnalytics] = []
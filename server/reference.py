@@ -0,0 +1,138 @@
+import threading
+from server.decoding import decode_rows
+from server.models import Role
+
+
+ENUM_NAMES = ("CAR_TYPE", "CAR_BRAND", "FUEL_TYPE")
+
+# What a load reads, in this order
+LOAD_QUERIES = (
+    "SELECT type_name::text, id FROM car_types;",
+    "SELECT name::text, model, id FROM brands;",
+    "SELECT type_name::text, id FROM fuel_types;",
+    "SELECT name, permission FROM roles ORDER BY id;",
+    *(f"SELECT unnest(enum_range(NULL::{enum_name}))::text;" for enum_name in ENUM_NAMES),
+)
+
+
+class ReferenceCache(object):
+
+    def __init__(self, db_handler):
+        self.db_handler = db_handler
+        self.loads = 0
+        self.__car_types = {}
+        self.__brands = {}
+        self.__fuel_types = {}
+        self.__roles = []
+        self.__enum_labels = {}
+        self.__loaded = False
+        self.__generation = 0
+        self.__published_generation = 0
+        self.__lock = threading.Lock()
+
+
+    @property
+    def loaded(self):
+        return self.__loaded
+
+
+    @property
+    def generation(self):
+        return self.__generation
+
+
+    def ensure_loaded(self):
+        if self.__loaded:
+            return
+
+        # Read outside the lock, on the caller's connection when it has one. A
+        # thread waiting for the pool while holding the lock would stall every
+        # caller that already holds a connection, at worst until the pool times out
+        generation = self.__generation
+        with self.db_handler.transaction() as connection:
+            with connection.cursor() as cursor:
+                results = []
+                for query in LOAD_QUERIES:
+                    cursor.execute(query)
+                    results.append((cursor.description, cursor.fetchall()))
+        self.publish(generation, results)
+
+
+    def publish(self, generation, results):
+        # results holds (description, rows) of each of LOAD_QUERIES, read once generation was current
+        (_, car_types), (_, brands), (_, fuel_types), (roles_description, roles), *enums = results
+
+        with self.__lock:
+            # Concurrent loads publish in turn, rows read before a later load's never replace its maps
+            if generation < self.__published_generation:
+                return
+
+            self.__car_types = dict(car_types)
+            self.__brands = {(name, model): brand_id for name, model, brand_id in brands}
+            self.__fuel_types = dict(fuel_types)
+            self.__roles = decode_rows(roles_description, roles, Role)
+            self.__enum_labels = {
+                enum_name: frozenset(row[0] for row in rows) for enum_name, (_, rows) in zip(ENUM_NAMES, enums)
+            }
+            self.__published_generation = generation
+            # A change notified while loading may not be in these rows, load again next time
+            self.__loaded = generation == self.__generation
+            self.loads += 1
+
+
+    def invalidate(self, payload=None):
+        # The maps are swapped as a whole on the next load, readers never see a half-filled one
+        self.__generation += 1
+        self.__loaded = False
+
+
+    def car_ids(self, type_name, brand, model, fuel_type):
+        self.ensure_loaded()
+        return (
+            self.__car_types.get(type_name),
+            self.__brands.get((brand, model)),
+            self.__fuel_types.get(fuel_type),
+        )
+
+
+    def enum_labels(self, enum_name):
+        self.ensure_loaded()
+        return self.__enum_labels[enum_name]
+
+
+    def roles(self):
+        self.ensure_loaded()
+        return self.__roles
+
+
+    def stats(self):
+        return {
+            "loaded": self.__loaded,
+            "loads": self.loads,
+            "car_types": len(self.__car_types),
+            "brands": len(self.__brands),
+            "fuel_types": len(self.__fuel_types),
+            "roles": len(self.__roles),
+        }
+
+
+class AsyncReferenceCache(ReferenceCache):
+    # The same maps for the async app. Its callers await load() first, the
+    # lookups then read the maps as published, so they never block the event loop
+
+    def ensure_loaded(self):
+        pass
+
+
+    async def load(self):
+        if self.loaded:
+            return
+
+        generation = self.generation
+        async with self.db_handler.transaction() as connection:
+            cursor = connection.cursor()
+            results = []
+            for query in LOAD_QUERIES:
+                await cursor.execute(query)
+                results.append((cursor.description, await cursor.fetchall()))
+        self.publish(generation, results)
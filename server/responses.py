@@ -0,0 +1,18 @@
+from fastapi import Request, Response, status
+from server.decoding import encode_json
+
+
+def json_response(data, response_type, headers=None):
+    return Response(content=encode_json(data, response_type), media_type="application/json", headers=headers)
+
+
+def etag_matches(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def not_modified(etag: str):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
@@ -1,44 +1,313 @@
 import os
-import json
+import time
+import functools
 import psycopg2
 from fastapi import status
-from server.db import DatabaseHandler
-from server.models import Role, UserRegister, UserLogin, EditUser, AddCar, UpdateCar, RentalDeal
+from server.db import DatabaseHandler, PoolError
+from server.metrics import Metrics
+from server.cache import MISSING, LRUCache, NotifyListener
+from server.reference import ReferenceCache
+from server.sessions import SessionTokens
+from server.bulk import BulkCarImporter, parse_rows
+from server.activity import ActivityLog
+from server.ledger import LedgerError, LedgerExporter, SettleTimeout
+from server.decoding import decode_row, decode_rows
+from server.models import UserRegister, UserLogin, UserProfile, EditUser, AddCar, Cars, CurrentCar, CarDetails, CarBatch, UpdateCar, Review, RentalDeal, OwnerAnalytics, CarAnalytics
+
+
+def timed(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        stat_code = "error"
+        try:
+            data, stat_code = method(self, *args, **kwargs)
+            return data, stat_code
+        finally:
+            self.metrics.observe_service_call(method.__name__, stat_code, time.perf_counter() - started)
+    return wrapper
+
+
+def transactional(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.db_handler.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def read_only(pinned=None):
+    # Served by a read replica, or by the primary while the ServiceHandler
+    # method named pinned says the caller may not see its own writes there
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            primary = pinned is not None and getattr(self, pinned)(*args)
+            with self.db_handler.transaction(read_only=True, primary=primary):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def cached(cache_name):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            cache = getattr(self, cache_name)
+            value = cache.get(args)
+            if value is not MISSING:
+                return value, status.HTTP_200_OK
+
+            generation = cache.generation
+            data, stat_code = method(self, *args)
+            if stat_code == status.HTTP_200_OK:
+                cache.set(args, data, generation)
+            return data, stat_code
+        return wrapper
+    return decorator
+
+
+def verified_user(method):
+    @functools.wraps(method)
+    def wrapper(self, user_id, *args, **kwargs):
+        error = self.check_user(user_id)
+        if error is not None:
+            return error, status.HTTP_401_UNAUTHORIZED
+
+        with self.db_handler.verified_user(user_id):
+            data, stat_code = method(self, user_id, *args, **kwargs)
+        
+        if stat_code == status.HTTP_200_OK and not self.db_handler.read_only:
+            self.user_wrote(user_id)
+        return data, stat_code
+    return wrapper
 
 
 class ServiceHandler(object):
     
     def __init__(self):
+        slow_query_threshold_ms = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200))
+        self.metrics = Metrics(
+            slow_query_threshold=slow_query_threshold_ms / 1000 if slow_query_threshold_ms >= 0 else None,
+        )
         self.db_handler = DatabaseHandler(
             db_user=os.getenv("PG_USER"),
             db_password=os.getenv("PG_PASSWORD"),
             db_name=os.getenv("PG_DB"),
-            db_host="172.23.0.2",
+            db_host=os.getenv("PG_HOST"),
             db_port=os.getenv("PG_PORT"),
+            dsn=os.getenv("PG_DSN"),
+            replica_dsns=[dsn.strip() for dsn in os.getenv("PG_REPLICA_DSNS", "").split(",") if dsn.strip()],
+            max_replica_lag=float(os.getenv("PG_MAX_REPLICA_LAG", 5)),
+            replica_check_interval=float(os.getenv("PG_REPLICA_CHECK_INTERVAL", 1)),
+            pool_min_size=int(os.getenv("PG_POOL_MIN_SIZE", 1)),
+            pool_max_size=int(os.getenv("PG_POOL_MAX_SIZE", 10)),
+            pool_timeout=float(os.getenv("PG_POOL_TIMEOUT", 30)),
+            pool_health_check_interval=float(os.getenv("PG_POOL_HEALTH_CHECK_INTERVAL", 30)),
+            metrics=self.metrics,
+            # Connects in start(), in each worker of a forking server
+            lazy=True,
         )
-        
+        # Off in the workers of server/gunicorn.conf.py, which migrates once before forking
+        self.migrate_on_startup = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+        self.readiness_timeout = float(os.getenv("READINESS_TIMEOUT", 1))
+        self.state = "starting"
+        self.cars_cache = LRUCache(
+            max_size=int(os.getenv("CARS_CACHE_SIZE", 1024)),
+            ttl=float(os.getenv("CARS_CACHE_TTL", 30)),
+        )
+        self.car_cache = LRUCache(
+            max_size=int(os.getenv("CAR_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("CAR_CACHE_TTL", 300)),
+        )
+        # (status, role_id, session_generation) per user id, None for a user that does not exist
+        self.session_cache = LRUCache(
+            max_size=int(os.getenv("SESSION_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("SESSION_CACHE_TTL", 60)),
+        )
+        # A replica in use is at most max_replica_lag behind when checked, and
+        # is checked again replica_check_interval later. For that long a user's
+        # own reads and the cache refills after a change go to the primary
+        stale_read_window = self.db_handler.max_replica_lag + self.db_handler.replica_check_interval
+        self.recent_writers = LRUCache(max_size=int(os.getenv("SESSION_CACHE_SIZE", 10000)), ttl=stale_read_window)
+        self.recent_car_changes = LRUCache(max_size=int(os.getenv("CAR_CACHE_SIZE", 10000)), ttl=stale_read_window)
+        # A random secret is lost on restart and differs between hosts, so only development runs without one
+        session_secret = os.getenv("SESSION_SECRET") or None
+        if session_secret is None and os.getenv("APP_ENV", "production") != "development":
+            raise RuntimeError("SESSION_SECRET is not set, set it or APP_ENV=development to sign with a random secret")
+        self.session_tokens = SessionTokens(
+            secret=session_secret,
+            ttl=float(os.getenv("SESSION_TOKEN_TTL", 86400)),
+        )
+        self.reference_cache = ReferenceCache(self.db_handler)
+        self.bulk_importer = BulkCarImporter(
+            self.db_handler.transaction,
+            self.reference_cache,
+            chunk_size=int(os.getenv("BULK_IMPORT_CHUNK_SIZE", 1000)),
+        )
+        self.export_batch_size = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+        # Finance extracts, off unless LEDGER_TOKEN is set. Each export has its own connection, not a pooled one
+        self.ledger_token = os.getenv("LEDGER_TOKEN") or None
+        self.ledger_exporter = LedgerExporter(
+            self.db_handler.connect,
+            chunk_size=int(os.getenv("LEDGER_CHUNK_SIZE", 10000)),
+            settle_timeout=float(os.getenv("LEDGER_SETTLE_TIMEOUT", 10)),
+        )
+        # Compliance record of logins, logouts, car changes, reviews and rentals, written behind the requests
+        self.activity_log = ActivityLog(
+            self.db_handler.connect,
+            max_queue_size=int(os.getenv("ACTIVITY_LOG_QUEUE_SIZE", 10000)),
+            batch_size=int(os.getenv("ACTIVITY_LOG_BATCH_SIZE", 500)),
+            flush_interval=float(os.getenv("ACTIVITY_LOG_FLUSH_INTERVAL", 1)),
+            block_timeout=float(os.getenv("ACTIVITY_LOG_BLOCK_MS", 0)) / 1000,
+            metrics=self.metrics,
+        )
+        self.notify_listener = NotifyListener(self.db_handler.connect)
+        if os.getenv("CACHE_BACKEND", "local") == "postgres":
+            self.notify_listener.subscribe("car_changes", self.__on_car_change, on_reconnect=self.clear_caches)
+            self.notify_listener.subscribe(
+                "reference_changes", self.reference_cache.invalidate, on_reconnect=self.reference_cache.invalidate
+            )
+            self.notify_listener.subscribe("user_changes", self.__on_user_change, on_reconnect=self.session_cache.clear)
     
-    def __row_to_entity(self, row, pydantic_model):
-        return pydantic_model(**{
-            key: row[i] for i, key in enumerate(pydantic_model.__fields__.keys())
-        })
-
+    
+    def start(self):
+        self.db_handler.open(migrate=self.migrate_on_startup)
+        self.notify_listener.start()
+        self.activity_log.start()
+        self.state = "ready"
+    
+    
+    def close(self):
+        self.state = "stopping"
+        self.notify_listener.stop()
+        self.activity_log.stop()
+        self.db_handler.close()
+    
+    
+    def readiness(self):
+        readiness = {"status": self.state, "pid": os.getpid(), **self.db_handler.pool_state()}
+        if self.state != "ready":
+            return readiness, status.HTTP_503_SERVICE_UNAVAILABLE
 
-    def __cursor_to_entities(self, cursor, pydantic_model):
-        entities = []
+        try:
+            self.db_handler.ping(self.readiness_timeout)
+        except (psycopg2.Error, PoolError) as e:
+            return {**readiness, "status": "unavailable", "detail": f"{e}".split('\n')[0]}, status.HTTP_503_SERVICE_UNAVAILABLE
+        return readiness, status.HTTP_200_OK
+    
+    
+    def cache_stats(self):
+        return {
+            "cars": self.cars_cache.stats(),
+            "car": self.car_cache.stats(),
+            "reference": self.reference_cache.stats(),
+            "session": self.session_cache.stats(),
+            "activity_log": self.activity_log.stats(),
+        }
+    
+    
+    def clear_caches(self):
+        self.cars_cache.clear()
+        self.car_cache.clear()
+        self.recent_car_changes.set(("cars",), True)
+        self.recent_car_changes.set(("car",), True)
+    
+    
+    def invalidate_car(self, car_id: int = None):
+        self.cars_cache.clear()
+        self.recent_car_changes.set(("cars",), True)
+        if car_id is not None:
+            self.car_cache.invalidate((car_id,))
+            self.recent_car_changes.set(("car", car_id), True)
+    
+    
+    def user_wrote(self, user_id: int):
+        self.recent_writers.set((user_id,), True)
+    
+    
+    def user_wrote_recently(self, user_id: int, *args):
+        return self.recent_writers.get((user_id,)) is not MISSING
+    
+    
+    # A replica could still have what the cache was just cleared of
+    def cars_changed_recently(self, *args):
+        return self.recent_car_changes.get(("cars",)) is not MISSING
+    
+    
+    def car_changed_recently(self, car_id: int):
+        return (
+            self.recent_car_changes.get(("car", car_id)) is not MISSING
+            or self.recent_car_changes.get(("car",)) is not MISSING
+        )
+    
+    
+    def __on_car_change(self, payload):
+        self.invalidate_car(int(payload) if payload else None)
+    
+    
+    def __on_user_change(self, payload):
+        self.session_cache.invalidate((int(payload),))
+    
+    
+    def __version(self, resource, params=()):
+        # The version behind a resource's ETag, see 0012_resource_versions.sql
+        statement = f"get_{resource}_version"
+        result = self.db_handler.prepared_sql(
+            statement, f"SELECT {statement}({', '.join(['%s'] * len(params))});", params
+        )
+        return result.fetchone()[0]
+    
+    
+    def check_user(self, user_id: int, token_generation: int = None):
+        # What check_user_status would raise, from the session cache when it is warm.
+        # A token issued before the user's last logout is refused as well
+        session = self.session_cache.get((user_id,))
+        if session is MISSING:
+            generation = self.session_cache.generation
+            # Joins the caller's transaction, or borrows a connection of its own for a token check
+            with self.db_handler.transaction(read_only=True, primary=self.user_wrote_recently(user_id)):
+                try:
+                    result = self.db_handler.prepared_sql("user_session",
+                    """
+                        SELECT status, role_id, session_generation FROM users WHERE id = %s;
+                    """, (user_id,)
+                    )
+                except psycopg2.Error as e:
+                    self.db_handler.connection.rollback()
+                    return f"Cannot check user: {e}".split('\n')[0]
+                session = result.fetchone()
+            self.session_cache.set((user_id,), session, generation)
         
-        for row in cursor:
-            entity = self.__row_to_entity(row, pydantic_model)
-            entities.append(entity)
-        return entities
-
-
+        if session is None:
+            return f"User with id {user_id} does not exist"
+        if token_generation is not None and token_generation < session[2]:
+            return "Session token has been revoked by a logout"
+        if session[0] == "inactive":
+            return "User is inactive"
+        return None
+        
+    
+    @timed
+    @read_only("cars_changed_recently")
+    def get_version(self, resource, *params):
+        try:
+            version = self.__version(resource, params)
+        except psycopg2.Error as e:
+            self.db_handler.connection.rollback()
+            return f"Cannot get {resource} version: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            self.db_handler.connection.commit()
+            return version, status.HTTP_200_OK
+    
+    
+    @timed
     def get_all_roles(self):
-        result = self.db_handler.raw_sql("""SELECT name, permission FROM roles;""")
-        roles = self.__cursor_to_entities(result, Role)
-        return roles, status.HTTP_200_OK
+        return self.reference_cache.roles(), status.HTTP_200_OK
     
     
+    @timed
+    @transactional
     def register(self, user_register: UserRegister):
         try:
             result = self.db_handler.raw_sql(
@@ -62,11 +331,13 @@ class ServiceHandler(object):
             return {"id": result.fetchone()[0]}, status.HTTP_200_OK
     
     
+    @timed
+    @transactional
     def login(self, user_login: UserLogin):
         try:
-            _ = self.db_handler.raw_sql(
+            result = self.db_handler.raw_sql(
             """
-                CALL user_login(%s, %s);
+                SELECT user_id, status, role_id, session_generation FROM login_user(%s, %s);
             """, (user_login.email, user_login.password)
             )
         except psycopg2.Error as e:
@@ -74,9 +345,22 @@ class ServiceHandler(object):
             return f"Cannot login: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
-            return "Successful login!", status.HTTP_200_OK
+            
+            user_id, user_status, role_id, session_generation = result.fetchone()
+            self.session_cache.set((user_id,), (user_status, role_id, session_generation))
+            self.user_wrote(user_id)
+            self.activity_log.record(user_id, "login")
+            
+            return {
+                "user_id": user_id,
+                "token": self.session_tokens.issue(user_id, session_generation),
+                "token_type": "bearer",
+                "expires_in": int(self.session_tokens.ttl),
+            }, status.HTTP_200_OK
         
         
+    @timed
+    @transactional
     def logout(self, user_id: int, choice: bool):
         try:
             _ = self.db_handler.raw_sql(
@@ -89,14 +373,25 @@ class ServiceHandler(object):
             return f"Cannot logout: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
+            self.session_cache.invalidate((user_id,))
+            self.user_wrote(user_id)
+            self.activity_log.record(user_id, "logout")
             return "Successful logout!", status.HTTP_200_OK
         
         
+    @timed
+    @read_only("user_wrote_recently")
+    @verified_user
     def user_profile(self, user_id: int):
         try:
-            result = self.db_handler.raw_sql(
+            result = self.db_handler.prepared_sql("user_profile",
             """
-                SELECT user_profile(%s);
+                SELECT
+                    given_name, surname, passport_no, identification_no,
+                    license_no, telephone_no, email, date_of_birth,
+                    password, is_owner, avatar_url, status,
+                    role_name, permission AS role_permission
+                FROM user_profile(%s);
             """, (user_id,)
             )
         except psycopg2.Error as e:
@@ -105,31 +400,14 @@ class ServiceHandler(object):
         else:
             self.db_handler.connection.commit()
             
-            data_string = result.fetchone()[0]
-            data_list = list(map(lambda x: x.replace('\"', ''), data_string[1:-1].split(',')))
-
-            formatted_data = {
-                "given_name": data_list[0],
-                "surname": data_list[1],
-                "passport_no": data_list[2],
-                "identification_no": data_list[3],
-                "license_no": data_list[4],
-                "telephone_no": data_list[5],
-                "email": data_list[6],
-                "date_of_birth": data_list[7],
-                "password": data_list[8],
-                "is_owner": data_list[9],
-                "avatar_url": data_list[10],
-                "status": data_list[11],
-                "role_name": data_list[12],
-                "role_permission": data_list[13]
-            }
-            
-            json_data = json.dumps(formatted_data, indent=2)
+            profile = decode_row(result.description, result.fetchone(), UserProfile)
             
-            return json_data, status.HTTP_200_OK
+            return profile, status.HTTP_200_OK
         
         
+    @timed
+    @transactional
+    @verified_user
     def edit_profile(self, user_id: int, edit_user: EditUser):
         try:
             _ = self.db_handler.raw_sql(
@@ -148,30 +426,74 @@ class ServiceHandler(object):
             return "Successful editing!", status.HTTP_200_OK
         
         
+    def __insert_car(self, user_id: int, car: AddCar, reference_ids):
+        return self.db_handler.raw_sql(
+        """
+            SELECT add_car(
+                %s, %s, %s, %s, %s, %s, %s, %s,
+                ARRAY[%s]::VARCHAR[],
+                %s, %s, %s
+            ) AS id;
+        """, (
+            user_id, car.type_name,
+            car.brand, car.model,
+            car.fuel_type, car.registration_plate,
+            car.price_per_day, car.description,
+            car.images, *reference_ids
+            )
+        )
+    
+    
+    @timed
+    @transactional
+    @verified_user
     def add_car(self, user_id: int, car: AddCar):
+        reference_ids = self.reference_cache.car_ids(car.type_name, car.brand, car.model, car.fuel_type)
         try:
-            result = self.db_handler.raw_sql(
-            """
-                SELECT add_car(
-                    %s, %s, %s, %s, %s, %s, %s, %s,
-                    ARRAY[%s]::VARCHAR[]
-                ) AS id;
-            """, (
-                user_id, car.type_name,
-                car.brand, car.model,
-                car.fuel_type, car.registration_plate,
-                car.price_per_day, car.description,
-                car.images
-                )
-            )
+            try:
+                result = self.__insert_car(user_id, car, reference_ids)
+            except psycopg2.errors.ForeignKeyViolation:
+                # A cached id no longer exists, let add_car resolve all of them
+                self.db_handler.connection.rollback()
+                self.reference_cache.invalidate()
+                reference_ids = (None, None, None)
+                result = self.__insert_car(user_id, car, reference_ids)
         except psycopg2.Error as e:
             self.db_handler.connection.rollback()
             return f"Cannot add car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
-            return {"id": result.fetchone()[0]}, status.HTTP_200_OK
+            if None in reference_ids:
+                self.reference_cache.invalidate()
+            self.invalidate_car()
+            car_id = result.fetchone()[0]
+            self.activity_log.record(user_id, f"add car {car_id}")
+            return {"id": car_id}, status.HTTP_200_OK
         
     
+    @timed
+    def import_cars(self, user_id: int, body: bytes, content_type: str):
+        try:
+            rows = parse_rows(body, content_type)
+        except ValueError as e:
+            return f"Cannot import cars: {e}", status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        
+        try:
+            result = self.bulk_importer.import_cars(user_id, rows)
+        except UnicodeDecodeError as e:
+            return f"Cannot import cars: {e}", status.HTTP_400_BAD_REQUEST
+        except psycopg2.Error as e:
+            return f"Cannot import cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            if result["inserted"]:
+                self.invalidate_car()
+                self.activity_log.record(user_id, f"import {result['inserted']} cars")
+            return result, status.HTTP_200_OK
+        
+    
+    @timed
+    @transactional
+    @verified_user
     def delete_car(self, user_id: int, car_id: int):
         try:
             _ = self.db_handler.raw_sql(
@@ -184,9 +506,14 @@ class ServiceHandler(object):
             return f"Cannot delete car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
+            self.invalidate_car(car_id)
+            self.activity_log.record(user_id, f"delete car {car_id}")
             return "Successful deliting!", status.HTTP_200_OK
         
         
+    @timed
+    @transactional
+    @verified_user
     def update_car(self, user_id: int, car_id: int, update_car: UpdateCar):
         try:
             _ = self.db_handler.raw_sql(
@@ -202,15 +529,28 @@ class ServiceHandler(object):
             return f"Cannot update car: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
+            self.invalidate_car(car_id)
+            self.activity_log.record(user_id, f"update car {car_id}")
             return "Successful updating!", status.HTTP_200_OK
         
         
-    def get_available_cars(self):
+    @timed
+    @cached("cars_cache")
+    @read_only("cars_changed_recently")
+    def get_available_cars(self, after_car_id: int = None, page_size: int = 50,
+                           type_name: str = None, brand: str = None, fuel_type: str = None,
+                           min_price: float = None, max_price: float = None):
         try:
-            result = self.db_handler.raw_sql(
-            """
-                SELECT get_available_cars();
+            # Read before the page, so the page is never older than its version
+            version = self.__version("catalogue")
+            result = self.db_handler.prepared_sql("get_available_cars",
             """
+                SELECT * FROM get_available_cars(%s, %s, %s, %s, %s, %s, %s);
+            """, (
+                after_car_id, page_size,
+                type_name, brand, fuel_type,
+                min_price, max_price
+                )
             )
         except psycopg2.Error as e:
             self.db_handler.connection.rollback()
@@ -218,31 +558,98 @@ class ServiceHandler(object):
         else:
             self.db_handler.connection.commit()
             
-            data = result.fetchall()
+            cars = decode_rows(result.description, result.fetchall(), Cars)
             
-            parsed_data = []
-            for item in data:
-                item_data = item[0].strip('()').split(',')
-                parsed_data.append({
-                    'car_id': int(item_data[0]),
-                    'type_name': item_data[1],
-                    'brand': item_data[2],
-                    'model': item_data[3],
-                    'fuel_type': item_data[4],
-                    'price_per_day': float(item_data[5]),
-                    'main_image_url': item_data[6]
-                })
-
-            json_data = json.dumps(parsed_data, indent=2)
+            return (version, cars), status.HTTP_200_OK
+        
+        
+    @timed
+    @read_only()
+    def search_cars(self, query: str, page_size: int = 20):
+        try:
+            result = self.db_handler.prepared_sql("search_cars",
+            """
+                SELECT * FROM search_cars(%s, %s);
+            """, (query, page_size)
+            )
+        except psycopg2.Error as e:
+            self.db_handler.connection.rollback()
+            return f"Cannot search cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            self.db_handler.connection.commit()
             
-            return json_data, status.HTTP_200_OK
+            cars = decode_rows(result.description, result.fetchall(), Cars)
+            
+            return cars, status.HTTP_200_OK
         
+    
+    @timed
+    def export_cars(self):
+        batches = self.db_handler.stream(
+        """
+            SELECT * FROM export_cars();
+        """, batch_size=self.export_batch_size, read_only=True
+        )
+        try:
+            description = next(batches)
+        except psycopg2.Error as e:
+            return f"Cannot export cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        
+        # Decoded a batch at a time while the response is being sent
+        return (decode_rows(description, rows, Cars) for rows in batches), status.HTTP_200_OK
         
+    
+    @timed
+    def export_ledger(self, table: str, fmt: str, date_from=None, date_to=None, watermark: str = None):
+        try:
+            export = self.ledger_exporter.export(table, fmt, date_from, date_to, watermark)
+        except SettleTimeout as e:
+            return f"Cannot export {table}: {e}", status.HTTP_503_SERVICE_UNAVAILABLE
+        except LedgerError as e:
+            return f"Cannot export {table}: {e}", status.HTTP_400_BAD_REQUEST
+        except psycopg2.Error as e:
+            return f"Cannot export {table}: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        
+        return (export, self.__ledger_chunks(export)), status.HTTP_200_OK
+    
+    
+    def __ledger_chunks(self, export):
+        # The watermark only moves once the last chunk has been handed to the response
+        try:
+            yield from export.chunks()
+            export.advance_watermark()
+        finally:
+            export.close()
+        
+    
+    @timed
+    @read_only()
+    def get_free_cars(self, start_date, end_date, after_car_id: int = None, page_size: int = 50):
+        try:
+            result = self.db_handler.prepared_sql("get_free_cars",
+            """
+                SELECT * FROM get_free_cars(%s, %s, %s, %s);
+            """, (start_date, end_date, after_car_id, page_size)
+            )
+        except psycopg2.Error as e:
+            self.db_handler.connection.rollback()
+            return f"Cannot get free cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, result.fetchall(), Cars)
+            
+            return cars, status.HTTP_200_OK
+        
+        
+    @timed
+    @cached("car_cache")
+    @read_only("car_changed_recently")
     def get_available_car(self, car_id: int):
         try:
-            result = self.db_handler.raw_sql(
+            result = self.db_handler.prepared_sql("get_available_car",
             """
-                SELECT get_available_car(%s);
+                SELECT * FROM get_available_car(%s);
             """, (car_id,)
             )
         except psycopg2.Error as e:
@@ -251,48 +658,44 @@ class ServiceHandler(object):
         else:
             self.db_handler.connection.commit()
             
-            data_string = result.fetchone()[0]
-            data_string = data_string[1:-1]
-
-            split_data = []
-            current = ''
-            quoted = False
-
-            for char in data_string:
-                if char == ',' and not quoted:
-                    split_data.append(current)
-                    current = ''
-                elif char == '"':
-                    quoted = not quoted
-                    current += char
-                else:
-                    current += char
-
-            split_data.append(current) 
-            split_data = [item.replace('"', '') for item in split_data]
-
-            car_data = {
-                "type_name": split_data[0],
-                "brand": split_data[1],
-                "model": split_data[2],
-                "fuel_type": split_data[3],
-                "registration_plate": split_data[4],
-                "price_per_day": float(split_data[5]),
-                "description": split_data[6],
-                "images": split_data[7][1:-1].split(','),  # Преобразуем в список из одного элемента
-                "given_name": split_data[8],
-                "telephone_no": split_data[9]
-            }
-
-            # Преобразуем в JSON
-            json_data = json.dumps(car_data, indent=2)
+            row = result.fetchone()
+            if row is None:
+                return f"Cannot get available car: Car with id {car_id} is not available", status.HTTP_400_BAD_REQUEST
+            
+            car = decode_row(result.description, row, CurrentCar)
+            
+            # get_available_car returns the car's version last
+            return (row[-1], car), status.HTTP_200_OK
+        
+        
+    @timed
+    @read_only()
+    def get_cars_by_ids(self, car_ids):
+        try:
+            result = self.db_handler.prepared_sql("get_cars_by_ids",
+            """
+                SELECT * FROM get_cars_by_ids(%s);
+            """, (car_ids,)
+            )
+        except psycopg2.Error as e:
+            self.db_handler.connection.rollback()
+            return f"Cannot get cars: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            self.db_handler.connection.commit()
+            
+            cars = decode_rows(result.description, result.fetchall(), CarDetails)
+            found_ids = {car.car_id for car in cars}
+            missing_ids = [car_id for car_id in dict.fromkeys(car_ids) if car_id not in found_ids]
             
-            return json_data, status.HTTP_200_OK
+            return CarBatch(cars=cars, missing_ids=missing_ids), status.HTTP_200_OK
         
         
+    @timed
+    @transactional
+    @verified_user
     def make_review(self, user_id: int, car_id: int, message: str):
         try:
-            result = self.db_handler.raw_sql(
+            result = self.db_handler.prepared_sql("make_review",
             """
                 SELECT make_review(
                     %s, %s, %s
@@ -306,15 +709,21 @@ class ServiceHandler(object):
             return f"Cannot make review: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
-            return {"id": result.fetchone()[0]}, status.HTTP_200_OK
+            self.invalidate_car(car_id)
+            review_id = result.fetchone()[0]
+            self.activity_log.record(user_id, f"review {review_id} of car {car_id}")
+            return {"id": review_id}, status.HTTP_200_OK
         
         
-    def get_reviews(self, car_id: int):
+    @timed
+    @read_only()
+    def get_reviews(self, car_id: int, before_review_id: int = None, page_size: int = 50):
         try:
-            result = self.db_handler.raw_sql(
+            version = self.__version("reviews", (car_id,))
+            result = self.db_handler.prepared_sql("get_reviews",
             """
-                SELECT get_reviews(%s);
-            """, (car_id,)
+                SELECT * FROM get_reviews(%s, %s, %s);
+            """, (car_id, before_review_id, page_size)
             )
         except psycopg2.Error as e:
             self.db_handler.connection.rollback()
@@ -322,24 +731,17 @@ class ServiceHandler(object):
         else:
             self.db_handler.connection.commit()
             
-            data = result.fetchall()
-            
-            parsed_data = []
-            for item in data:
-                item_data = item[0].strip('()').split(',')
-                parsed_data.append({
-                    'given_name': item_data[0],
-                    'message': item_data[1]
-                })
-
-            json_data = json.dumps(parsed_data, indent=2)
+            reviews = decode_rows(result.description, result.fetchall(), Review)
             
-            return json_data, status.HTTP_200_OK
+            return (version, reviews), status.HTTP_200_OK
         
     
+    @timed
+    @transactional
+    @verified_user
     def add_to_favourites(self, user_id: int, car_id: int):
         try:
-            result = self.db_handler.raw_sql(
+            result = self.db_handler.prepared_sql("add_to_favourites",
             """
                 SELECT add_to_favourites(
                     %s, %s
@@ -354,11 +756,15 @@ class ServiceHandler(object):
             return {"id": result.fetchone()[0]}, status.HTTP_200_OK
         
         
+    @timed
+    @read_only("user_wrote_recently")
+    @verified_user
     def get_favourites(self, user_id: int):
         try:
-            result = self.db_handler.raw_sql(
+            version = self.__version("favourites", (user_id,))
+            result = self.db_handler.prepared_sql("get_favourites",
             """
-                SELECT get_favourites(%s);
+                SELECT * FROM get_favourites(%s);
             """, (user_id,)
             )
         except psycopg2.Error as e:
@@ -367,29 +773,61 @@ class ServiceHandler(object):
         else:
             self.db_handler.connection.commit()
             
-            data = result.fetchall()
+            cars = decode_rows(result.description, result.fetchall(), Cars)
             
-            parsed_data = []
-            for item in data:
-                item_data = item[0].strip('()').split(',')
-                parsed_data.append({
-                    'car_id': int(item_data[0]),
-                    'type_name': item_data[1],
-                    'brand': item_data[2],
-                    'model': item_data[3],
-                    'fuel_type': item_data[4],
-                    'price_per_day': float(item_data[5]),
-                    'main_image_url': item_data[6]
-                })
-
-            json_data = json.dumps(parsed_data, indent=2)
+            return (version, cars), status.HTTP_200_OK
+        
+        
+    @timed
+    @read_only("user_wrote_recently")
+    @verified_user
+    def get_favourites_version(self, user_id: int):
+        try:
+            version = self.__version("favourites", (user_id,))
+        except psycopg2.Error as e:
+            self.db_handler.connection.rollback()
+            return f"Cannot get favourites version: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            self.db_handler.connection.commit()
+            return version, status.HTTP_200_OK
+        
+        
+    @timed
+    @read_only("user_wrote_recently")
+    @verified_user
+    def get_owner_analytics(self, user_id: int):
+        try:
+            # Totals and per-car rows from one snapshot, so they add up under concurrent rentals
+            with self.db_handler.snapshot():
+                totals = self.db_handler.raw_sql(
+                """
+                    SELECT * FROM get_owner_analytics(%s);
+                """, (user_id,)
+                )
+                analytics = decode_row(totals.description, totals.fetchone(), OwnerAnalytics)
+                
+                cars = self.db_handler.raw_sql(
+                """
+                    SELECT * FROM get_car_analytics(%s);
+                """, (user_id,)
+                )
+        except psycopg2.Error as e:
+            self.db_handler.connection.rollback()
+            return f"Cannot get analytics: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+        else:
+            self.db_handler.connection.commit()
             
-            return json_data, status.HTTP_200_OK
+            analytics.cars = decode_rows(cars.description, cars.fetchall(), CarAnalytics)
+            
+            return analytics, status.HTTP_200_OK
         
         
+    @timed
+    @transactional
+    @verified_user
     def make_rent(self, user_id, car_id, rental_deal: RentalDeal):
         try:
-            result = self.db_handler.raw_sql(
+            result = self.db_handler.prepared_sql("make_rent",
             """
                 SELECT make_rent(%s, %s, %s, %s, %s, %s);
             """, (
@@ -397,9 +835,20 @@ class ServiceHandler(object):
                 rental_deal.start_date, rental_deal.end_date
                 )
             )
+        except psycopg2.errors.ExclusionViolation:
+            self.db_handler.connection.rollback()
+            return (
+                f"Cannot make rent: Car {car_id} is already rented between "
+                f"{rental_deal.start_date} and {rental_deal.end_date}"
+            ), status.HTTP_409_CONFLICT
         except psycopg2.Error as e:
             self.db_handler.connection.rollback()
-            return f"Cannot add to favourites: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
+            return f"Cannot make rent: {e}".split('\n')[0], status.HTTP_400_BAD_REQUEST
         else:
             self.db_handler.connection.commit()
-            return {"id": result.fetchone()[0]}, status.HTTP_200_OK
\ No newline at end of file
+            self.invalidate_car(car_id)
+            deal_id = result.fetchone()[0]
+            self.activity_log.record(
+                user_id, f"rent car {car_id} from {rental_deal.start_date} to {rental_deal.end_date}, deal {deal_id}"
+            )
+            return {"id": deal_id}, status.HTTP_200_OK
\ No newline at end of file
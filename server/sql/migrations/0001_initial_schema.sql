@@ -1,24 +1,3 @@
-DROP TABLE IF EXISTS roles CASCADE;
-DROP TABLE IF EXISTS admin CASCADE;
-DROP TABLE IF EXISTS users CASCADE;
-DROP TABLE IF EXISTS payments CASCADE;
-DROP TABLE IF EXISTS user_logs CASCADE;
-DROP TABLE IF EXISTS car_types CASCADE;
-DROP TABLE IF EXISTS brands CASCADE;
-DROP TABLE IF EXISTS fuel_types CASCADE;
-DROP TABLE IF EXISTS car_images CASCADE;
-DROP TABLE IF EXISTS reviews CASCADE;
-DROP TABLE IF EXISTS cars CASCADE;
-DROP TABLE IF EXISTS favorite_cars CASCADE;
-DROP TABLE IF EXISTS pick_up_location CASCADE;
-DROP TABLE IF EXISTS rental_deals CASCADE;
-DROP TABLE IF EXISTS taxes CASCADE;
-DROP TYPE IF EXISTS ACTIVITY_STATUS_TYPE CASCADE;
-DROP TYPE IF EXISTS CAR_TYPE CASCADE;
-DROP TYPE IF EXISTS CAR_BRAND CASCADE;
-DROP TYPE IF EXISTS FUEL_TYPE CASCADE;
-
-
 CREATE TYPE ACTIVITY_STATUS_TYPE AS ENUM (
     'active', 'inactive'
 );
@@ -139,6 +118,14 @@ CREATE TABLE IF NOT EXISTS cars (
 );
 
 
+CREATE INDEX IF NOT EXISTS cars_available_id_idx ON cars (id) WHERE is_available;
+CREATE INDEX IF NOT EXISTS cars_available_car_type_idx ON cars (car_type_id, id) WHERE is_available;
+CREATE INDEX IF NOT EXISTS cars_available_brand_idx ON cars (brand_id, id) WHERE is_available;
+CREATE INDEX IF NOT EXISTS cars_available_fuel_type_idx ON cars (fuel_type_id, id) WHERE is_available;
+CREATE INDEX IF NOT EXISTS cars_available_price_idx ON cars (price_per_day, id) WHERE is_available;
+CREATE INDEX IF NOT EXISTS brands_name_idx ON brands (name);
+
+
 CREATE TABLE IF NOT EXISTS car_images (
     id SERIAL PRIMARY KEY NOT NULL UNIQUE,
     car_id INT REFERENCES cars(id) ON DELETE CASCADE,
@@ -146,6 +133,9 @@ CREATE TABLE IF NOT EXISTS car_images (
 );
 
 
+CREATE INDEX IF NOT EXISTS car_images_car_id_idx ON car_images (car_id, id);
+
+
 CREATE TABLE IF NOT EXISTS reviews (
     id SERIAL PRIMARY KEY NOT NULL UNIQUE,
     car_id INT REFERENCES cars(id) ON DELETE CASCADE,
@@ -605,7 +595,7 @@ BEGIN
     CALL delete_brand(brand_id_var);
 
     DELETE FROM cars WHERE id = car_id;
-    DELETE FROM car_images WHERE car_id = car_id;
+    DELETE FROM car_images WHERE car_images.car_id = delete_car.car_id;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -631,32 +621,108 @@ FOR EACH ROW
 EXECUTE FUNCTION update_user_status_false();
 
 
-CREATE OR REPLACE FUNCTION get_available_cars() 
+-- Tells API workers which car to drop from their caches, delivered on commit
+CREATE OR REPLACE FUNCTION notify_car_change() RETURNS TRIGGER AS $$
+DECLARE
+    changed_row JSONB;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_row := to_jsonb(OLD);
+    ELSE
+        changed_row := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify('car_changes', COALESCE(changed_row ->> TG_ARGV[0], ''));
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER cars_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON cars
+FOR EACH ROW
+EXECUTE FUNCTION notify_car_change('id');
+
+
+CREATE TRIGGER car_images_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON car_images
+FOR EACH ROW
+EXECUTE FUNCTION notify_car_change('car_id');
+
+
+CREATE TRIGGER rental_deals_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON rental_deals
+FOR EACH ROW
+EXECUTE FUNCTION notify_car_change('car_id');
+
+
+CREATE OR REPLACE FUNCTION get_available_cars(
+    after_car_id INT DEFAULT NULL, page_size INT DEFAULT 50,
+    filter_type_name CAR_TYPE DEFAULT NULL, filter_brand CAR_BRAND DEFAULT NULL,
+    filter_fuel_type FUEL_TYPE DEFAULT NULL,
+    min_price NUMERIC DEFAULT NULL, max_price NUMERIC DEFAULT NULL
+) 
 RETURNS TABLE (
     car_id INT, type_name CAR_TYPE,
     brand CAR_BRAND, model VARCHAR,
     fuel_type FUEL_TYPE, price_per_day NUMERIC,
     main_image_url VARCHAR
 ) AS $$
+DECLARE
+    query TEXT;
 BEGIN
-    RETURN QUERY
-    SELECT 
-        cars.id, car_types.type_name,
-        brands.name, brands.model,
-        fuel_types.type_name, cars.price_per_day,
-        (SELECT url FROM car_images WHERE car_images.car_id = cars.id LIMIT 1) AS main_image_url
-    FROM 
-        cars
-    JOIN 
-        car_types ON cars.car_type_id = car_types.id
-    JOIN 
-        brands ON cars.brand_id = brands.id
-    JOIN 
-        fuel_types ON cars.fuel_type_id = fuel_types.id
-    WHERE 
-        cars.is_available = TRUE
-    GROUP BY 
-        cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name, cars.price_per_day;
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    -- Only the filters that were passed end up in the query, so every call
+    -- is planned against the matching partial index on cars
+    query := '
+        SELECT 
+            cars.id, car_types.type_name,
+            brands.name, brands.model,
+            fuel_types.type_name, cars.price_per_day,
+            (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1)
+        FROM 
+            cars
+        JOIN 
+            car_types ON cars.car_type_id = car_types.id
+        JOIN 
+            brands ON cars.brand_id = brands.id
+        JOIN 
+            fuel_types ON cars.fuel_type_id = fuel_types.id
+        WHERE 
+            cars.is_available = TRUE';
+
+    IF after_car_id IS NOT NULL THEN
+        query := query || ' AND cars.id > $1';
+    END IF;
+
+    IF filter_type_name IS NOT NULL THEN
+        query := query || ' AND car_types.type_name = $3';
+    END IF;
+
+    IF filter_brand IS NOT NULL THEN
+        query := query || ' AND brands.name = $4';
+    END IF;
+
+    IF filter_fuel_type IS NOT NULL THEN
+        query := query || ' AND fuel_types.type_name = $5';
+    END IF;
+
+    IF min_price IS NOT NULL THEN
+        query := query || ' AND cars.price_per_day >= $6';
+    END IF;
+
+    IF max_price IS NOT NULL THEN
+        query := query || ' AND cars.price_per_day <= $7';
+    END IF;
+
+    query := query || ' ORDER BY cars.id LIMIT $2';
+
+    RETURN QUERY EXECUTE query
+    USING after_car_id, page_size, filter_type_name, filter_brand, filter_fuel_type, min_price, max_price;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -0,0 +1,42 @@
+-- Every foreign key gets an index on the referencing side: the stored
+-- functions look rows up by these columns and ON DELETE CASCADE / SET NULL
+-- would otherwise scan the whole child table for each deleted parent row
+
+
+-- delete_car, update_user_status_false and the users -> cars cascade
+CREATE INDEX IF NOT EXISTS cars_owner_id_idx ON cars (owner_id);
+
+-- delete_car_type / delete_brand / delete_fuel_type count cars of every
+-- availability, the cars_available_* partial indexes do not cover them
+CREATE INDEX IF NOT EXISTS cars_car_type_id_idx ON cars (car_type_id);
+CREATE INDEX IF NOT EXISTS cars_brand_id_idx ON cars (brand_id);
+CREATE INDEX IF NOT EXISTS cars_fuel_type_id_idx ON cars (fuel_type_id);
+
+-- The unfiltered car listing reads every cars column it needs from the
+-- index, so a page is an index-only scan plus the lookup joins
+DROP INDEX IF EXISTS cars_available_id_idx;
+CREATE INDEX cars_available_id_idx ON cars (id)
+    INCLUDE (car_type_id, brand_id, fuel_type_id, price_per_day)
+    WHERE is_available;
+
+-- create_brand looks brands up by name and model, the name prefix still
+-- serves the brand filter of get_available_cars
+DROP INDEX IF EXISTS brands_name_idx;
+CREATE INDEX IF NOT EXISTS brands_name_model_idx ON brands (name, model);
+
+CREATE INDEX IF NOT EXISTS car_types_type_name_idx ON car_types (type_name);
+CREATE INDEX IF NOT EXISTS fuel_types_type_name_idx ON fuel_types (type_name);
+
+-- get_reviews
+CREATE INDEX IF NOT EXISTS reviews_car_id_idx ON reviews (car_id, id);
+
+-- get_favourites reads car ids straight from the index
+CREATE INDEX IF NOT EXISTS favorite_cars_user_id_idx ON favorite_cars (user_id, car_id);
+CREATE INDEX IF NOT EXISTS favorite_cars_car_id_idx ON favorite_cars (car_id);
+
+CREATE INDEX IF NOT EXISTS rental_deals_car_id_idx ON rental_deals (car_id);
+CREATE INDEX IF NOT EXISTS rental_deals_user_id_idx ON rental_deals (user_id);
+
+CREATE INDEX IF NOT EXISTS payments_user_id_idx ON payments (user_id);
+CREATE INDEX IF NOT EXISTS taxes_rental_deal_id_idx ON taxes (rental_deal_id);
+CREATE INDEX IF NOT EXISTS user_logs_user_id_idx ON user_logs (user_id);
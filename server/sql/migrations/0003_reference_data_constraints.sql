@@ -0,0 +1,218 @@
+-- Concurrent create_* calls could insert the same lookup row twice, fold
+-- the duplicates into the oldest row before making the columns unique
+
+WITH duplicates AS (
+    SELECT id, MIN(id) OVER (PARTITION BY type_name) AS kept_id FROM car_types
+)
+UPDATE cars SET car_type_id = duplicates.kept_id
+FROM duplicates
+WHERE cars.car_type_id = duplicates.id AND duplicates.id <> duplicates.kept_id;
+
+DELETE FROM car_types
+USING (SELECT id, MIN(id) OVER (PARTITION BY type_name) AS kept_id FROM car_types) duplicates
+WHERE car_types.id = duplicates.id AND duplicates.id <> duplicates.kept_id;
+
+
+WITH duplicates AS (
+    SELECT id, MIN(id) OVER (PARTITION BY name, model) AS kept_id FROM brands
+)
+UPDATE cars SET brand_id = duplicates.kept_id
+FROM duplicates
+WHERE cars.brand_id = duplicates.id AND duplicates.id <> duplicates.kept_id;
+
+DELETE FROM brands
+USING (SELECT id, MIN(id) OVER (PARTITION BY name, model) AS kept_id FROM brands) duplicates
+WHERE brands.id = duplicates.id AND duplicates.id <> duplicates.kept_id;
+
+
+WITH duplicates AS (
+    SELECT id, MIN(id) OVER (PARTITION BY type_name) AS kept_id FROM fuel_types
+)
+UPDATE cars SET fuel_type_id = duplicates.kept_id
+FROM duplicates
+WHERE cars.fuel_type_id = duplicates.id AND duplicates.id <> duplicates.kept_id;
+
+DELETE FROM fuel_types
+USING (SELECT id, MIN(id) OVER (PARTITION BY type_name) AS kept_id FROM fuel_types) duplicates
+WHERE fuel_types.id = duplicates.id AND duplicates.id <> duplicates.kept_id;
+
+
+-- The unique constraints replace the plain lookup indexes
+DROP INDEX IF EXISTS car_types_type_name_idx;
+DROP INDEX IF EXISTS brands_name_model_idx;
+DROP INDEX IF EXISTS fuel_types_type_name_idx;
+
+ALTER TABLE car_types ADD CONSTRAINT car_types_type_name_key UNIQUE (type_name);
+ALTER TABLE brands ADD CONSTRAINT brands_name_model_key UNIQUE (name, model);
+ALTER TABLE fuel_types ADD CONSTRAINT fuel_types_type_name_key UNIQUE (type_name);
+
+
+-- Look the row up first, the insert only runs for a new value. ON CONFLICT
+-- makes a concurrent insert of the same value wait and then do nothing,
+-- the second SELECT sees the row it committed
+CREATE OR REPLACE FUNCTION create_car_type(
+    car_type_name CAR_TYPE
+) RETURNS INT AS $$
+DECLARE
+    car_type_id INT;
+BEGIN
+    SELECT id INTO car_type_id FROM car_types WHERE type_name = car_type_name;
+
+    IF NOT FOUND THEN
+        INSERT INTO car_types (type_name) VALUES (car_type_name)
+        ON CONFLICT (type_name) DO NOTHING
+        RETURNING id INTO car_type_id;
+    END IF;
+
+    IF car_type_id IS NULL THEN
+        SELECT id INTO car_type_id FROM car_types WHERE type_name = car_type_name;
+    END IF;
+
+    RETURN car_type_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION create_brand(
+    car_name CAR_BRAND,
+    car_model VARCHAR
+) RETURNS INT AS $$
+DECLARE
+    brand_id INT;
+BEGIN
+    SELECT id INTO brand_id FROM brands WHERE name = car_name AND model = car_model;
+
+    IF NOT FOUND THEN
+        INSERT INTO brands (name, model) VALUES (car_name, car_model)
+        ON CONFLICT (name, model) DO NOTHING
+        RETURNING id INTO brand_id;
+    END IF;
+
+    IF brand_id IS NULL THEN
+        SELECT id INTO brand_id FROM brands WHERE name = car_name AND model = car_model;
+    END IF;
+
+    RETURN brand_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION create_fuel_type(
+    car_fuel_type FUEL_TYPE
+) RETURNS INT AS $$
+DECLARE
+    fuel_type_id INT;
+BEGIN
+    SELECT id INTO fuel_type_id FROM fuel_types WHERE type_name = car_fuel_type;
+
+    IF NOT FOUND THEN
+        INSERT INTO fuel_types (type_name) VALUES (car_fuel_type)
+        ON CONFLICT (type_name) DO NOTHING
+        RETURNING id INTO fuel_type_id;
+    END IF;
+
+    IF fuel_type_id IS NULL THEN
+        SELECT id INTO fuel_type_id FROM fuel_types WHERE type_name = car_fuel_type;
+    END IF;
+
+    RETURN fuel_type_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Workers pass the ids they already know from their reference cache, only
+-- the missing ones are resolved here
+DROP FUNCTION IF EXISTS add_car(INT, CAR_TYPE, CAR_BRAND, VARCHAR, FUEL_TYPE, VARCHAR, NUMERIC, VARCHAR, VARCHAR[]);
+
+CREATE OR REPLACE FUNCTION add_car(
+    user_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, registration_plate VARCHAR,
+    price_per_day NUMERIC, description VARCHAR, images VARCHAR[],
+    known_car_type_id INT DEFAULT NULL,
+    known_brand_id INT DEFAULT NULL,
+    known_fuel_type_id INT DEFAULT NULL
+) RETURNS INT AS $$
+DECLARE
+    car_type_id INT;
+    brand_id INT;
+    fuel_type_id INT;
+    car_id INT;
+BEGIN
+    CALL validate_add_car(
+        user_id, type_name,
+        brand, model,
+        fuel_type, registration_plate,
+        price_per_day, description
+    );
+
+    car_type_id := COALESCE(known_car_type_id, create_car_type(type_name));
+    brand_id := COALESCE(known_brand_id, create_brand(brand, model));
+    fuel_type_id := COALESCE(known_fuel_type_id, create_fuel_type(fuel_type));
+
+    INSERT INTO cars (
+        owner_id, car_type_id,
+        brand_id, fuel_type_id,
+        registration_plate,
+        price_per_day, description
+        )
+    VALUES (
+        user_id, car_type_id,
+        brand_id, fuel_type_id,
+        registration_plate,
+        price_per_day, description
+        )
+    RETURNING id INTO car_id;
+
+    CALL add_car_images(car_id, images);
+
+    RETURN car_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Lookup rows are kept when their last car goes away: deleting them raced
+-- with owners adding a car of the same brand (brands cascade to cars) and
+-- invalidated ids cached by the API workers
+CREATE OR REPLACE PROCEDURE delete_car(user_id INT, car_id INT) AS $$
+BEGIN
+    CALL check_user_status(user_id);
+
+    DELETE FROM cars WHERE id = car_id;
+    DELETE FROM car_images WHERE car_images.car_id = delete_car.car_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Tells API workers to reload their reference cache, delivered on commit
+CREATE OR REPLACE FUNCTION notify_reference_change() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('reference_changes', TG_TABLE_NAME);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER car_types_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON car_types
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_change();
+
+
+CREATE TRIGGER brands_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON brands
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_change();
+
+
+CREATE TRIGGER fuel_types_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON fuel_types
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_change();
+
+
+CREATE TRIGGER roles_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON roles
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_change();
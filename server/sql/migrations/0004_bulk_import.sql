@@ -0,0 +1,40 @@
+-- Bulk imports set app.bulk_import for their transaction and do the work of
+-- these row triggers once per chunk instead: one owner update and one
+-- "everything changed" notification
+
+
+CREATE OR REPLACE FUNCTION notify_car_change() RETURNS TRIGGER AS $$
+DECLARE
+    changed_row JSONB;
+BEGIN
+    IF current_setting('app.bulk_import', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        changed_row := to_jsonb(OLD);
+    ELSE
+        changed_row := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify('car_changes', COALESCE(changed_row ->> TG_ARGV[0], ''));
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION update_owner_status_true()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.bulk_import', true) = 'on' THEN
+        RETURN NEW;
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM users WHERE id = NEW.owner_id AND is_owner = TRUE) THEN
+        UPDATE users SET is_owner = TRUE WHERE id = NEW.owner_id;
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,171 @@
+-- Rentals are charged per night, (end_date - start_date) days, so the end
+-- date is exclusive and a car can be picked up the day it is returned.
+-- GREATEST keeps old deals with end_date before start_date as empty periods
+ALTER TABLE rental_deals
+    ADD COLUMN period DATERANGE GENERATED ALWAYS AS (daterange(start_date, GREATEST(start_date, end_date), '[)')) STORED;
+
+
+-- make_rent never checked for overlaps, keep the earliest of the active
+-- bookings that overlap and deactivate the later ones
+DO $$
+DECLARE
+    deal RECORD;
+    deactivated INT := 0;
+BEGIN
+    FOR deal IN
+        SELECT id, car_id, period FROM rental_deals
+        WHERE status = 'active' AND car_id IS NOT NULL
+        ORDER BY id
+    LOOP
+        IF EXISTS (
+            SELECT 1 FROM rental_deals earlier
+            WHERE earlier.car_id = deal.car_id
+                AND earlier.id < deal.id
+                AND earlier.status = 'active'
+                AND earlier.period && deal.period
+        ) THEN
+            UPDATE rental_deals SET status = 'inactive' WHERE id = deal.id;
+            deactivated := deactivated + 1;
+        END IF;
+    END LOOP;
+
+    IF deactivated > 0 THEN
+        RAISE NOTICE 'Deactivated % overlapping rental deals', deactivated;
+    END IF;
+END;
+$$;
+
+
+-- One car cannot have two active bookings for the same night. A single
+-- point int4range stands in for car_id equality, so the built-in range
+-- GiST operator classes are enough and btree_gist is not needed. The same
+-- index serves the availability search in get_free_cars
+ALTER TABLE rental_deals ADD CONSTRAINT rental_deals_no_overlap
+    EXCLUDE USING gist (int4range(car_id, car_id, '[]') WITH &&, period WITH &&)
+    WHERE (status = 'active' AND car_id IS NOT NULL);
+
+
+CREATE OR REPLACE FUNCTION get_free_cars(
+    period_start DATE, period_end DATE,
+    after_car_id INT DEFAULT NULL, page_size INT DEFAULT 50
+)
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR
+) AS $$
+DECLARE
+    requested_period DATERANGE;
+BEGIN
+    IF period_end <= period_start THEN
+        RAISE EXCEPTION 'End date should be after start date';
+    END IF;
+
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    requested_period := daterange(period_start, period_end, '[)');
+
+    -- Walks available cars in id order and probes rental_deals_no_overlap
+    -- once per car, so a page costs page_size index probes however many
+    -- bookings there are
+    RETURN QUERY
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    WHERE
+        cars.is_available = TRUE
+        AND cars.id > COALESCE(after_car_id, 0)
+        AND NOT EXISTS (
+            SELECT 1 FROM rental_deals
+            WHERE int4range(rental_deals.car_id, rental_deals.car_id, '[]') && int4range(cars.id, cars.id, '[]')
+                AND rental_deals.period && requested_period
+                AND rental_deals.status = 'active'
+                AND rental_deals.car_id IS NOT NULL
+        )
+    ORDER BY cars.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION make_rent(
+    user_id INT, car_id INT,
+    start_location VARCHAR,
+    end_location VARCHAR,
+    start_date DATE, end_date DATE
+) RETURNS INT AS $$
+DECLARE
+    pick_up_location_id INT;
+    car_price NUMERIC;
+    total_price NUMERIC;
+    tax_price NUMERIC;
+    rent_price NUMERIC;
+    rental_deal_id INT;
+    owner_id INT;
+BEGIN
+    INSERT INTO pick_up_location (start_location, end_location)
+    VALUES (start_location, end_location)
+    RETURNING id INTO pick_up_location_id;
+
+    SELECT cars.owner_id INTO owner_id
+    FROM cars
+    WHERE cars.id = car_id;
+
+    IF owner_id = user_id THEN
+        RAISE EXCEPTION 'User cannot rent their own car';
+    END IF;
+
+    IF start_date < NOW() OR end_date < NOW() THEN
+        RAISE EXCEPTION 'Dates cannot be in the past';
+    END IF;
+
+    -- An empty period would never overlap anything
+    IF end_date <= start_date THEN
+        RAISE EXCEPTION 'End date should be after start date';
+    END IF;
+
+    IF start_location >= end_location THEN
+        RAISE EXCEPTION 'Start location should be before end location';
+    END IF;
+
+    SELECT price_per_day INTO car_price
+    FROM cars
+    WHERE id = car_id;
+
+    rent_price := (end_date - start_date) * car_price;
+    tax_price := rent_price * 0.13;
+    total_price := rent_price + tax_price;
+
+    -- Overlapping bookings fail here on rental_deals_no_overlap
+    INSERT INTO rental_deals (
+        user_id, car_id,
+        pick_up_id, start_date,
+        end_date, total_price
+    ) VALUES (
+        user_id, car_id,
+        pick_up_location_id, start_date,
+        end_date, rent_price
+    ) RETURNING id INTO rental_deal_id;
+
+    INSERT INTO payments (user_id, payed_price, time)
+    VALUES (user_id, total_price, NOW());
+
+    INSERT INTO taxes (rental_deal_id, price)
+    VALUES (rental_deal_id, tax_price);
+
+    RETURN rental_deal_id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,28 @@
+-- Whole catalogue for GET /cars/export, read through a server-side cursor.
+-- A plain SQL function is inlined into the caller's query, so the cursor
+-- walks cars_available_id_idx and hands out rows as they are produced
+-- instead of waiting for a plpgsql RETURN QUERY to collect all of them
+CREATE OR REPLACE FUNCTION export_cars()
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR
+) AS $$
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    WHERE
+        cars.is_available = TRUE
+    ORDER BY cars.id;
+$$ LANGUAGE sql STABLE;
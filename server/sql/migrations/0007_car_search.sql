@@ -0,0 +1,222 @@
+-- Full-text search over brand, model and description for GET /cars/search.
+-- The 'simple' configuration only lowercases, so model names are not
+-- stemmed and descriptions in any language are searchable
+
+
+-- Typo tolerance without pg_trgm: the words of every brand and model are
+-- split into the same trigrams pg_trgm uses and kept here, query words are
+-- expanded to the terms that share most of their trigrams. Brands are a
+-- small lookup table, so this vocabulary stays small too
+CREATE TABLE IF NOT EXISTS search_term_trigrams (
+    trigram TEXT NOT NULL,
+    term TEXT NOT NULL,
+    PRIMARY KEY (trigram, term)
+);
+
+
+CREATE OR REPLACE FUNCTION search_trigrams(word TEXT)
+RETURNS SETOF TEXT AS $$
+    SELECT DISTINCT substr(padded, position, 3)
+    FROM (SELECT '  ' || lower(word) || ' ' AS padded) AS padded_word,
+         generate_series(1, length(padded) - 2) AS position;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION index_brand_terms() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO search_term_trigrams (trigram, term)
+    SELECT search_trigrams(lexemes.lexeme), lexemes.lexeme
+    FROM unnest(to_tsvector('simple', NEW.name::text || ' ' || NEW.model)) AS lexemes
+    ON CONFLICT DO NOTHING;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+INSERT INTO search_term_trigrams (trigram, term)
+SELECT search_trigrams(lexemes.lexeme), lexemes.lexeme
+FROM brands, unnest(to_tsvector('simple', brands.name::text || ' ' || brands.model)) AS lexemes
+ON CONFLICT DO NOTHING;
+
+
+CREATE TRIGGER brands_index_terms_trigger
+AFTER INSERT OR UPDATE ON brands
+FOR EACH ROW
+EXECUTE FUNCTION index_brand_terms();
+
+
+-- Brand and model weigh more than the description
+CREATE OR REPLACE FUNCTION car_search_vector(car_brand_id INT, car_description VARCHAR)
+RETURNS TSVECTOR AS $$
+    SELECT
+        COALESCE(
+            (SELECT setweight(to_tsvector('simple', brands.name::text || ' ' || brands.model), 'A')
+             FROM brands WHERE brands.id = car_brand_id),
+            ''::TSVECTOR
+        )
+        || setweight(to_tsvector('simple', COALESCE(car_description, '')), 'B');
+$$ LANGUAGE sql STABLE;
+
+
+ALTER TABLE cars ADD COLUMN search_vector TSVECTOR;
+
+-- Skips the per-row change notifications of the backfill
+SET LOCAL app.bulk_import = 'on';
+UPDATE cars SET search_vector = car_search_vector(brand_id, description);
+
+CREATE INDEX IF NOT EXISTS cars_available_search_idx ON cars USING gin (search_vector) WHERE is_available;
+
+
+-- Runs for add_car, update_car and bulk imports alike
+CREATE OR REPLACE FUNCTION update_car_search_vector() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.search_vector := car_search_vector(NEW.brand_id, NEW.description);
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER cars_search_vector_trigger
+BEFORE INSERT OR UPDATE OF brand_id, description ON cars
+FOR EACH ROW
+EXECUTE FUNCTION update_car_search_vector();
+
+
+-- A quoted lexeme in the tsquery input syntax. Words match whole lexemes,
+-- not prefixes: the planner keeps statistics per lexeme but has to guess
+-- how common a prefix is, and the trigram expansion already completes
+-- brand and model names
+CREATE OR REPLACE FUNCTION tsquery_lexeme(lexeme TEXT)
+RETURNS TEXT AS $$
+    SELECT '''' || replace(replace(lexeme, '\', '\\'), '''', '''''') || '''';
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION search_cars(search_query TEXT, page_size INT DEFAULT 20)
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR
+) AS $$
+DECLARE
+    max_words CONSTANT INT := 8;
+    max_similar_terms CONSTANT INT := 5;
+    -- Share of a query word's trigrams a term has to contain, 0.5 lets
+    -- "camyr" find "camry" and "cam" find "camry" and "camaro"
+    min_similarity CONSTANT REAL := 0.5;
+    -- Ranking reads every candidate row, broad queries only rank their
+    -- first candidates in id order so a page stays a bounded amount of work
+    max_candidates CONSTANT INT := 200;
+    -- Cars read in id order before a query counts as rare and is looked up
+    -- through the GIN index instead. Row estimates for words missing from
+    -- the column statistics are a guess, so the plan is not left to them
+    max_scanned CONSTANT INT := 20000;
+    words TEXT[];
+    word TEXT;
+    similar_terms TEXT[];
+    exact_parts TEXT[] := '{}';
+    fuzzy_parts TEXT[] := '{}';
+    exact_query TSQUERY;
+    fuzzy_query TSQUERY;
+    candidate_ids INT[];
+BEGIN
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    -- A hyphenated word is indexed whole and by its parts, matching the parts is enough
+    words := ARRAY(
+        SELECT token_lexemes.lexeme
+        FROM ts_debug('simple', search_query) WITH ORDINALITY AS tokens, unnest(tokens.lexemes) AS token_lexemes(lexeme)
+        WHERE tokens.alias NOT IN ('asciihword', 'hword', 'numhword')
+        GROUP BY token_lexemes.lexeme
+        ORDER BY min(tokens.ordinality)
+        LIMIT max_words
+    );
+
+    IF cardinality(words) = 0 THEN
+        RAISE EXCEPTION 'Search query should contain at least one word';
+    END IF;
+
+    FOREACH word IN ARRAY words LOOP
+        similar_terms := '{}';
+        IF length(word) >= 3 THEN
+            similar_terms := ARRAY(
+                SELECT search_term_trigrams.term
+                FROM search_term_trigrams
+                WHERE search_term_trigrams.trigram IN (SELECT search_trigrams(word))
+                    AND search_term_trigrams.term <> word
+                GROUP BY search_term_trigrams.term
+                HAVING count(*) >= min_similarity * (SELECT count(*) FROM search_trigrams(word))
+                ORDER BY count(*) DESC, search_term_trigrams.term
+                LIMIT max_similar_terms
+            );
+        END IF;
+
+        exact_parts := exact_parts || tsquery_lexeme(word);
+        fuzzy_parts := fuzzy_parts || (
+            '(' || array_to_string(
+                tsquery_lexeme(word) || ARRAY(SELECT tsquery_lexeme(term) FROM unnest(similar_terms) AS term),
+                ' | '
+            ) || ')'
+        );
+    END LOOP;
+
+    exact_query := array_to_string(exact_parts, ' & ')::TSQUERY;
+    fuzzy_query := array_to_string(fuzzy_parts, ' & ')::TSQUERY;
+
+    -- A common query fills its candidates within the first cars
+    candidate_ids := ARRAY(
+        SELECT first_cars.id
+        FROM (
+            SELECT cars.id, cars.search_vector
+            FROM cars
+            WHERE cars.is_available = TRUE
+            ORDER BY cars.id
+            LIMIT max_scanned
+        ) AS first_cars
+        WHERE first_cars.search_vector @@ fuzzy_query
+        ORDER BY first_cars.id
+        LIMIT max_candidates
+    );
+
+    -- A rarer one is looked up through the GIN index. The CTE is planned to
+    -- return every match but read lazily, so this stops at max_candidates too
+    IF cardinality(candidate_ids) < max_candidates THEN
+        candidate_ids := ARRAY(
+            WITH matches AS MATERIALIZED (
+                SELECT cars.id
+                FROM cars
+                WHERE cars.is_available = TRUE AND cars.search_vector @@ fuzzy_query
+            )
+            SELECT matches.id FROM matches LIMIT max_candidates
+        );
+    END IF;
+
+    -- Matches with every word as typed come first, then the typo-tolerant ones
+    RETURN QUERY
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    WHERE
+        cars.id = ANY(candidate_ids)
+    ORDER BY
+        ts_rank(cars.search_vector, exact_query) DESC,
+        ts_rank(cars.search_vector, fuzzy_query) DESC,
+        cars.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,426 @@
+-- Reviews remember who wrote them and are read a page at a time. The number
+-- of reviews per car is kept in car_review_stats by make_review, so car
+-- listings show it with a primary key lookup instead of counting reviews
+
+
+-- Reviews written before this migration have no known author or date
+ALTER TABLE reviews ADD COLUMN user_id INT REFERENCES users(id) ON DELETE SET NULL;
+ALTER TABLE reviews ADD COLUMN created_at TIMESTAMPTZ;
+ALTER TABLE reviews ALTER COLUMN created_at SET DEFAULT NOW();
+
+CREATE INDEX IF NOT EXISTS reviews_user_id_idx ON reviews (user_id);
+
+
+CREATE TABLE IF NOT EXISTS car_review_stats (
+    car_id INT PRIMARY KEY REFERENCES cars(id) ON DELETE CASCADE,
+    review_count INT NOT NULL DEFAULT 0,
+    last_review_at TIMESTAMPTZ
+);
+
+INSERT INTO car_review_stats (car_id, review_count, last_review_at)
+SELECT reviews.car_id, COUNT(*), MAX(reviews.created_at)
+FROM reviews
+WHERE reviews.car_id IS NOT NULL
+GROUP BY reviews.car_id;
+
+
+-- A new review count has to reach the cached car listings
+CREATE TRIGGER car_review_stats_notify_change_trigger
+AFTER INSERT OR UPDATE OR DELETE ON car_review_stats
+FOR EACH ROW
+EXECUTE FUNCTION notify_car_change('car_id');
+
+
+CREATE OR REPLACE FUNCTION make_review(user_id INT, car_id INT, message VARCHAR)
+RETURNS INT AS $$
+DECLARE
+    review_id INT;
+BEGIN
+    CALL check_user_status(user_id);
+    CALL check_car(car_id);
+
+    IF message = '' OR message IS NULL THEN
+        RAISE EXCEPTION 'Message cannot be empty';
+    END IF;
+
+    INSERT INTO reviews (car_id, user_id, message)
+    VALUES (make_review.car_id, make_review.user_id, make_review.message)
+    RETURNING id INTO review_id;
+
+    -- Concurrent reviews of one car queue up on its stats row
+    INSERT INTO car_review_stats AS stats (car_id, review_count, last_review_at)
+    VALUES (make_review.car_id, 1, NOW())
+    ON CONFLICT ON CONSTRAINT car_review_stats_pkey DO UPDATE
+    SET review_count = stats.review_count + 1, last_review_at = EXCLUDED.last_review_at;
+
+    RETURN review_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP FUNCTION IF EXISTS get_reviews(INT);
+
+-- Newest first, the next page starts before the last review_id of this one.
+-- Walks reviews_car_id_idx backwards, so a page costs the same on any car
+CREATE OR REPLACE FUNCTION get_reviews(
+    chosen_car_id INT, before_review_id INT DEFAULT NULL, page_size INT DEFAULT 50
+)
+RETURNS TABLE (
+    review_id INT, user_id INT,
+    given_name VARCHAR, message VARCHAR,
+    created_at TIMESTAMPTZ
+) AS $$
+BEGIN
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    CALL check_car(chosen_car_id);
+
+    RETURN QUERY
+    SELECT reviews.id, reviews.user_id, users.given_name, reviews.message, reviews.created_at
+    FROM reviews
+    LEFT JOIN users ON reviews.user_id = users.id
+    WHERE reviews.car_id = chosen_car_id
+        AND (before_review_id IS NULL OR reviews.id < before_review_id)
+    ORDER BY reviews.id DESC
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Car listings gain review_count, a changed result type needs the old functions dropped
+DROP FUNCTION IF EXISTS get_available_cars(INT, INT, CAR_TYPE, CAR_BRAND, FUEL_TYPE, NUMERIC, NUMERIC);
+DROP FUNCTION IF EXISTS get_free_cars(DATE, DATE, INT, INT);
+DROP FUNCTION IF EXISTS get_favourites(INT);
+DROP FUNCTION IF EXISTS export_cars();
+DROP FUNCTION IF EXISTS search_cars(TEXT, INT);
+
+
+CREATE OR REPLACE FUNCTION get_available_cars(
+    after_car_id INT DEFAULT NULL, page_size INT DEFAULT 50,
+    filter_type_name CAR_TYPE DEFAULT NULL, filter_brand CAR_BRAND DEFAULT NULL,
+    filter_fuel_type FUEL_TYPE DEFAULT NULL,
+    min_price NUMERIC DEFAULT NULL, max_price NUMERIC DEFAULT NULL
+) 
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+DECLARE
+    query TEXT;
+BEGIN
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    -- Only the filters that were passed end up in the query, so every call
+    -- is planned against the matching partial index on cars
+    query := '
+        SELECT 
+            cars.id, car_types.type_name,
+            brands.name, brands.model,
+            fuel_types.type_name, cars.price_per_day,
+            (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+            COALESCE(car_review_stats.review_count, 0)
+        FROM 
+            cars
+        JOIN 
+            car_types ON cars.car_type_id = car_types.id
+        JOIN 
+            brands ON cars.brand_id = brands.id
+        JOIN 
+            fuel_types ON cars.fuel_type_id = fuel_types.id
+        LEFT JOIN
+            car_review_stats ON car_review_stats.car_id = cars.id
+        WHERE 
+            cars.is_available = TRUE';
+
+    IF after_car_id IS NOT NULL THEN
+        query := query || ' AND cars.id > $1';
+    END IF;
+
+    IF filter_type_name IS NOT NULL THEN
+        query := query || ' AND car_types.type_name = $3';
+    END IF;
+
+    IF filter_brand IS NOT NULL THEN
+        query := query || ' AND brands.name = $4';
+    END IF;
+
+    IF filter_fuel_type IS NOT NULL THEN
+        query := query || ' AND fuel_types.type_name = $5';
+    END IF;
+
+    IF min_price IS NOT NULL THEN
+        query := query || ' AND cars.price_per_day >= $6';
+    END IF;
+
+    IF max_price IS NOT NULL THEN
+        query := query || ' AND cars.price_per_day <= $7';
+    END IF;
+
+    query := query || ' ORDER BY cars.id LIMIT $2';
+
+    RETURN QUERY EXECUTE query
+    USING after_car_id, page_size, filter_type_name, filter_brand, filter_fuel_type, min_price, max_price;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION get_free_cars(
+    period_start DATE, period_end DATE,
+    after_car_id INT DEFAULT NULL, page_size INT DEFAULT 50
+)
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+DECLARE
+    requested_period DATERANGE;
+BEGIN
+    IF period_end <= period_start THEN
+        RAISE EXCEPTION 'End date should be after start date';
+    END IF;
+
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    requested_period := daterange(period_start, period_end, '[)');
+
+    -- Walks available cars in id order and probes rental_deals_no_overlap
+    -- once per car, so a page costs page_size index probes however many
+    -- bookings there are
+    RETURN QUERY
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+        COALESCE(car_review_stats.review_count, 0)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN
+        car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE
+        cars.is_available = TRUE
+        AND cars.id > COALESCE(after_car_id, 0)
+        AND NOT EXISTS (
+            SELECT 1 FROM rental_deals
+            WHERE int4range(rental_deals.car_id, rental_deals.car_id, '[]') && int4range(cars.id, cars.id, '[]')
+                AND rental_deals.period && requested_period
+                AND rental_deals.status = 'active'
+                AND rental_deals.car_id IS NOT NULL
+        )
+    ORDER BY cars.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION get_favourites(chosen_user_id INT) 
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+BEGIN
+    CALL check_user_status(chosen_user_id);
+
+    RETURN QUERY
+    SELECT 
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id LIMIT 1) AS main_image_url,
+        COALESCE(car_review_stats.review_count, 0)
+    FROM 
+        cars
+    JOIN 
+        car_types ON cars.car_type_id = car_types.id
+    JOIN 
+        brands ON cars.brand_id = brands.id
+    JOIN 
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN
+        car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE 
+        cars.id IN (SELECT favorite_cars.car_id FROM favorite_cars WHERE favorite_cars.user_id = chosen_user_id)
+        AND cars.is_available = TRUE
+    GROUP BY 
+        cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name, cars.price_per_day,
+        car_review_stats.review_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION export_cars()
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+        COALESCE(car_review_stats.review_count, 0)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN
+        car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE
+        cars.is_available = TRUE
+    ORDER BY cars.id;
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION search_cars(search_query TEXT, page_size INT DEFAULT 20)
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+DECLARE
+    max_words CONSTANT INT := 8;
+    max_similar_terms CONSTANT INT := 5;
+    -- Share of a query word's trigrams a term has to contain, 0.5 lets
+    -- "camyr" find "camry" and "cam" find "camry" and "camaro"
+    min_similarity CONSTANT REAL := 0.5;
+    -- Ranking reads every candidate row, broad queries only rank their
+    -- first candidates in id order so a page stays a bounded amount of work
+    max_candidates CONSTANT INT := 200;
+    -- Cars read in id order before a query counts as rare and is looked up
+    -- through the GIN index instead. Row estimates for words missing from
+    -- the column statistics are a guess, so the plan is not left to them
+    max_scanned CONSTANT INT := 20000;
+    words TEXT[];
+    word TEXT;
+    similar_terms TEXT[];
+    exact_parts TEXT[] := '{}';
+    fuzzy_parts TEXT[] := '{}';
+    exact_query TSQUERY;
+    fuzzy_query TSQUERY;
+    candidate_ids INT[];
+BEGIN
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    -- A hyphenated word is indexed whole and by its parts, matching the parts is enough
+    words := ARRAY(
+        SELECT token_lexemes.lexeme
+        FROM ts_debug('simple', search_query) WITH ORDINALITY AS tokens, unnest(tokens.lexemes) AS token_lexemes(lexeme)
+        WHERE tokens.alias NOT IN ('asciihword', 'hword', 'numhword')
+        GROUP BY token_lexemes.lexeme
+        ORDER BY min(tokens.ordinality)
+        LIMIT max_words
+    );
+
+    IF cardinality(words) = 0 THEN
+        RAISE EXCEPTION 'Search query should contain at least one word';
+    END IF;
+
+    FOREACH word IN ARRAY words LOOP
+        similar_terms := '{}';
+        IF length(word) >= 3 THEN
+            similar_terms := ARRAY(
+                SELECT search_term_trigrams.term
+                FROM search_term_trigrams
+                WHERE search_term_trigrams.trigram IN (SELECT search_trigrams(word))
+                    AND search_term_trigrams.term <> word
+                GROUP BY search_term_trigrams.term
+                HAVING count(*) >= min_similarity * (SELECT count(*) FROM search_trigrams(word))
+                ORDER BY count(*) DESC, search_term_trigrams.term
+                LIMIT max_similar_terms
+            );
+        END IF;
+
+        exact_parts := exact_parts || tsquery_lexeme(word);
+        fuzzy_parts := fuzzy_parts || (
+            '(' || array_to_string(
+                tsquery_lexeme(word) || ARRAY(SELECT tsquery_lexeme(term) FROM unnest(similar_terms) AS term),
+                ' | '
+            ) || ')'
+        );
+    END LOOP;
+
+    exact_query := array_to_string(exact_parts, ' & ')::TSQUERY;
+    fuzzy_query := array_to_string(fuzzy_parts, ' & ')::TSQUERY;
+
+    -- A common query fills its candidates within the first cars
+    candidate_ids := ARRAY(
+        SELECT first_cars.id
+        FROM (
+            SELECT cars.id, cars.search_vector
+            FROM cars
+            WHERE cars.is_available = TRUE
+            ORDER BY cars.id
+            LIMIT max_scanned
+        ) AS first_cars
+        WHERE first_cars.search_vector @@ fuzzy_query
+        ORDER BY first_cars.id
+        LIMIT max_candidates
+    );
+
+    -- A rarer one is looked up through the GIN index. The CTE is planned to
+    -- return every match but read lazily, so this stops at max_candidates too
+    IF cardinality(candidate_ids) < max_candidates THEN
+        candidate_ids := ARRAY(
+            WITH matches AS MATERIALIZED (
+                SELECT cars.id
+                FROM cars
+                WHERE cars.is_available = TRUE AND cars.search_vector @@ fuzzy_query
+            )
+            SELECT matches.id FROM matches LIMIT max_candidates
+        );
+    END IF;
+
+    -- Matches with every word as typed come first, then the typo-tolerant ones
+    RETURN QUERY
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+        COALESCE(car_review_stats.review_count, 0)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN
+        car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE
+        cars.id = ANY(candidate_ids)
+    ORDER BY
+        ts_rank(cars.search_vector, exact_query) DESC,
+        ts_rank(cars.search_vector, fuzzy_query) DESC,
+        cars.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,262 @@
+-- Revenue, tax and days rented per car and per owner for GET
+-- /user/{user_id}/analytics. Every booking adds to its car's and its
+-- owner's row as it is made, so a report reads one row per car instead of
+-- summing the whole rental history. Only active deals of existing cars count
+
+
+CREATE TABLE IF NOT EXISTS car_rental_stats (
+    car_id INT PRIMARY KEY REFERENCES cars(id) ON DELETE CASCADE,
+    deal_count INT NOT NULL DEFAULT 0,
+    days_rented INT NOT NULL DEFAULT 0,
+    revenue NUMERIC NOT NULL DEFAULT 0,
+    tax NUMERIC NOT NULL DEFAULT 0,
+    -- Span of the bookings made so far, only widened until the next
+    -- refresh_rental_stats, so cancelled and deleted ones stay in it
+    first_rental_date DATE,
+    last_rental_date DATE
+);
+
+
+CREATE TABLE IF NOT EXISTS owner_rental_stats (
+    owner_id INT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    deal_count INT NOT NULL DEFAULT 0,
+    days_rented INT NOT NULL DEFAULT 0,
+    revenue NUMERIC NOT NULL DEFAULT 0,
+    tax NUMERIC NOT NULL DEFAULT 0
+);
+
+
+CREATE OR REPLACE FUNCTION add_rental_stats(
+    stats_car_id INT, deals INT, days INT,
+    added_revenue NUMERIC, added_tax NUMERIC,
+    first_date DATE DEFAULT NULL, last_date DATE DEFAULT NULL
+)
+RETURNS VOID AS $$
+DECLARE
+    stats_owner_id INT;
+BEGIN
+    SELECT cars.owner_id INTO stats_owner_id FROM cars WHERE cars.id = stats_car_id;
+
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    -- Concurrent bookings of one car, or of one owner, queue up on these rows
+    INSERT INTO car_rental_stats AS stats (
+        car_id, deal_count, days_rented, revenue, tax, first_rental_date, last_rental_date
+    ) VALUES (
+        stats_car_id, deals, days, added_revenue, added_tax, first_date, last_date
+    )
+    ON CONFLICT ON CONSTRAINT car_rental_stats_pkey DO UPDATE
+    SET deal_count = stats.deal_count + EXCLUDED.deal_count,
+        days_rented = stats.days_rented + EXCLUDED.days_rented,
+        revenue = stats.revenue + EXCLUDED.revenue,
+        tax = stats.tax + EXCLUDED.tax,
+        first_rental_date = LEAST(stats.first_rental_date, EXCLUDED.first_rental_date),
+        last_rental_date = GREATEST(stats.last_rental_date, EXCLUDED.last_rental_date);
+
+    IF stats_owner_id IS NOT NULL THEN
+        INSERT INTO owner_rental_stats AS stats (owner_id, deal_count, days_rented, revenue, tax)
+        VALUES (stats_owner_id, deals, days, added_revenue, added_tax)
+        ON CONFLICT ON CONSTRAINT owner_rental_stats_pkey DO UPDATE
+        SET deal_count = stats.deal_count + EXCLUDED.deal_count,
+            days_rented = stats.days_rented + EXCLUDED.days_rented,
+            revenue = stats.revenue + EXCLUDED.revenue,
+            tax = stats.tax + EXCLUDED.tax;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Deals are counted with the taxes they already have, make_rent inserts
+-- its tax afterwards and taxes_rental_stats_trigger adds it
+CREATE OR REPLACE FUNCTION update_rental_stats() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.bulk_import', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    -- The car was deleted and its stats with it
+    IF TG_OP = 'UPDATE' AND NEW.car_id IS NULL AND OLD.car_id IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'active' AND OLD.car_id IS NOT NULL THEN
+        PERFORM add_rental_stats(
+            OLD.car_id, -1, -(upper(OLD.period) - lower(OLD.period)), -OLD.total_price,
+            -COALESCE((SELECT SUM(taxes.price) FROM taxes WHERE taxes.rental_deal_id = OLD.id), 0)
+        );
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'active' AND NEW.car_id IS NOT NULL THEN
+        PERFORM add_rental_stats(
+            NEW.car_id, 1, upper(NEW.period) - lower(NEW.period), NEW.total_price,
+            COALESCE((SELECT SUM(taxes.price) FROM taxes WHERE taxes.rental_deal_id = NEW.id), 0),
+            lower(NEW.period), upper(NEW.period)
+        );
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        RETURN OLD;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER rental_deals_stats_trigger
+AFTER INSERT OR UPDATE OF status, car_id, start_date, end_date, total_price ON rental_deals
+FOR EACH ROW
+EXECUTE FUNCTION update_rental_stats();
+
+
+-- Before the delete cascades to taxes, so the deal's taxes are still there to subtract
+CREATE TRIGGER rental_deals_stats_delete_trigger
+BEFORE DELETE ON rental_deals
+FOR EACH ROW
+EXECUTE FUNCTION update_rental_stats();
+
+
+CREATE OR REPLACE FUNCTION update_tax_stats() RETURNS TRIGGER AS $$
+DECLARE
+    deal_car_id INT;
+BEGIN
+    IF current_setting('app.bulk_import', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT rental_deals.car_id INTO deal_car_id
+        FROM rental_deals
+        WHERE rental_deals.id = OLD.rental_deal_id AND rental_deals.status = 'active';
+
+        IF deal_car_id IS NOT NULL THEN
+            PERFORM add_rental_stats(deal_car_id, 0, 0, 0, -OLD.price);
+        END IF;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT rental_deals.car_id INTO deal_car_id
+        FROM rental_deals
+        WHERE rental_deals.id = NEW.rental_deal_id AND rental_deals.status = 'active';
+
+        IF deal_car_id IS NOT NULL THEN
+            PERFORM add_rental_stats(deal_car_id, 0, 0, 0, NEW.price);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER taxes_rental_stats_trigger
+AFTER INSERT OR UPDATE OF rental_deal_id, price OR DELETE ON taxes
+FOR EACH ROW
+EXECUTE FUNCTION update_tax_stats();
+
+
+-- Runs before the car's stats row cascades away
+CREATE OR REPLACE FUNCTION remove_car_rental_stats() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE owner_rental_stats
+    SET deal_count = owner_rental_stats.deal_count - stats.deal_count,
+        days_rented = owner_rental_stats.days_rented - stats.days_rented,
+        revenue = owner_rental_stats.revenue - stats.revenue,
+        tax = owner_rental_stats.tax - stats.tax
+    FROM car_rental_stats stats
+    WHERE stats.car_id = OLD.id AND owner_rental_stats.owner_id = OLD.owner_id;
+
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER cars_rental_stats_delete_trigger
+BEFORE DELETE ON cars
+FOR EACH ROW
+EXECUTE FUNCTION remove_car_rental_stats();
+
+
+-- Rebuilds both tables from the rental history, after a bulk load with
+-- app.bulk_import set or to repair them. Locks out bookings while it runs
+CREATE OR REPLACE PROCEDURE refresh_rental_stats()
+AS $$
+BEGIN
+    LOCK TABLE rental_deals, taxes IN SHARE MODE;
+
+    DELETE FROM car_rental_stats;
+    DELETE FROM owner_rental_stats;
+
+    INSERT INTO car_rental_stats (car_id, deal_count, days_rented, revenue, tax, first_rental_date, last_rental_date)
+    SELECT
+        all_deals.car_id,
+        COUNT(*) FILTER (WHERE all_deals.status = 'active'),
+        COALESCE(SUM(upper(all_deals.period) - lower(all_deals.period)) FILTER (WHERE all_deals.status = 'active'), 0),
+        COALESCE(SUM(all_deals.total_price) FILTER (WHERE all_deals.status = 'active'), 0),
+        COALESCE(SUM(deal_taxes.price) FILTER (WHERE all_deals.status = 'active'), 0),
+        MIN(lower(all_deals.period)), MAX(upper(all_deals.period))
+    FROM rental_deals all_deals
+    JOIN cars ON all_deals.car_id = cars.id
+    LEFT JOIN (
+        SELECT taxes.rental_deal_id, SUM(taxes.price) AS price FROM taxes GROUP BY taxes.rental_deal_id
+    ) AS deal_taxes ON deal_taxes.rental_deal_id = all_deals.id
+    GROUP BY all_deals.car_id;
+
+    INSERT INTO owner_rental_stats (owner_id, deal_count, days_rented, revenue, tax)
+    SELECT cars.owner_id, SUM(stats.deal_count), SUM(stats.days_rented), SUM(stats.revenue), SUM(stats.tax)
+    FROM car_rental_stats stats
+    JOIN cars ON stats.car_id = cars.id
+    WHERE cars.owner_id IS NOT NULL
+    GROUP BY cars.owner_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CALL refresh_rental_stats();
+
+
+CREATE OR REPLACE FUNCTION get_owner_analytics(chosen_user_id INT)
+RETURNS TABLE (
+    car_count INT, deal_count INT,
+    days_rented INT, revenue NUMERIC, tax NUMERIC
+) AS $$
+BEGIN
+    CALL check_user_status(chosen_user_id);
+
+    RETURN QUERY
+    SELECT
+        (SELECT COUNT(*)::INT FROM cars WHERE cars.owner_id = chosen_user_id),
+        COALESCE(stats.deal_count, 0), COALESCE(stats.days_rented, 0),
+        COALESCE(stats.revenue, 0), COALESCE(stats.tax, 0)
+    FROM (SELECT 1) AS owner
+    LEFT JOIN owner_rental_stats stats ON stats.owner_id = chosen_user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Utilization is the share of days between a car's first booked day and
+-- its last one that it is rented
+CREATE OR REPLACE FUNCTION get_car_analytics(chosen_user_id INT)
+RETURNS TABLE (
+    car_id INT, brand CAR_BRAND, model VARCHAR,
+    deal_count INT, days_rented INT,
+    revenue NUMERIC, tax NUMERIC,
+    first_rental_date DATE, last_rental_date DATE,
+    utilization NUMERIC
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        cars.id, brands.name, brands.model,
+        COALESCE(stats.deal_count, 0), COALESCE(stats.days_rented, 0),
+        COALESCE(stats.revenue, 0), COALESCE(stats.tax, 0),
+        stats.first_rental_date, stats.last_rental_date,
+        COALESCE(round(stats.days_rented::NUMERIC / NULLIF(stats.last_rental_date - stats.first_rental_date, 0), 4), 0)
+    FROM cars
+    JOIN brands ON cars.brand_id = brands.id
+    LEFT JOIN car_rental_stats stats ON stats.car_id = cars.id
+    WHERE cars.owner_id = chosen_user_id
+    ORDER BY cars.id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,94 @@
+-- Signed session tokens issued by PUT /login. API workers keep each user's
+-- status and role in a session cache and tell the stored procedures which
+-- user they have already checked, so check_user_status only reads users on
+-- a cache miss
+
+
+-- app.verified_user_id is set for the current transaction by the API worker
+-- that checked the user against its session cache
+CREATE OR REPLACE PROCEDURE check_user_status(user_id INT) AS $$
+DECLARE
+    user_status ACTIVITY_STATUS_TYPE;
+BEGIN
+    IF current_setting('app.verified_user_id', true) = user_id::text THEN
+        RETURN;
+    END IF;
+
+    SELECT users.status INTO user_status FROM users WHERE users.id = user_id;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'User with id % does not exist', user_id;
+    END IF;
+
+    IF user_status = 'inactive' THEN
+        RAISE EXCEPTION 'User is inactive';
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- An active user logging in again, on another device or for a fresh token,
+-- only has the password checked. The row is written when an inactive user
+-- comes back
+CREATE OR REPLACE PROCEDURE user_login(IN email_to_check VARCHAR, IN password_to_check VARCHAR) AS $$
+DECLARE
+    user_status ACTIVITY_STATUS_TYPE;
+    user_password VARCHAR;
+BEGIN
+    IF NOT email_to_check ~ '^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}$' THEN
+        RAISE EXCEPTION 'Invalid email format';
+    END IF;
+
+    SELECT users.status, users.password INTO user_status, user_password
+    FROM users WHERE users.email = email_to_check;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'User with email % does not exist', email_to_check;
+    END IF;
+
+    IF user_password <> password_to_check THEN
+        RAISE EXCEPTION 'Incorrect password';
+    END IF;
+
+    IF user_status = 'inactive' THEN
+        UPDATE users SET status = 'active', role_id = 2 WHERE users.email = email_to_check;
+        RAISE NOTICE 'Login successful! User status changed from inactive to active';
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- What the session token and the session cache are filled from
+CREATE OR REPLACE FUNCTION login_user(email_to_check VARCHAR, password_to_check VARCHAR)
+RETURNS TABLE (user_id INT, status ACTIVITY_STATUS_TYPE, role_id INT) AS $$
+BEGIN
+    CALL user_login(email_to_check, password_to_check);
+
+    RETURN QUERY
+    SELECT users.id, users.status, users.role_id FROM users WHERE users.email = email_to_check;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Tells API workers to drop the user from their session cache, delivered on commit
+CREATE OR REPLACE FUNCTION notify_user_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.bulk_import', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('user_changes', OLD.id::text);
+    ELSE
+        PERFORM pg_notify('user_changes', NEW.id::text);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER users_notify_change_trigger
+AFTER UPDATE OF status, role_id OR DELETE ON users
+FOR EACH ROW
+EXECUTE FUNCTION notify_user_change();
@@ -0,0 +1,50 @@
+-- Details of several cars in one call for GET /cars/batch, for the
+-- favourites and comparison screens. Ids of cars that do not exist or are
+-- not available are left out, the caller reports them as missing
+
+
+CREATE OR REPLACE FUNCTION get_cars_by_ids(car_ids INT[])
+RETURNS TABLE (
+    car_id INT,
+    type_name CAR_TYPE, brand CAR_BRAND,
+    model VARCHAR, fuel_type FUEL_TYPE,
+    registration_plate VARCHAR, price_per_day NUMERIC,
+    description VARCHAR, images VARCHAR[],
+    given_name VARCHAR, telephone_no VARCHAR
+) AS $$
+BEGIN
+    -- In the order the ids were asked for, images in the order they were added
+    RETURN QUERY
+    SELECT
+        cars.id,
+        car_types.type_name, brands.name,
+        brands.model, fuel_types.type_name,
+        cars.registration_plate, cars.price_per_day,
+        cars.description,
+        COALESCE(car_image_urls.urls, '{}'),
+        users.given_name, users.telephone_no
+    FROM
+        (SELECT requested.id, min(requested.position) AS position
+         FROM unnest(car_ids) WITH ORDINALITY AS requested(id, position)
+         GROUP BY requested.id) AS requested_cars
+    JOIN
+        cars ON cars.id = requested_cars.id
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    JOIN
+        users ON cars.owner_id = users.id
+    LEFT JOIN
+        (SELECT car_images.car_id, array_agg(car_images.url ORDER BY car_images.id) AS urls
+         FROM car_images
+         WHERE car_images.car_id = ANY(car_ids)
+         GROUP BY car_images.car_id) AS car_image_urls ON car_image_urls.car_id = cars.id
+    WHERE
+        cars.is_available = TRUE
+    ORDER BY
+        requested_cars.position;
+END;
+$$ LANGUAGE plpgsql;
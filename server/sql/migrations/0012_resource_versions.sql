@@ -0,0 +1,249 @@
+-- Versions behind the ETags of GET /cars, /cars/{car_id},
+-- /cars/{car_id}/get_reviews and /user/{user_id}/get_favourites. A
+-- conditional request reads one version instead of running the endpoint's
+-- query, so an unchanged resource is answered with 304 and no body
+
+
+-- Bumped by every change to a car, its images or its owner's contact details
+ALTER TABLE cars ADD COLUMN version BIGINT NOT NULL DEFAULT 1;
+ALTER TABLE cars ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+-- Bumped by every review of the car and by edits to its reviews
+ALTER TABLE car_review_stats ADD COLUMN version BIGINT NOT NULL DEFAULT 1;
+
+
+-- Listing pages can lose cars, which no remaining row records, so the
+-- catalogue as a whole has a version of its own
+CREATE TABLE IF NOT EXISTS catalogue_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 1
+);
+
+INSERT INTO catalogue_version DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+
+CREATE OR REPLACE FUNCTION update_car_version() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    NEW.updated_at := NOW();
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER cars_version_trigger
+BEFORE UPDATE ON cars
+FOR EACH ROW
+EXECUTE FUNCTION update_car_version();
+
+
+-- Bulk imports only add images to the cars they insert
+CREATE OR REPLACE FUNCTION update_car_images_version() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.bulk_import', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE cars SET version = cars.version + 1 WHERE cars.id = OLD.car_id;
+    END IF;
+
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.car_id IS DISTINCT FROM OLD.car_id) THEN
+        UPDATE cars SET version = cars.version + 1 WHERE cars.id = NEW.car_id;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER car_images_version_trigger
+AFTER INSERT OR UPDATE OR DELETE ON car_images
+FOR EACH ROW
+EXECUTE FUNCTION update_car_images_version();
+
+
+-- Car details show the owner's name and telephone, reviews the reviewer's name
+CREATE OR REPLACE FUNCTION update_user_versions() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.given_name IS DISTINCT FROM OLD.given_name OR NEW.telephone_no IS DISTINCT FROM OLD.telephone_no THEN
+        UPDATE cars SET version = cars.version + 1 WHERE cars.owner_id = NEW.id;
+    END IF;
+
+    IF NEW.given_name IS DISTINCT FROM OLD.given_name THEN
+        UPDATE car_review_stats SET version = car_review_stats.version + 1
+        WHERE car_review_stats.car_id IN (SELECT reviews.car_id FROM reviews WHERE reviews.user_id = NEW.id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER users_versions_trigger
+AFTER UPDATE OF given_name, telephone_no ON users
+FOR EACH ROW
+EXECUTE FUNCTION update_user_versions();
+
+
+-- New reviews bump the version in make_review, together with the count
+CREATE OR REPLACE FUNCTION update_reviews_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE car_review_stats SET version = car_review_stats.version + 1
+    WHERE car_review_stats.car_id = OLD.car_id;
+
+    IF TG_OP = 'UPDATE' AND NEW.car_id IS DISTINCT FROM OLD.car_id THEN
+        UPDATE car_review_stats SET version = car_review_stats.version + 1
+        WHERE car_review_stats.car_id = NEW.car_id;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER reviews_version_trigger
+AFTER UPDATE OR DELETE ON reviews
+FOR EACH ROW
+EXECUTE FUNCTION update_reviews_version();
+
+
+-- Once per statement, so a bulk import bumps it once per chunk. Writers
+-- queue on the row only for the rest of their transaction
+CREATE OR REPLACE FUNCTION update_catalogue_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE catalogue_version SET version = catalogue_version.version + 1;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER cars_catalogue_version_trigger
+AFTER INSERT OR UPDATE OR DELETE ON cars
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_catalogue_version();
+
+
+CREATE TRIGGER car_images_catalogue_version_trigger
+AFTER INSERT OR UPDATE OR DELETE ON car_images
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_catalogue_version();
+
+
+CREATE TRIGGER car_review_stats_catalogue_version_trigger
+AFTER INSERT OR UPDATE OR DELETE ON car_review_stats
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_catalogue_version();
+
+
+CREATE TRIGGER brands_catalogue_version_trigger
+AFTER INSERT OR UPDATE OR DELETE ON brands
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_catalogue_version();
+
+
+CREATE OR REPLACE FUNCTION make_review(user_id INT, car_id INT, message VARCHAR)
+RETURNS INT AS $$
+DECLARE
+    review_id INT;
+BEGIN
+    CALL check_user_status(user_id);
+    CALL check_car(car_id);
+
+    IF message = '' OR message IS NULL THEN
+        RAISE EXCEPTION 'Message cannot be empty';
+    END IF;
+
+    INSERT INTO reviews (car_id, user_id, message)
+    VALUES (make_review.car_id, make_review.user_id, make_review.message)
+    RETURNING id INTO review_id;
+
+    -- Concurrent reviews of one car queue up on its stats row
+    INSERT INTO car_review_stats AS stats (car_id, review_count, last_review_at)
+    VALUES (make_review.car_id, 1, NOW())
+    ON CONFLICT ON CONSTRAINT car_review_stats_pkey DO UPDATE
+    SET review_count = stats.review_count + 1,
+        last_review_at = EXCLUDED.last_review_at,
+        version = stats.version + 1;
+
+    RETURN review_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The version comes with the details, so a cached copy carries the one it was read at
+DROP FUNCTION IF EXISTS get_available_car(INT);
+
+CREATE OR REPLACE FUNCTION get_available_car(car_id INT)
+RETURNS TABLE (
+    type_name CAR_TYPE, brand CAR_BRAND,
+    model VARCHAR, fuel_type FUEL_TYPE,
+    registration_plate VARCHAR, price_per_day NUMERIC,
+    description VARCHAR, images VARCHAR[],
+    given_name VARCHAR, telephone_no VARCHAR,
+    version BIGINT
+) AS $$
+BEGIN
+    CALL check_car(car_id);
+
+    RETURN QUERY
+    SELECT
+        car_types.type_name, brands.name,
+        brands.model, fuel_types.type_name,
+        cars.registration_plate, cars.price_per_day,
+        cars.description,
+        ARRAY(SELECT url FROM car_images WHERE car_images.car_id = cars.id),
+        users.given_name, users.telephone_no,
+        cars.version
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    JOIN
+        users ON cars.owner_id = users.id
+    WHERE
+        cars.id = car_id
+        AND cars.is_available = TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION get_catalogue_version()
+RETURNS BIGINT AS $$
+    SELECT catalogue_version.version FROM catalogue_version;
+$$ LANGUAGE sql STABLE;
+
+
+-- NULL for a car that does not exist or is not available
+CREATE OR REPLACE FUNCTION get_car_version(chosen_car_id INT)
+RETURNS BIGINT AS $$
+    SELECT cars.version FROM cars WHERE cars.id = chosen_car_id AND cars.is_available = TRUE;
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION get_reviews_version(chosen_car_id INT)
+RETURNS BIGINT AS $$
+    SELECT COALESCE(
+        (SELECT car_review_stats.version FROM car_review_stats WHERE car_review_stats.car_id = chosen_car_id), 0
+    );
+$$ LANGUAGE sql STABLE;
+
+
+-- Changes with the set of favourites and with the version of any of them
+CREATE OR REPLACE FUNCTION get_favourites_version(chosen_user_id INT)
+RETURNS TEXT AS $$
+    SELECT md5(COALESCE(string_agg(
+        favorite_cars.car_id || ':' || cars.version || ':' || COALESCE(stats.version, 0), ','
+        ORDER BY favorite_cars.car_id
+    ), ''))
+    FROM favorite_cars
+    JOIN cars ON cars.id = favorite_cars.car_id
+    LEFT JOIN car_review_stats stats ON stats.car_id = cars.id
+    WHERE favorite_cars.user_id = chosen_user_id;
+$$ LANGUAGE sql STABLE;
@@ -0,0 +1,12 @@
+-- Incremental finance extracts of payments, taxes and rental_deals. Each
+-- named extract remembers, per table, the highest id it has handed out, the
+-- next run of server.ledger reads only the rows after it
+
+
+CREATE TABLE IF NOT EXISTS ledger_watermarks (
+    name VARCHAR(100) NOT NULL,
+    table_name VARCHAR(50) NOT NULL,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    exported_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (name, table_name)
+);
@@ -0,0 +1,40 @@
+-- The favourites showed whichever image of a car the planner found first.
+-- The first image added is the main one, as in the listing, search, export
+-- and availability results
+
+
+CREATE OR REPLACE FUNCTION get_favourites(chosen_user_id INT) 
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+BEGIN
+    CALL check_user_status(chosen_user_id);
+
+    RETURN QUERY
+    SELECT 
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1) AS main_image_url,
+        COALESCE(car_review_stats.review_count, 0)
+    FROM 
+        cars
+    JOIN 
+        car_types ON cars.car_type_id = car_types.id
+    JOIN 
+        brands ON cars.brand_id = brands.id
+    JOIN 
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN
+        car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE 
+        cars.id IN (SELECT favorite_cars.car_id FROM favorite_cars WHERE favorite_cars.user_id = chosen_user_id)
+        AND cars.is_available = TRUE
+    GROUP BY 
+        cars.id, car_types.type_name, brands.name, brands.model, fuel_types.type_name, cars.price_per_day,
+        car_review_stats.review_count;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,309 @@
+-- Car search matches word prefixes and looks cars up tier by tier: every
+-- word as typed, then as a prefix, then typo tolerant. Candidates were the
+-- first typo-tolerant matches in id order, so a broad misspelling could push
+-- the cars matching the query exactly out of the ranked page. Similar terms
+-- come from pg_trgm where the server has it, the postgres image does. On a
+-- server without the contrib modules 0007's trigram table keeps serving them,
+-- so the migrations still need nothing beyond core PostgreSQL
+
+
+-- The words of every brand and model, looked up through pg_trgm
+CREATE TABLE IF NOT EXISTS search_terms (
+    term TEXT PRIMARY KEY
+);
+
+INSERT INTO search_terms (term)
+SELECT DISTINCT lexemes.lexeme
+FROM brands, unnest(to_tsvector('simple', brands.name::text || ' ' || brands.model)) AS lexemes
+ON CONFLICT DO NOTHING;
+
+
+-- Both vocabularies are kept, the fallback one stays usable if pg_trgm goes
+CREATE OR REPLACE FUNCTION index_brand_terms() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO search_term_trigrams (trigram, term)
+    SELECT search_trigrams(lexemes.lexeme), lexemes.lexeme
+    FROM unnest(to_tsvector('simple', NEW.name::text || ' ' || NEW.model)) AS lexemes
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO search_terms (term)
+    SELECT lexemes.lexeme
+    FROM unnest(to_tsvector('simple', NEW.name::text || ' ' || NEW.model)) AS lexemes
+    ON CONFLICT DO NOTHING;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Up to max_terms brand and model words most similar to word. Without
+-- pg_trgm, the terms sharing at least half of the word's trigrams, as in
+-- 0007: "camyr" finds "camry", "cam" finds "camry" and "camaro"
+CREATE OR REPLACE FUNCTION similar_search_terms(word TEXT, max_terms INT)
+RETURNS TEXT[] AS $$
+    SELECT ARRAY(
+        SELECT search_term_trigrams.term
+        FROM search_term_trigrams
+        WHERE search_term_trigrams.trigram IN (SELECT search_trigrams(word))
+            AND search_term_trigrams.term <> word
+        GROUP BY search_term_trigrams.term
+        HAVING count(*) >= 0.5 * (SELECT count(*) FROM search_trigrams(word))
+        ORDER BY count(*) DESC, search_term_trigrams.term
+        LIMIT max_terms
+    );
+$$ LANGUAGE sql STABLE;
+
+
+-- With pg_trgm the lookup goes through a gin_trgm_ops index. The extension
+-- needs the contrib package, and before PostgreSQL 13 a superuser to create
+-- it. Objects that use it are created by EXECUTE, so they are only parsed
+-- once it exists
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        RAISE NOTICE 'pg_trgm is not available, similar search terms come from search_term_trigrams';
+        RETURN;
+    END IF;
+
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN insufficient_privilege THEN
+        RAISE NOTICE 'Not allowed to create pg_trgm, similar search terms come from search_term_trigrams';
+        RETURN;
+    END;
+
+    EXECUTE 'CREATE INDEX IF NOT EXISTS search_terms_trgm_idx ON search_terms USING gin (term gin_trgm_ops)';
+
+    -- pg_trgm's default threshold, pinned so a session setting does not
+    -- change which terms a word is expanded to. "camyr" finds "camry",
+    -- "toyta" finds "toyota"
+    EXECUTE $function$
+        CREATE OR REPLACE FUNCTION similar_search_terms(word TEXT, max_terms INT)
+        RETURNS TEXT[] AS $body$
+            SELECT ARRAY(
+                SELECT search_terms.term
+                FROM search_terms
+                WHERE search_terms.term % word AND search_terms.term <> word
+                ORDER BY similarity(search_terms.term, word) DESC, search_terms.term
+                LIMIT max_terms
+            );
+        $body$ LANGUAGE sql STABLE
+        SET pg_trgm.similarity_threshold = 0.3
+    $function$;
+END;
+$$;
+
+
+-- Up to max_ids of the first max_scanned available cars that match
+-- search_query, in id order. Read in id order a common query stops early
+CREATE OR REPLACE FUNCTION first_car_ids(search_query TSQUERY, excluded_ids INT[], max_ids INT, max_scanned INT)
+RETURNS INT[] AS $$
+    SELECT ARRAY(
+        SELECT first_cars.id
+        FROM (
+            SELECT cars.id, cars.search_vector
+            FROM cars
+            WHERE cars.is_available = TRUE
+            ORDER BY cars.id
+            LIMIT max_scanned
+        ) AS first_cars
+        WHERE first_cars.search_vector @@ search_query AND first_cars.id <> ALL(excluded_ids)
+        ORDER BY first_cars.id
+        LIMIT max_ids
+    );
+$$ LANGUAGE sql STABLE;
+
+
+-- Up to max_ids available cars that match search_query, looked up through the
+-- GIN index by index_query. The CTE is planned to return every match but read
+-- lazily, so this stops at max_ids too
+CREATE OR REPLACE FUNCTION indexed_car_ids(search_query TSQUERY, index_query TSQUERY, excluded_ids INT[], max_ids INT)
+RETURNS INT[] AS $$
+    SELECT ARRAY(
+        WITH matches AS MATERIALIZED (
+            SELECT cars.id
+            FROM cars
+            WHERE cars.is_available = TRUE AND cars.search_vector @@ index_query
+                AND ts_match_vq(cars.search_vector, search_query)
+        )
+        SELECT matches.id FROM matches
+        WHERE matches.id <> ALL(excluded_ids)
+        LIMIT max_ids
+    );
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION search_cars(search_query TEXT, page_size INT DEFAULT 20)
+RETURNS TABLE (
+    car_id INT, type_name CAR_TYPE,
+    brand CAR_BRAND, model VARCHAR,
+    fuel_type FUEL_TYPE, price_per_day NUMERIC,
+    main_image_url VARCHAR, review_count INT
+) AS $$
+DECLARE
+    max_words CONSTANT INT := 8;
+    max_similar_terms CONSTANT INT := 5;
+    -- Ranking reads every candidate row, broad queries only rank the first
+    -- candidates of each tier so a page stays a bounded amount of work
+    max_candidates CONSTANT INT := 200;
+    -- Cars read in id order before a query counts as rare and is looked up
+    -- through the GIN index instead. Row estimates for words missing from
+    -- the column statistics are a guess, so the plan is not left to them
+    max_scanned CONSTANT INT := 20000;
+    words TEXT[];
+    word TEXT;
+    similar_terms TEXT[];
+    exact_parts TEXT[] := '{}';
+    prefix_parts TEXT[] := '{}';
+    fuzzy_parts TEXT[] := '{}';
+    exact_query TSQUERY;
+    any_exact_query TSQUERY;
+    prefix_query TSQUERY;
+    fuzzy_query TSQUERY;
+    tier_queries TSQUERY[];
+    index_queries TSQUERY[];
+    tier_number INT;
+    first_ids INT[];
+    fuzzy_common BOOLEAN;
+    tier_ids INT[];
+    candidate_ids INT[] := '{}';
+    all_matched BOOLEAN := FALSE;
+BEGIN
+    IF page_size <= 0 THEN
+        RAISE EXCEPTION 'Page size should be a positive number';
+    END IF;
+
+    -- A hyphenated word is indexed whole and by its parts, matching the parts is enough
+    words := ARRAY(
+        SELECT token_lexemes.lexeme
+        FROM ts_debug('simple', search_query) WITH ORDINALITY AS tokens, unnest(tokens.lexemes) AS token_lexemes(lexeme)
+        WHERE tokens.alias NOT IN ('asciihword', 'hword', 'numhword')
+        GROUP BY token_lexemes.lexeme
+        ORDER BY min(tokens.ordinality)
+        LIMIT max_words
+    );
+
+    IF cardinality(words) = 0 THEN
+        RAISE EXCEPTION 'Search query should contain at least one word';
+    END IF;
+
+    FOREACH word IN ARRAY words LOOP
+        similar_terms := '{}';
+        IF length(word) >= 3 THEN
+            similar_terms := similar_search_terms(word, max_similar_terms);
+        END IF;
+
+        -- The last word may still be being typed, it also matches as a prefix
+        exact_parts := exact_parts || tsquery_lexeme(word);
+        prefix_parts := prefix_parts || (
+            tsquery_lexeme(word) || CASE WHEN word = words[cardinality(words)] THEN ':*' ELSE '' END
+        );
+        fuzzy_parts := fuzzy_parts || (
+            '(' || array_to_string(
+                prefix_parts[cardinality(prefix_parts)]
+                    || ARRAY(SELECT tsquery_lexeme(term) FROM unnest(similar_terms) AS term),
+                ' | '
+            ) || ')'
+        );
+    END LOOP;
+
+    exact_query := array_to_string(exact_parts, ' & ')::TSQUERY;
+    any_exact_query := array_to_string(exact_parts, ' | ')::TSQUERY;
+    prefix_query := array_to_string(prefix_parts, ' & ')::TSQUERY;
+    fuzzy_query := array_to_string(fuzzy_parts, ' & ')::TSQUERY;
+    tier_queries := ARRAY[exact_query, prefix_query, fuzzy_query];
+
+    -- The index reads every posting of the lexemes a prefix matches, so with
+    -- more than one word it is only searched for the others and the prefix is
+    -- checked on the rows it returns
+    index_queries := tier_queries;
+    IF cardinality(words) > 1 THEN
+        index_queries[2] := array_to_string(exact_parts[1:cardinality(words) - 1], ' & ')::TSQUERY;
+        index_queries[3] := array_to_string(fuzzy_parts[1:cardinality(words) - 1], ' & ')::TSQUERY;
+    END IF;
+
+    -- The typo-tolerant tier takes in the others, a common query fills its
+    -- candidates within the first cars
+    first_ids := first_car_ids(fuzzy_query, '{}', max_candidates, max_scanned);
+    fuzzy_common := cardinality(first_ids) >= max_candidates;
+
+    -- Few of the first cars matching even the typo-tolerant tier, it is
+    -- likely rare overall. Fewer matches than max_candidates are all of them,
+    -- every tier included, so one index lookup does instead of one per tier
+    IF NOT fuzzy_common AND cardinality(first_ids) * (SELECT reltuples FROM pg_class WHERE oid = 'cars'::regclass)
+            < max_candidates * max_scanned THEN
+        tier_ids := indexed_car_ids(fuzzy_query, index_queries[3], '{}', max_candidates);
+        IF cardinality(tier_ids) < max_candidates THEN
+            candidate_ids := tier_ids;
+            all_matched := TRUE;
+        END IF;
+    END IF;
+
+    -- Each tier only fills what the ones before it left, so no exact match is
+    -- pushed out by typo-tolerant ones
+    FOR tier_number IN 1..3 LOOP
+        EXIT WHEN all_matched OR cardinality(candidate_ids) >= max_candidates;
+        -- Compared as text, tsquery equality ignores prefix markers. A word
+        -- without similar terms has no typo-tolerant tier of its own
+        CONTINUE WHEN tier_queries[tier_number]::TEXT = tier_queries[tier_number - 1]::TEXT;
+
+        tier_ids := ARRAY(
+            SELECT cars.id
+            FROM cars
+            WHERE cars.id = ANY(first_ids) AND cars.id <> ALL(candidate_ids)
+                AND cars.search_vector @@ tier_queries[tier_number]
+            ORDER BY cars.id
+            LIMIT max_candidates - cardinality(candidate_ids)
+        );
+
+        -- A tier missing from the first matches is rare, past them a common
+        -- one goes on in id order too
+        IF fuzzy_common AND cardinality(tier_ids) > 0
+                AND cardinality(tier_ids) < max_candidates - cardinality(candidate_ids) THEN
+            tier_ids := tier_ids || first_car_ids(
+                tier_queries[tier_number], candidate_ids || tier_ids,
+                max_candidates - cardinality(candidate_ids) - cardinality(tier_ids), max_scanned
+            );
+        END IF;
+
+        IF cardinality(tier_ids) < max_candidates - cardinality(candidate_ids) THEN
+            tier_ids := indexed_car_ids(
+                tier_queries[tier_number], index_queries[tier_number],
+                candidate_ids, max_candidates - cardinality(candidate_ids)
+            );
+        END IF;
+
+        candidate_ids := candidate_ids || tier_ids;
+    END LOOP;
+
+    -- Matches with every word as typed come first, then prefix matches, then
+    -- the typo-tolerant ones. Within each, cars matching more of the words as
+    -- typed rank higher
+    RETURN QUERY
+    SELECT
+        cars.id, car_types.type_name,
+        brands.name, brands.model,
+        fuel_types.type_name, cars.price_per_day,
+        (SELECT url FROM car_images WHERE car_images.car_id = cars.id ORDER BY car_images.id LIMIT 1),
+        COALESCE(car_review_stats.review_count, 0)
+    FROM
+        cars
+    JOIN
+        car_types ON cars.car_type_id = car_types.id
+    JOIN
+        brands ON cars.brand_id = brands.id
+    JOIN
+        fuel_types ON cars.fuel_type_id = fuel_types.id
+    LEFT JOIN
+        car_review_stats ON car_review_stats.car_id = cars.id
+    WHERE
+        cars.id = ANY(candidate_ids)
+    ORDER BY
+        cars.search_vector @@ exact_query DESC,
+        cars.search_vector @@ prefix_query DESC,
+        ts_rank(cars.search_vector, any_exact_query) DESC,
+        ts_rank(cars.search_vector, fuzzy_query) DESC,
+        cars.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
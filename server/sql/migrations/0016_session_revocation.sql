@@ -0,0 +1,55 @@
+-- Logging out revokes the user's session tokens. Tokens carry the
+-- session_generation they were issued at, logout moves it on, so a token
+-- from before it is refused even after the user logs in again
+
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS session_generation INT NOT NULL DEFAULT 0;
+
+
+CREATE OR REPLACE PROCEDURE user_logout(IN user_id INT, IN choice BOOLEAN) AS $$
+DECLARE
+    user_status ACTIVITY_STATUS_TYPE;
+BEGIN
+    IF choice THEN
+        SELECT status INTO user_status FROM users WHERE id = user_id;
+
+        IF FOUND THEN
+            IF user_status = 'active' THEN
+                UPDATE users
+                SET status = 'inactive', role_id = 1, session_generation = users.session_generation + 1
+                WHERE id = user_id;
+                RAISE NOTICE 'User status changed from active to inactive';
+            ELSE
+                RAISE EXCEPTION 'User is already inactive';
+            END IF;
+        ELSE
+            RAISE EXCEPTION 'User with such id % does not exist', user_id;
+        END IF;
+    ELSE
+        RAISE EXCEPTION 'User choice not confirmed';
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The generation is signed into the token PUT /login returns
+DROP FUNCTION IF EXISTS login_user(VARCHAR, VARCHAR);
+
+CREATE FUNCTION login_user(email_to_check VARCHAR, password_to_check VARCHAR)
+RETURNS TABLE (user_id INT, status ACTIVITY_STATUS_TYPE, role_id INT, session_generation INT) AS $$
+BEGIN
+    CALL user_login(email_to_check, password_to_check);
+
+    RETURN QUERY
+    SELECT users.id, users.status, users.role_id, users.session_generation FROM users WHERE users.email = email_to_check;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- A logout drops the user from every API worker's session cache
+DROP TRIGGER IF EXISTS users_notify_change_trigger ON users;
+
+CREATE TRIGGER users_notify_change_trigger
+AFTER UPDATE OF status, role_id, session_generation OR DELETE ON users
+FOR EACH ROW
+EXECUTE FUNCTION notify_user_change();